@@ -1,8 +1,11 @@
 #!/usr/bin/env/python
 import argparse
+import sys
 
 from src.disorder_annotators import APIDisorderAnnotator
 from src.disorder_annotators import LocalDisorderAnnotator
+from src.disorder_annotators import OfflineCacheMiss
+from src.mobidb_client import MOBIDB_URL
 
 
 def parser():
@@ -21,6 +24,55 @@ def parser():
         "-t", "--threads", type=int, choices=range(0, 8),
         help="(only relevant in local mode) How many threads should MobiDB-Lite use? (between 1(default) and 7)"
     )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="(only relevant in local mode) Split the fasta file in chunks of about equal numbers of residues and run "
+             "this many MobiDB-Lite processes at once, each with --threads threads (default: 1, no chunks)"
+    )
+    parser.add_argument(
+        "--chunks", type=int, default=None,
+        help="(only relevant in local mode with --jobs) Number of chunks (default: 4 per job)"
+    )
+    parser.add_argument(
+        "--index", type=str, default=None,
+        help="(only relevant in local mode) Index of earlier annotations by sequence digest (created if it does not "
+             "exist). Only new and changed sequences are annotated, the output is rebuilt from the index"
+    )
+    parser.add_argument(
+        "--base-url", type=str, default=MOBIDB_URL,
+        help="(only relevant in api mode) MobiDB download endpoint (default: {})".format(MOBIDB_URL)
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=8,
+        help="(only relevant in api mode) Number of concurrent requests to MobiDB (default: 8)"
+    )
+    parser.add_argument(
+        "--rate", type=float, default=10,
+        help="(only relevant in api mode) Maximum number of requests per second, 0 for no limit (default: 10)"
+    )
+    parser.add_argument(
+        "--retries", type=int, default=5,
+        help="(only relevant in api mode) Retries after transient errors (timeouts, HTTP 429/5xx) (default: 5)"
+    )
+    parser.add_argument(
+        "--cache", type=str, default=None,
+        help="(only relevant in api mode) Persistent MobiDB response cache (SQLite file). Proteins of which accession "
+             "and sequence are in the cache are not downloaded again"
+    )
+    parser.add_argument(
+        "--cache-ttl", type=float, default=None,
+        help="(only relevant in api mode) Days after which cached responses expire (default: never)"
+    )
+    parser.add_argument(
+        "--cache-size", type=float, default=None,
+        help="(only relevant in api mode) Maximum size of the response cache in MB, least recently used responses "
+             "are evicted (default: no limit)"
+    )
+    parser.add_argument(
+        "--offline", action="store_true",
+        help="(only relevant in api mode) Only use the response cache (--cache), stop at the first protein that is "
+             "not in the cache"
+    )
     return parser.parse_args()
 
 
@@ -28,11 +80,20 @@ def main():
     args = parser()
 
     if args.mode == "local":
-        annotator = LocalDisorderAnnotator(args.fasta, args.output)
-        annotator.get_disorder_annotations(threads=args.threads)
+        annotator = LocalDisorderAnnotator(args.fasta, args.output, index_file=args.index)
+        failed = annotator.get_disorder_annotations(threads=args.threads, jobs=args.jobs, chunks=args.chunks)
+        if failed:
+            sys.exit("ERROR: MobiDB-Lite failed for {} chunk(s), see above".format(len(failed)))
     elif args.mode == "api":
-        annotator = APIDisorderAnnotator(args.fasta, args.output)
-        annotator.get_disorder_annotations()
+        annotator = APIDisorderAnnotator(
+            args.fasta, args.output, base_url=args.base_url, concurrency=args.concurrency, rate=args.rate or None,
+            retries=args.retries, cache_file=args.cache,
+            cache_ttl=args.cache_ttl * 86400 if args.cache_ttl else None,
+            cache_size=int(args.cache_size * 1e6) if args.cache_size else None, offline=args.offline)
+        try:
+            annotator.get_disorder_annotations()
+        except OfflineCacheMiss as err:
+            sys.exit("ERROR: {}".format(err))
 
 
 if __name__ == "__main__":
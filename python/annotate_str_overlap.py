@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Make the final STR table (str_sp_final.tsv) from merged TRAL output and disorder annotation, e.g.:
+    annotate_str_overlap.py -t merged_tral_results.tsv -d disorder.tsv -f proteins.fasta -o str_sp_final.tsv
+Adds the center, type (homo/ micro), end, overlap with disordered regions (DSinTR, TRinDS, tail, head and total) and
+disorder/ order promoting composition of every STR, and the length of its protein if a fasta file is given. See
+src/str_idr_overlap.py for the definition of the overlap columns.
+
+IMPORTANT: fasta files are assumed to have UniProt/ SwissProt headers (the accession is used as ID)
+
+Author: Max Verbiest
+Contact: max.verbiest@zhaw.ch
+"""
+
+import argparse
+import time
+
+from Bio import SeqIO
+
+from src.str_idr_overlap import annotate_strs
+
+
+def cla_parser():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--tral", "-t", type=str, required=True, help="Path to merged TRAL output (see merge_tral_results.py)"
+    )
+    parser.add_argument(
+        "--disorder", "-d", type=str, required=True,
+        help="Path to disorder annotation (ID, start and end of every disordered region, see annotate_disorder.py)"
+    )
+    parser.add_argument(
+        "--fasta", "-f", type=str, default=None,
+        help="Path to the proteins, to add protein lengths (protein_length is NA if not given)"
+    )
+    parser.add_argument(
+        "--output", "-o", type=str, required=True, help="Path to write the final STR table to"
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    args = cla_parser()
+    start = time.perf_counter()
+    protein_lengths = None
+    if args.fasta:
+        protein_lengths = {record.id.split("|")[1]: len(record.seq) for record in SeqIO.parse(args.fasta, "fasta")}
+    n_strs, n_overlapping = annotate_strs(args.tral, args.disorder, args.output, protein_lengths)
+    print("Annotated {} STRs, {} overlap a disordered region ({:.1f} s)".format(
+        n_strs, n_overlapping, time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    main()
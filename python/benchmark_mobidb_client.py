@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Benchmark the MobiDB client (src/mobidb_client.py) against a local stand-in for the MobiDB API, so throughput and
+error handling can be measured without sending requests to MobiDB. The local server answers every request after a
+fixed latency, with HTTP 404 for a fraction of the accessions and HTTP 503 for a fraction of the requests (transient
+errors that the client retries). Reported are requests per second, the number of connections that were opened and the
+status of all results, e.g.:
+    benchmark_mobidb_client.py -n 2000 --latency 0.02 --concurrency 1 8 32 --baseline
+
+Author: Max Verbiest
+Contact: max.verbiest@zhaw.ch
+"""
+
+import argparse
+import collections
+import http.server
+import json
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from src.mobidb_client import MobiDBClient
+
+
+class StandInServer(http.server.ThreadingHTTPServer):
+    """Local HTTP/1.1 server that imitates the MobiDB download endpoint"""
+
+    daemon_threads = True
+
+    def __init__(self, latency=0.02, not_found=0.05, unavailable=0.02, seed=1):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.latency = latency
+        self.not_found = not_found
+        self.unavailable = unavailable
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = 0
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}/api/download".format(self.server_address[1])
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    # keep-alive connections, headers and body are sent without waiting for acknowledgement
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        accession = query.get("acc", [""])[0]
+        with self.server.lock:
+            self.server.requests += 1
+            unavailable = self.server.random.random() < self.server.unavailable
+        time.sleep(self.server.latency)
+        if unavailable:
+            self.respond(503, b"")
+        elif random.Random(accession).random() < self.server.not_found:
+            self.respond(404, b"")
+        else:
+            # deterministic disordered regions for every accession
+            rng = random.Random(accession)
+            begin = rng.randint(1, 200)
+            entry = {"acc": accession,
+                     "prediction-disorder-mobidb_lite": {"regions": [[begin, begin + rng.randint(20, 100)]]}}
+            self.respond(200, json.dumps(entry).encode("utf-8"))
+
+    def respond(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_client(server, accessions, concurrency, rate=None):
+    """Query all accessions with the client, returns elapsed time and result status counts"""
+
+    client = MobiDBClient(server.url, concurrency=concurrency, rate=rate, retries=5, backoff=0.01, timeout=10)
+    start = time.perf_counter()
+    statuses = collections.Counter(result.status for result in client.fetch_all(accessions))
+    elapsed = time.perf_counter() - start
+    client.close()
+    return elapsed, statuses
+
+
+def run_baseline(server, accessions):
+    """Query all accessions one by one with a new urllib connection per request (the previous implementation, which
+    counts all errors as not found)"""
+
+    statuses = collections.Counter()
+    start = time.perf_counter()
+    for accession in accessions:
+        try:
+            with urllib.request.urlopen("{}?acc={}&format=json".format(server.url, accession)) as response:
+                json.loads(response.read().decode("utf-8"))
+                statuses["found"] += 1
+        except urllib.error.URLError:
+            statuses["not_found"] += 1
+    return time.perf_counter() - start, statuses
+
+
+def report(name, server, n, elapsed, statuses, connections, requests):
+    print("{:<16}{:>10.1f}{:>12}{:>10}   {}".format(
+        name, n / elapsed, server.connections - connections, server.requests - requests,
+        ", ".join("{}={}".format(status, count) for status, count in sorted(statuses.items()))))
+
+
+def parser():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--n", "-n", type=int, default=1000, help="Number of accessions to query (default: 1000)"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.02, help="Response time of the local server in seconds (default: 0.02)"
+    )
+    parser.add_argument(
+        "--not-found", type=float, default=0.05, help="Fraction of accessions answered with 404 (default: 0.05)"
+    )
+    parser.add_argument(
+        "--unavailable", type=float, default=0.02, help="Fraction of requests answered with 503 (default: 0.02)"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, nargs="+", default=[1, 8, 32],
+        help="Numbers of concurrent requests to benchmark (default: 1 8 32)"
+    )
+    parser.add_argument(
+        "--rate", type=float, default=None, help="Rate limit of the client in requests per second (default: none)"
+    )
+    parser.add_argument(
+        "--baseline", action="store_true",
+        help="Also benchmark serial requests with a new urllib connection per request"
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    args = parser()
+    server = StandInServer(latency=args.latency, not_found=args.not_found, unavailable=args.unavailable)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    accessions = ["P{:05d}".format(i) for i in range(args.n)]
+
+    print("{:<16}{:>10}{:>12}{:>10}   {}".format("client", "req/s", "connections", "requests", "results"))
+    if args.baseline:
+        connections, requests = server.connections, server.requests
+        elapsed, statuses = run_baseline(server, accessions)
+        report("urllib serial", server, args.n, elapsed, statuses, connections, requests)
+    for concurrency in args.concurrency:
+        connections, requests = server.connections, server.requests
+        elapsed, statuses = run_client(server, accessions, concurrency, rate=args.rate)
+        report("pool x{}".format(concurrency), server, args.n, elapsed, statuses, connections, requests)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
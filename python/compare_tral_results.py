@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Concordance report between two merged tables of tandem repeats (columns ID, begin, msa_original, l_effective and
+repeat_region_length), e.g. a run with windowed detection (run_tral.py --windows) against a run on complete sequences,
+or any run against the reference table data_for_sub/str_sp_final.tsv.
+
+TRs are matched exactly on ID, begin and l_effective. TRs that are not matched exactly but overlap a TR with the same
+ID and l_effective in the other table are reported as shifted.
+
+Author: Max Verbiest
+Contact: max.verbiest@zhaw.ch
+"""
+
+import argparse
+import collections
+import csv
+
+
+def read_repeats(tr_file, max_l_effective=None):
+    """Read TRs from a merged table
+
+    Parameters
+    tr_file (str):  table with TRs
+    max_l_effective (int):
+                    If given, only keep TRs with at most this unit length
+
+    Returns
+    repeats (dict):
+                    (ID, begin, l_effective) -> (begin, end) of the repeat region (1-based, inclusive)
+    """
+
+    repeats = dict()
+    with open(tr_file, "r") as f:
+        for row in csv.DictReader(f, delimiter="\t"):
+            l_effective = int(float(row["l_effective"]))
+            if max_l_effective and l_effective > max_l_effective:
+                continue
+            begin = int(row["begin"])
+            repeats[(row["ID"], begin, l_effective)] = (begin, begin + int(row["repeat_region_length"]) - 1)
+    return repeats
+
+
+def compare(reference, query):
+    """Compare two sets of TRs (see read_repeats())
+
+    Returns
+    counts (dict):  per status ("shared", "shifted_reference", "reference_only", "shifted_query", "query_only"):
+                    collections.Counter of TRs per l_effective
+    unmatched (dict):
+                    per status: list of keys of TRs that were not matched exactly
+    """
+
+    def overlapping(repeats):
+        # per protein and unit length, regions of all TRs of the other table
+        index = collections.defaultdict(list)
+        for (prot_id, _, l_effective), region in repeats.items():
+            index[(prot_id, l_effective)].append(region)
+        return index
+
+    counts = collections.defaultdict(collections.Counter)
+    unmatched = collections.defaultdict(list)
+    for name, repeats, other in (("reference", reference, query), ("query", query, reference)):
+        index = overlapping(other)
+        for key, (begin, end) in sorted(repeats.items()):
+            if key in other:
+                if name == "reference":
+                    counts["shared"][key[2]] += 1
+                continue
+            shifted = any(begin <= other_end and other_begin <= end
+                          for other_begin, other_end in index[(key[0], key[2])])
+            status = "shifted_{}".format(name) if shifted else "{}_only".format(name)
+            counts[status][key[2]] += 1
+            unmatched[status].append(key)
+    return counts, unmatched
+
+
+def print_report(counts, n_reference, n_query):
+    print("Reference: {} TRs, query: {} TRs".format(n_reference, n_query))
+    shared = sum(counts["shared"].values())
+    print("Shared (ID, begin, l_effective): {} ({:.2%} of reference, {:.2%} of query)".format(
+        shared, shared / n_reference if n_reference else 0, shared / n_query if n_query else 0))
+    statuses = ["shared", "shifted_reference", "reference_only", "shifted_query", "query_only"]
+    print("\nl_effective\t" + "\t".join(statuses))
+    for l_effective in sorted(set().union(*counts.values())):
+        print("{}\t{}".format(l_effective, "\t".join(str(counts[status][l_effective]) for status in statuses)))
+
+
+def write_unmatched(unmatched, reference, query, output_file):
+    with open(output_file, "w") as o:
+        o.write("status\tID\tbegin\tend\tl_effective\n")
+        for status, keys in unmatched.items():
+            repeats = reference if status.endswith("reference") else query
+            for key in keys:
+                o.write("{}\t{}\t{}\t{}\t{}\n".format(status, key[0], key[1], repeats[key][1], key[2]))
+
+
+def parser():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--reference", "-r", type=str, required=True, help="Merged table with reference TRs, e.g. str_sp_final.tsv"
+    )
+    parser.add_argument(
+        "--query", "-q", type=str, required=True, help="Merged table with TRs to compare to the reference"
+    )
+    parser.add_argument(
+        "--max-l-effective", type=int, default=None,
+        help="Only compare TRs with at most this unit length, e.g. 3 for the STR reference table (default: all)"
+    )
+    parser.add_argument(
+        "--common-ids", action="store_true",
+        help="Only compare proteins that occur in both tables, e.g. when the query covers a subset of the proteins "
+             "(default: False)"
+    )
+    parser.add_argument(
+        "--output", "-o", type=str, default=None, help="Write TRs that are not matched exactly to this file"
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    args = parser()
+    reference = read_repeats(args.reference, args.max_l_effective)
+    query = read_repeats(args.query, args.max_l_effective)
+    if args.common_ids:
+        ids = {key[0] for key in reference} & {key[0] for key in query}
+        reference = {key: region for key, region in reference.items() if key[0] in ids}
+        query = {key: region for key, region in query.items() if key[0] in ids}
+
+    counts, unmatched = compare(reference, query)
+    print_report(counts, len(reference), len(query))
+    if args.output:
+        write_unmatched(unmatched, reference, query, args.output)
+
+
+if __name__ == "__main__":
+    main()
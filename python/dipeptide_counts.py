@@ -1,11 +1,24 @@
 #!/usr/bin/env python3
+"""
+Count dipeptides in SwissProt proteins outside of STRs (dipeptides that overlap an STR are not counted), for the
+dipeptides that make up the most common di-peptide STRs. Counting is done in batches of proteins with the vectorized
+counter in src/dipeptide_counter.py, which also counts the dipeptides inside STRs; with --output the counts of all 400
+dipeptides are written to a table.
+
+Author: Max Verbiest
+Contact: max.verbiest@zhaw.ch
+"""
 
 import argparse
 import itertools
+import time
 
 from Bio import SeqIO
 import pandas as pd
 
+from src.dipeptide_counter import DipeptideCounter
+
+
 def cla_parser():
     parser = argparse.ArgumentParser()
 
@@ -15,13 +28,33 @@ def cla_parser():
     parser.add_argument(
         "--str_df", "-s", type=str, required=True, help="Path to where dataframe with STR information is stored"
     )
+    parser.add_argument(
+        "--output", "-o", type=str, default=None,
+        help="Write the counts of all dipeptides inside and outside of STRs to this file"
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=10000, help="Number of proteins that are counted at once (default: 10000)"
+    )
 
     return parser.parse_args()
 
 
+def read_str_regions(strs):
+    """Read the regions of all STRs per protein from the STR dataframe
+
+    Returns
+    str_regions (dict): protein ID -> (begins, ends) arrays of its STRs
+    """
+
+    str_df = pd.read_csv(strs, sep="\t")
+    if "end" not in str_df.columns:
+        str_df["end"] = str_df["begin"] + str_df["repeat_region_length"] - 1
+    begins, ends = str_df["begin"].to_numpy(), str_df["end"].to_numpy()
+    return {prot_id: (begins[rows], ends[rows]) for prot_id, rows in str_df.groupby("ID").indices.items()}
+
+
 def main():
-    proteins = "/Users/maxverbiest/PhD/projects/SP_CRC_Pathway_TRs/data/uniprot_human_reviewed_21122020.fasta"
-    strs = "/Users/maxverbiest/PhD/projects/SP_CRC_Pathway_TRs/data_for_sub/str_sp_final.tsv"
+    args = cla_parser()
     duos = {
         ("G", "S"),
         ("A", "P"),
@@ -34,50 +67,26 @@ def main():
         ("E", "R"),
         ("K", "E")
     }
+
+    start = time.perf_counter()
+    counter = DipeptideCounter(read_str_regions(args.str_df))
+    proteins = ((record.id.split("|")[1], str(record.seq)) for record in SeqIO.parse(args.proteins, "fasta"))
+    while True:
+        batch = list(itertools.islice(proteins, args.batch_size))
+        if not batch:
+            break
+        counter.add(batch)
+
     count_dict = dict()
     for duo in duos:
-        count_dict[f"{duo[0]}{duo[1]}"] = 0
-        count_dict[f"{duo[1]}{duo[0]}"] = 0
-
-    str_df = pd.read_csv(strs, sep="\t")[["ID", "begin", "end"]]
-    prot_dict = dict()
-    for i, row in str_df.iterrows():
-        try:
-            prot_dict[row["ID"]].append((row["begin"], row["end"]))
-        except KeyError:
-            prot_dict[row["ID"]] = [(row["begin"], row["end"])]
-
-    prot_parser = SeqIO.parse(proteins, "fasta")
-    for record in prot_parser:
-        uniprot_id = record.id.split("|")[1]
-        for i in range(0, len(record.seq) + 1):
-            try:
-                dipeptide = record.seq[i:i + 2]
-                skip = False
-                # try to access count dictionary to see if dipeptide is among those to count
-                count_dict[dipeptide]
-                try:
-                    str_coords = prot_dict[uniprot_id]
-                    # protein contains STR, check if current dipeptide overlaps STR
-                    for coords in str_coords:
-                        # is first dipeptide position in STR?
-                        if coords[0] <= i+1 <= coords[1]:
-                            skip = True
-                            break
-                        # is second dipeptide position in STR?
-                        elif coords[0] <= i+2 <= coords[1]:
-                            skip = True
-                            break
-                    # dipeptide not in any STR, increment dipeptide count
-                    if not skip:
-                        count_dict[dipeptide] += 1
-                except KeyError:
-                    # protein does not have STR(s), increment dipeptide count
-                    count_dict[dipeptide] += 1
-            except KeyError:
-                # dipeptide is not among those to count, continue
-                continue
+        for dipeptide in [f"{duo[0]}{duo[1]}", f"{duo[1]}{duo[0]}"]:
+            count_dict[dipeptide] = counter.outside(dipeptide)
     print(count_dict)
+    if args.output:
+        counter.write(args.output)
+    print("Counted dipeptides in {} proteins ({} residues) in {:.1f} s".format(
+        counter.n_proteins, counter.n_residues, time.perf_counter() - start))
+
 
 if __name__ == "__main__":
     main()
@@ -2,47 +2,226 @@
 """
 Sometimes, TRAL returns duplicate TRs (not sure why).
 This script will take the output from run_tral.py that has been merged using merge_tral_results.py and remove the
-duplicates. This is done by checked if (ID, begin) is unique (pretty naive method but should work)
+duplicates. By default, this is done by checking if (ID, begin) is unique (pretty naive method but should work), TRs
+can also be compared on (ID, begin, end) or (ID, msa_original).
+
+The file is filtered in a single streaming pass: merged files list the TRs of a protein together, so only the keys of
+the current protein are kept in memory. Files where the TRs of a protein are spread out are filtered again with the
+keys of all TRs in memory when a protein occurs a second time, --ungrouped does so from the start.
+
+Optionally, TRs that overlap another TR of the same protein (e.g. found in separate shards or windows) are removed as
+well, keeping the TR with the lowest p-value, the lowest divergence or the longest region (see src/intervals.py). This
+is done on batches of complete proteins.
 
 Author: Max Verbiest
 Contact: max.verbiest@zhaw.ch
 """
 
 import argparse
+import os
+import time
+
+# columns that identify a TR (besides its protein ID) for every type of key
+KEYS = {
+    "begin": ["begin"],
+    "begin-end": ["begin", "end"],
+    "msa": ["msa_original"],
+}
+
+# rules for --resolve-overlaps, as src.intervals.RULES (not imported here: plain duplicate filtering needs no numpy)
+OVERLAP_RULES = ["pvalue", "divergence", "length"]
+
+
+class UngroupedError(ValueError):
+    """The TRs of a protein are not listed together"""
+
+
+def key_function(header, key="begin"):
+    """Function that returns the key of a TR from its (split) line
+
+    Parameters
+    header (list[str]): column names of the file
+    key (str):          type of key, see KEYS. 'end' is calculated from begin and repeat_region_length if the file has
+                        no end column
+    """
+
+    if key not in KEYS:
+        raise ValueError("Unknown key '{}', choose from: {}".format(key, ", ".join(KEYS)))
+    columns = []
+    for name in KEYS[key]:
+        if name == "end" and "end" not in header:
+            begin, length = header.index("begin"), header.index("repeat_region_length")
+            columns.append(lambda fields: int(fields[begin]) + int(fields[length]) - 1)
+        else:
+            index = header.index(name)
+            columns.append(lambda fields, index=index: fields[index])
+    return lambda fields: tuple(column(fields) for column in columns)
 
 
-def tral_file_filter(file):
-    """In file, check whether there are TRs that belong to the same protein and have the same starting amino acid.
-    This should never occur and these instances are therefore considered duplicates.
+def filter_lines(lines, key="begin", grouped=True):
+    """Remove duplicate TRs from the lines of a merged TRAL file
+
+    Parameters
+    lines (iterable[str]):  lines of the file, starting with the header
+    key (str):              type of key that identifies a TR within a protein, see KEYS
+    grouped (bool):         If True (default), the TRs of every protein are expected to be listed together, and only
+                            the keys of the current protein (and the IDs of finished proteins) are kept in memory. An
+                            UngroupedError is raised when a protein occurs again after other proteins. If False, the
+                            keys of all TRs are kept
+
+    Yields
+    line (str):             header and unique TR lines, in input order
+    """
+
+    lines = iter(lines)
+    header_line = next(lines)
+    yield header_line
+    get_key = key_function(header_line.rstrip("\n").split("\t"), key)
+
+    finished = set()
+    current_id = None
+    seen = set()
+    for line in lines:
+        fields = line.rstrip("\n").split("\t")
+        prot_id = fields[0]
+        if grouped and prot_id != current_id:
+            if prot_id in finished:
+                raise UngroupedError("TRs of protein {} are not listed together".format(prot_id))
+            finished.add(current_id)
+            current_id = prot_id
+            seen = set()
+        tr_key = get_key(fields) if grouped else (prot_id,) + get_key(fields)
+        if tr_key in seen:
+            continue
+        seen.add(tr_key)
+        yield line
+
+
+def resolve_overlapping_lines(lines, rule="pvalue", batch_size=100000, counts=None):
+    """Remove TRs that overlap a better TR (according to rule) of the same protein
+
+    Parameters
+    lines (iterable[str]):  lines of a merged TRAL file, starting with the header
+    rule (str):             which TR of an overlapping pair is kept, see src.intervals.RULES
+    batch_size (int):       minimal number of lines that are resolved at once. Batches end at the end of a protein,
+                            so the TRs of every protein have to be listed together. If None, all lines are resolved at
+                            once
+    counts (dict):          If given, the number of overlapping pairs and removed TRs are added to it
+                            ("overlapping_pairs", "overlapping_removed")
+
+    Yields
+    line (str):             header and the lines of the TRs that are kept, in input order
+    """
+
+    import numpy as np
+
+    from src.intervals import resolve_overlaps
+
+    lines = iter(lines)
+    header_line = next(lines)
+    yield header_line
+    header = header_line.rstrip("\n").split("\t")
+    begin, pvalue, divergence = header.index("begin"), header.index("pvalue"), header.index("divergence")
+    end = header.index("end") if "end" in header else None
+    length = header.index("repeat_region_length") if end is None else None
+    counts = counts if counts is not None else dict()
+    counts.setdefault("overlapping_pairs", 0)
+    counts.setdefault("overlapping_removed", 0)
+
+    def resolve(batch):
+        fields = [line.rstrip("\n").split("\t") for line in batch]
+        begins = np.array([int(f[begin]) for f in fields], dtype=np.int64)
+        if end is not None:
+            ends = np.array([int(f[end]) for f in fields], dtype=np.int64)
+        else:
+            ends = begins + np.array([int(f[length]) for f in fields], dtype=np.int64) - 1
+        values = {"pvalue": np.array([float(f[pvalue]) for f in fields]),
+                  "divergence": np.array([float(f[divergence]) for f in fields])}
+        keep, n_pairs = resolve_overlaps([f[0] for f in fields], begins, ends, values, rule=rule)
+        counts["overlapping_pairs"] += n_pairs
+        counts["overlapping_removed"] += int((~keep).sum())
+        return [line for line, kept in zip(batch, keep) if kept]
+
+    batch = []
+    for line in lines:
+        if batch_size and len(batch) >= batch_size and line.split("\t", 1)[0] != batch[-1].split("\t", 1)[0]:
+            yield from resolve(batch)
+            batch = []
+        batch.append(line)
+    if batch:
+        yield from resolve(batch)
+
+
+def tral_file_filter(file, output_file=None, key="begin", grouped=True, overlap_rule=None):
+    """In file, check whether there are TRs that belong to the same protein and have the same key (by default the
+    same starting amino acid). This should never occur and these instances are therefore considered duplicates.
 
     Paramters
-    file (str): Merged TRAL output file that will be checked for duplicates
+    file (str):         Merged TRAL output file that will be checked for duplicates
+    output_file (str):  File for the lines without duplicates, may be the same as file. The output is written under a
+                        temporary name and renamed when complete. If None (default), duplicates are only counted
+    key (str):          type of key that identifies a TR within a protein, see KEYS
+    grouped (bool):     are the TRs of every protein listed together? See filter_lines(). If the file turns out not
+                        to be grouped, it is filtered again with grouped=False
+    overlap_rule (str): If given, TRs that overlap a better TR of the same protein are removed as well, see
+                        resolve_overlapping_lines()
 
     Returns
-    line_list (list[str]):
-                A list containing lines describing tandem repeats, with the duplicate lines removed
+    counts (tuple(int, int)):
+                        number of TR lines read and number of TRs removed (duplicates and overlapping TRs)
     """
-    
-    filtered_dict = {}
-    line_list = []
-    dupe_count = 0
-    with open(file, "r") as f:
-        for line in f:
-            if line.startswith("ID"):
-                line_list.append(line)
-                continue
-            prot_id, begin = line.split("\t")[0], line.split("\t")[1]
-            try:
-                if begin in filtered_dict[prot_id]:
-                    dupe_count += 1
-                    continue
-                filtered_dict[prot_id].append(begin)
-                line_list.append(line)
-            except KeyError:
-                filtered_dict[prot_id] = [begin]
-                line_list.append(line)
-    print("Filter found {} cases where TRs in the same protein had the same start position.".format(dupe_count))
-    return line_list
+
+    tmp_file = output_file + ".tmp" if output_file else os.devnull
+    start = time.perf_counter()
+
+    def counted(lines):
+        nonlocal n_lines
+        for line in lines:
+            n_lines += 1
+            yield line
+
+    def unique(lines):
+        nonlocal n_unique
+        for line in lines:
+            n_unique += 1
+            yield line
+
+    while True:
+        n_lines, n_unique, n_kept = 0, 0, 0
+        counts = dict()
+        try:
+            with open(file, "r") as f, open(tmp_file, "w") as o:
+                lines = unique(filter_lines(counted(f), key=key, grouped=grouped))
+                if overlap_rule:
+                    lines = resolve_overlapping_lines(lines, overlap_rule, batch_size=100000 if grouped else None,
+                                                      counts=counts)
+                for line in lines:
+                    n_kept += 1
+                    o.write(line)
+            break
+        except UngroupedError as e:
+            print("{}, filtering again with the keys of all TRs in memory".format(e))
+            grouped = False
+        except BaseException:
+            # no incomplete output is left behind, also on I/O errors, malformed lines or an interrupt
+            if output_file and os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+    if output_file:
+        os.replace(tmp_file, output_file)
+
+    elapsed = time.perf_counter() - start
+    # the header line is not a TR
+    n_lines, n_unique, n_kept = n_lines - 1, n_unique - 1, n_kept - 1
+    print("Filter found {} cases where TRs in the same protein had the same {}.".format(
+        n_lines - n_unique, " and ".join(KEYS[key])))
+    if overlap_rule:
+        print("Found {} pairs of overlapping TRs, removed {} TRs (rule: {})".format(
+            counts["overlapping_pairs"], counts["overlapping_removed"], overlap_rule))
+    print("Filtered {} TRs in {:.1f} s ({:.0f} TRs/s, {:.1f} MB/s)".format(
+        n_lines, elapsed, n_lines / elapsed if elapsed else 0,
+        os.path.getsize(file) / 1e6 / elapsed if elapsed else 0))
+    return n_lines, n_lines - n_kept
 
 
 def parser():
@@ -52,7 +231,24 @@ def parser():
         "--file", "-f", type=str, required=True, help="File with merged TRAL results to be filtered."
     )
     parser.add_argument(
-        "--overwrite", "-o", type=bool, default=False, help="Overwrite existing file with filtered file?"
+        "--overwrite", "-o", action="store_true", help="Overwrite existing file with filtered file?"
+    )
+    parser.add_argument(
+        "--output", type=str, default=None, help="Write the filtered file to this path instead of overwriting"
+    )
+    parser.add_argument(
+        "--key", "-k", type=str, choices=list(KEYS), default="begin",
+        help="Columns (besides ID) that identify a TR: begin (default), begin-end or msa"
+    )
+    parser.add_argument(
+        "--ungrouped", action="store_true",
+        help="The TRs of a protein are not listed together in the file (keeps all keys in memory). Without this flag, "
+             "such files are detected and filtered a second time (default: False)"
+    )
+    parser.add_argument(
+        "--resolve-overlaps", type=str, choices=OVERLAP_RULES, default=None,
+        help="Also remove TRs that overlap another TR of the same protein, keeping the TR with the lowest pvalue, "
+             "lowest divergence or longest region (default: overlapping TRs are kept)"
     )
 
     return parser.parse_args()
@@ -60,13 +256,13 @@ def parser():
 
 def main():
     args = parser()
-    filtered_lines = tral_file_filter(args.file)
     # overwrite input file?
-    if args.overwrite:
+    output_file = args.output
+    if args.overwrite and not output_file:
         print("Overwriting existing file with filtered file")
-        with open(args.file, "w") as o:
-            for line in filtered_lines:
-                o.write(line)
+        output_file = args.file
+    tral_file_filter(args.file, output_file, key=args.key, grouped=not args.ungrouped,
+                     overlap_rule=args.resolve_overlaps)
 
 
 if __name__ == "__main__":
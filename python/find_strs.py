@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Detect short tandem repeats (homo-, di- and tri-peptide repeats) in all proteins of a fasta file without TRAL, using
+the vectorized scanner in src/str_scanner.py. Repeats are written to one table in the format of merged run_tral.py
+output (ID column followed by the columns of run_tral.write_file()), so it can be used as a fast first pass or instead
+of run_tral.py for STR-only studies. Concordance with TRAL output can be checked with compare_tral_results.py, e.g.:
+    compare_tral_results.py -r str_sp_final.tsv -q strs.tsv --max-l-effective 3
+
+IMPORTANT: fasta files are assumed to have UniProt/ SwissProt headers (the accession is used as ID)
+
+Author: Max Verbiest
+Contact: max.verbiest@zhaw.ch
+"""
+
+import argparse
+import itertools
+import time
+
+from Bio import SeqIO
+
+from src.result_writer import StreamingResultWriter
+from src.str_scanner import STRScanner
+
+
+def find_strs(sequences_file, output_file, scanner, batch_size=10000):
+    """Detect STRs in all proteins of a fasta file
+
+    Parameters
+    sequences_file (str):   path to .fasta file containing protein sequences
+    output_file (str):      table to write the STRs to
+    scanner (src.str_scanner.STRScanner):
+                            scanner with the STR settings
+    batch_size (int):       number of proteins that are scanned at once
+    """
+
+    start = time.perf_counter()
+    proteins = ((record.id.split("|")[1], str(record.seq)) for record in SeqIO.parse(sequences_file, "fasta"))
+    writer = StreamingResultWriter(output_file, batch_size=batch_size)
+    n_proteins, n_residues, n_repeats = 0, 0, 0
+    while True:
+        batch = list(itertools.islice(proteins, batch_size))
+        if not batch:
+            break
+        n_proteins += len(batch)
+        n_residues += sum(len(sequence) for _, sequence in batch)
+        for seq_name, rows in scanner.scan(batch).items():
+            writer.add(seq_name, rows)
+            n_repeats += len(rows)
+    writer.close()
+
+    elapsed = time.perf_counter() - start
+    print("{} STR(s) found in {} protein(s) ({} residues) in {:.1f} s ({:.0f} residues/s)".format(
+        n_repeats, n_proteins, n_residues, elapsed, n_residues / elapsed if elapsed else 0))
+
+
+def parser():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--fasta", "-f", type=str, required=True, help="Path to file containing protein sequence(s)"
+    )
+    parser.add_argument(
+        "--output", "-o", type=str, required=True, help="Output table with one STR per line"
+    )
+    parser.add_argument(
+        "--max-period", type=int, default=3, help="Longest repeat unit (default: 3)"
+    )
+    parser.add_argument(
+        "--min-length", type=int, default=6, help="Minimal length of a repeat region (default: 6)"
+    )
+    parser.add_argument(
+        "--n-threshold", type=float, default=2.5, help="Minimal number of repeat units (default: 2.5)"
+    )
+    parser.add_argument(
+        "--max-divergence", type=float, default=0.14,
+        help="Maximal fraction of residues that differ from the consensus unit (default: 0.14)"
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=10000, help="Number of proteins that are scanned at once (default: 10000)"
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parser()
+    scanner = STRScanner(max_period=args.max_period, min_length=args.min_length, n_threshold=args.n_threshold,
+                         max_divergence=args.max_divergence)
+    print(scanner)
+    find_strs(args.fasta, args.output, scanner, batch_size=args.batch_size)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Count all k-mers (k = 1-4) in the proteins of a fasta file per region class, e.g.:
+    kmer_profile.py -f proteins.fasta -k 1 2 3 -o kmers.npz \
+        -r str=str_sp_final.tsv idr=disorder.tsv signal_peptide=signal_peptides_all_proteins_with_ptm.tsv
+Every residue is assigned to the first region class (in the order of -r) with a region that covers it, or to 'other'.
+Counts are written as one matrix (classes x k-mers) per k to a compressed .npz file, see src/kmer_profiler.py. With
+--tsv, the counts are also written as a table with one line per k-mer.
+
+IMPORTANT: fasta files are assumed to have UniProt/ SwissProt headers (the accession is used as ID)
+
+Author: Max Verbiest
+Contact: max.verbiest@zhaw.ch
+"""
+
+import argparse
+import time
+
+from Bio import SeqIO
+
+from src.kmer_profiler import KmerProfiler, kmer_names, read_intervals
+
+
+def parse_region_table(specification):
+    """Parse a region class specification 'name=path'"""
+
+    name, _, path = specification.partition("=")
+    if not name or not path:
+        raise argparse.ArgumentTypeError("Invalid region table '{}', expected <class name>=<path>".format(
+            specification))
+    return name, path
+
+
+def write_table(profiler, output_file):
+    """Write the counts as table: k, kmer and one column with counts per region class"""
+
+    with open(output_file, "w") as o:
+        o.write("k\tkmer\t{}\n".format("\t".join(profiler.classes)))
+        for k, counts in profiler.counts.items():
+            for kmer, row in zip(kmer_names(k), counts.T.tolist()):
+                o.write("{}\t{}\t{}\n".format(k, kmer, "\t".join(str(count) for count in row)))
+
+
+def parser():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--fasta", "-f", type=str, required=True, help="Path to file containing protein sequence(s)"
+    )
+    parser.add_argument(
+        "--output", "-o", type=str, required=True, help="Output .npz file with the count matrices"
+    )
+    parser.add_argument(
+        "--regions", "-r", type=parse_region_table, nargs="*", default=[],
+        help="Region classes as <class name>=<interval table>, in order of priority. Interval tables have ID, begin "
+             "and end columns (merged TRAL output, disorder annotations or signal peptides)"
+    )
+    parser.add_argument(
+        "-k", type=int, nargs="+", default=[1, 2], choices=range(1, 5), help="k-mer lengths (default: 1 2)"
+    )
+    parser.add_argument(
+        "--workers", "-w", type=int, default=1, help="Number of worker processes (default: 1)"
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=10000, help="Number of proteins per batch (default: 10000)"
+    )
+    parser.add_argument(
+        "--tsv", type=str, default=None, help="Also write the counts to this table"
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    args = parser()
+    start = time.perf_counter()
+    regions = {name: read_intervals(path) for name, path in args.regions}
+    profiler = KmerProfiler(args.k, regions)
+    proteins = ((record.id.split("|")[1], str(record.seq)) for record in SeqIO.parse(args.fasta, "fasta"))
+    profiler.profile(proteins, batch_size=args.batch_size, workers=args.workers)
+    profiler.write(args.output)
+    if args.tsv:
+        write_table(profiler, args.tsv)
+    elapsed = time.perf_counter() - start
+    print("Counted {}-mers in {} proteins ({} residues) in {:.1f} s ({:.0f} residues/s)".format(
+        ",".join(str(k) for k in profiler.k_values), profiler.n_proteins, profiler.n_residues, elapsed,
+        profiler.n_residues / elapsed if elapsed else 0))
+
+
+if __name__ == "__main__":
+    main()
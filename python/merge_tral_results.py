@@ -1,6 +1,12 @@
 #!/usr/bin/env python3
 """
 Concatenate all TRAL output files (generated by run_tral.py) from a directory into one file.
+For sharded runs (run_tral.py --shard i/N), all shard directories are merged, after checking that all N shards have
+finished.
+
+Merging is incremental: a manifest next to merged.tsv records which result files were merged (size and modification
+time), so after a partial rerun only new and changed files are read (see src/result_merger.py). Use --full to rebuild
+merged.tsv from all result files.
 
 Author: Max Verbiest
 Contact: max.verbiest@zhaw.ch
@@ -8,36 +14,32 @@ Contact: max.verbiest@zhaw.ch
 
 import argparse
 import os
+import sys
+
+from src.result_merger import merge_result_files
+from src.sharding import shard_dir, missing_shards
 
 
-def concatenate_files(file_list, output_file):
-    """Concatenates all files from file_list into one big file: output_file
+def concatenate_merged_files(file_list, output_file):
+    """Concatenates already merged files (e.g. from the shards of a run_tral.py --single-file run) into one file,
+    keeping only the header of the first file
 
     file_list (list[str]):
-                list of file handles of run_tral.py output files to be concatenated
+                list of merged files (with ID column) to be concatenated
     output_file (str):
                 file where concatenated information will be deposited
     """
 
-    # get header
-    with open(file_list[0], "r") as f:
-        header_line = f.readline().strip()
-        if not header_line.startswith("begin"):
-            raise ValueError("File layout different than expected!")
-        header_line = "ID\t{}\n".format(header_line)
-
     with open(output_file, "w") as o:
-        o.write(header_line)
-        for file_name in file_list:
-            handle = file_name.split("/")[-1]
-            prot_id = handle.split(".")[0]
+        for i, file_name in enumerate(file_list):
             with open(file_name, "r") as f:
+                header_line = f.readline()
+                if not header_line.startswith("ID\tbegin"):
+                    raise ValueError("File layout different than expected!")
+                if i == 0:
+                    o.write(header_line)
                 for line in f:
-                    if not line.startswith("begin"):
-                        if line.endswith("\n"):
-                            o.write("{}\t{}".format(prot_id, line))
-                        else:
-                            o.write("{}\t{}\n".format(prot_id, line))
+                    o.write(line)
 
 
 def parser():
@@ -46,17 +48,45 @@ def parser():
     parser.add_argument(
         "--dir", "-d", type=str, required=True, help="Directory with tral output files."
     )
+    parser.add_argument(
+        "--shards", "-s", type=int, default=None,
+        help="Number of shards the run was split in (run_tral.py --shard i/N). All shard directories in --dir are "
+             "merged, merging is refused when not all shards have finished"
+    )
+    parser.add_argument(
+        "--single-file", action="store_true",
+        help="(only relevant with --shards) Shards were run with --single-file: concatenate their merged.tsv files"
+    )
+    parser.add_argument(
+        "--full", action="store_true",
+        help="Rebuild merged.tsv from all result files instead of only merging new and changed files (default: False)"
+    )
 
     return parser.parse_args()
 
 
 def main():
     args = parser()
-    # get handles of all .tsv files from a directory
-    filenames = [os.path.join(args.dir, file) for file in os.listdir(args.dir) if file.endswith(".tsv")]
-    # make output file name, will be deposited in the same dir as input files
+    # get all result directories
+    if args.shards:
+        missing = missing_shards(args.dir, args.shards)
+        if missing:
+            sys.exit("ERROR: {} out of {} shards have not finished: {}".format(
+                len(missing), args.shards, ", ".join("{}/{}".format(i, args.shards) for i in missing)))
+        if args.single_file:
+            concatenate_merged_files(
+                [os.path.join(shard_dir(args.dir, (index, args.shards)), "merged.tsv")
+                 for index in range(1, args.shards + 1)],
+                "{}/merged.tsv".format(args.dir))
+            return
+        directories = [shard_dir(args.dir, (index, args.shards)) for index in range(1, args.shards + 1)]
+    else:
+        directories = [args.dir]
+    # output file will be deposited in the same dir as input files
     output_file = "{}/merged.tsv".format(args.dir)
-    concatenate_files(filenames, output_file)
+    counts = merge_result_files(directories, output_file, incremental=not args.full)
+    print("Merged result files: {added} added, {replaced} replaced, {removed} removed, {unchanged} unchanged".format(
+        **counts))
 
 
 if __name__ == "__main__":
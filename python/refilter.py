@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Apply other filter thresholds to the raw repeats of a run (run_tral.py --raw-store) without running TRAL again.
+De novo repeats are filtered on p-value, divergence, n_effective and (optionally) l_effective, clustered for common
+ancestry (as in run_tral.py), and replaced by their cpHMM refined version when that overlaps the de novo repeat and
+passes the same thresholds. The result is written in the format of merged run_tral.py output.
+
+With --sweep, the number of repeats is reported for every combination of thresholds instead, e.g.:
+    refilter.py -r raw_repeats.tsv.gz --sweep pvalue=0.01,0.05 divergence=0.05,0.1 n_effective=2.5,3
+
+NOTE: refined repeats are only stored for de novo repeats that passed the thresholds of the original run, with looser
+thresholds the other de novo repeats are kept unrefined.
+
+Author: Max Verbiest
+Contact: max.verbiest@zhaw.ch
+"""
+
+import argparse
+import itertools
+import sys
+import time
+
+import numpy as np
+
+from src.raw_store import load_columns
+from src.result_writer import HEADER
+
+THRESHOLDS = ["pvalue", "divergence", "n_effective", "l_effective"]
+
+
+def threshold_mask(columns, pvalue=0.05, divergence=0.1, n_effective=2.5, l_effective=None):
+    """Which raw repeats pass the thresholds, with the semantics of the TRAL filters used in run_tral.py (p-value and
+    divergence at most, n_effective at least the threshold, l_effective at most the threshold if given)
+    """
+
+    mask = (columns["pvalue"] <= pvalue) & (columns["divergence"] <= divergence)
+    mask &= columns["n_effective"] >= n_effective
+    if l_effective is not None:
+        mask &= columns["l_effective"] <= l_effective
+    return mask
+
+
+def cluster(columns, rows, score="phylo_gap01"):
+    """Cluster de novo repeats per protein for common ancestry, keeping the repeats with the lowest p-value and
+    divergence (TRAL 'none_overlapping' filter)
+
+    Parameters
+    columns (dict):     raw store (see src.raw_store.load_columns())
+    rows (np.ndarray):  indices of the de novo repeats to cluster
+    score (str):        model of the stored p-values and divergences
+
+    Returns
+    kept (list[int]):   indices of the repeats that remain
+    """
+
+    from tral.repeat import repeat
+    from tral.repeat_list import repeat_list
+
+    kept = []
+    for _, group in itertools.groupby(rows.tolist(), key=lambda i: columns["ID"][i]):
+        group = list(group)
+        if len(group) == 1:
+            kept += group
+            continue
+        repeats = []
+        for i in group:
+            TR = repeat.Repeat(msa=str(columns["msa_original"][i]).split(","), begin=int(columns["begin"][i]))
+            # statistics are taken from the store instead of being calculated again
+            TR.d_pvalue = {score: float(columns["pvalue"][i])}
+            TR.d_divergence = {score: float(columns["divergence"][i])}
+            TR.raw_row = i
+            repeats.append(TR)
+        clustered = repeat_list.RepeatList(repeats).filter(
+            "none_overlapping", ["common_ancestry"], [("pvalue", score), ("divergence", score)])
+        kept += sorted(TR.raw_row for TR in clustered.repeats)
+    return kept
+
+
+def refilter(columns, thresholds, clustering=True):
+    """Select the repeats that would remain with other thresholds
+
+    Parameters
+    columns (dict):     raw store (see src.raw_store.load_columns())
+    thresholds (dict):  keyword arguments for threshold_mask()
+    clustering (bool):  If False, de novo repeats are not clustered for common ancestry
+
+    Returns
+    selected (list[int]):
+                        indices of the remaining repeats (de novo or refined)
+    counts (dict):      number of de novo repeats that pass the thresholds, remain after clustering and are refined
+    """
+
+    mask = threshold_mask(columns, **thresholds)
+    denovo = columns["stage"] == "denovo"
+    passing = np.flatnonzero(denovo & mask)
+    kept = cluster(columns, passing) if clustering else passing.tolist()
+
+    refined_rows = np.flatnonzero(~denovo)
+    refined = dict(zip(zip(columns["ID"][refined_rows].tolist(), columns["index"][refined_rows].tolist()),
+                       refined_rows.tolist()))
+    selected = []
+    n_refined = 0
+    for i in kept:
+        refined_row = refined.get((columns["ID"][i], columns["index"][i]))
+        if refined_row is not None and columns["overlaps_denovo"][refined_row] and mask[refined_row]:
+            selected.append(refined_row)
+            n_refined += 1
+        else:
+            selected.append(i)
+    return selected, {"passing": len(passing), "clustered": len(kept), "refined": n_refined}
+
+
+def write_repeats(columns, selected, output_file):
+    """Write repeats in the format of merged run_tral.py output"""
+
+    with open(output_file, "w") as o:
+        o.write("ID\t{}\n".format("\t".join(HEADER)))
+        for i in selected:
+            o.write("\t".join([columns["ID"][i]] + [
+                str(columns["begin"][i]),
+                columns["msa_original"][i],
+                str(columns["l_effective"][i]),
+                str(float(columns["n_effective"][i])),
+                str(columns["repeat_region_length"][i]),
+                str(float(columns["divergence"][i])),
+                str(float(columns["pvalue"][i])),
+            ]) + "\n")
+
+
+def parse_sweep(specifications):
+    """Parse threshold lists, e.g. ['pvalue=0.01,0.05', 'n_effective=2.5,3'] -> {'pvalue': [0.01, 0.05], ...}"""
+
+    sweep = dict()
+    for specification in specifications:
+        name, _, values = specification.partition("=")
+        if name not in THRESHOLDS or not values:
+            raise argparse.ArgumentTypeError(
+                "Invalid sweep '{}', expected <threshold>=<value>,<value>,... with threshold one of {}".format(
+                    specification, ", ".join(THRESHOLDS)))
+        sweep[name] = [float(value) for value in values.split(",")]
+    return sweep
+
+
+def parser():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--raw", "-r", type=str, required=True, help="Raw repeat store of a run ({outdir}/raw_repeats.tsv.gz)"
+    )
+    parser.add_argument(
+        "--output", "-o", type=str, default=None, help="Output file for the repeats that remain"
+    )
+    parser.add_argument(
+        "--pvalue", type=float, default=0.05, help="Maximal p-value (default: 0.05)"
+    )
+    parser.add_argument(
+        "--divergence", type=float, default=0.1, help="Maximal divergence (default: 0.1)"
+    )
+    parser.add_argument(
+        "--n-effective", type=float, default=2.5, help="Minimal number of repeat units (default: 2.5)"
+    )
+    parser.add_argument(
+        "--l-effective", type=float, default=None, help="Maximal repeat unit length (default: no limit)"
+    )
+    parser.add_argument(
+        "--no-clustering", action="store_true",
+        help="Do not cluster de novo repeats for common ancestry (faster, does not need TRAL) (default: False)"
+    )
+    parser.add_argument(
+        "--sweep", type=str, nargs="+", default=None,
+        help="Report the number of repeats for all combinations of thresholds, e.g. 'pvalue=0.01,0.05' "
+             "'n_effective=2.5,3'. Thresholds that are not swept keep their value"
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    args = parser()
+    start = time.perf_counter()
+    columns = load_columns(args.raw)
+    print("Loaded {} raw repeats in {:.1f} s".format(len(columns["ID"]), time.perf_counter() - start),
+          file=sys.stderr)
+    thresholds = {"pvalue": args.pvalue, "divergence": args.divergence, "n_effective": args.n_effective,
+                  "l_effective": args.l_effective}
+
+    if args.sweep:
+        sweep = parse_sweep(args.sweep)
+        names = list(sweep)
+        print("\t".join(names + ["passing", "clustered", "refined"]))
+        for values in itertools.product(*(sweep[name] for name in names)):
+            _, counts = refilter(columns, dict(thresholds, **dict(zip(names, values))),
+                                 clustering=not args.no_clustering)
+            print("\t".join([str(value) for value in values] +
+                            [str(counts[name]) for name in ["passing", "clustered", "refined"]]))
+        return
+
+    selected, counts = refilter(columns, thresholds, clustering=not args.no_clustering)
+    print("{passing} de novo repeats pass the thresholds, {clustered} remain after clustering, {refined} of which "
+          "are refined".format(**counts))
+    if args.output:
+        write_repeats(columns, selected, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,8 +2,11 @@
 """
 Script to detect Tandem Repeats in a specified fasta file containing protein sequences using TRAL.
 Output will be generated in a specified output directory (which will be made if it does not exist).
-Output will consist of one .tsv file and one .pkl file for each protein in which a TR is detected. These files can be
+Output will consist of one .tsv file for each protein in which a TR is detected. These files can be
 merged into one file containing all Tandem Repeats by running the separate 'merge_tral_results.py' script.
+Alternatively, with '--single-file' all Tandem Repeats are appended to one merged file directly.
+Finished proteins are recorded in a checkpoint manifest in the output directory, an interrupted run can be continued
+with the '--resume' option.
 
 NOTE: this script is heavily based on 'TR_in_multiple_Protein.py' (https://github.com/matteodelucchi/CRC_TRs)
 and 'tandem_repeat_annotation_scripts.py'
@@ -19,6 +22,11 @@ import pickle
 import argparse
 import logging
 import logging.config
+import traceback
+import itertools
+import json
+import collections
+import importlib.metadata
 
 from Bio import SeqIO
 
@@ -28,8 +36,31 @@ from tral.sequence import sequence
 from tral.repeat_list import repeat_list
 from tral.hmm import hmm
 
-
-def find_protein_repeats(sequences_file, result_dir):
+from src.checkpoint import Checkpoint
+from src.sharding import parse_shard, select_shard, shard_dir, mark_shard_done, clear_shard_done
+from src.result_writer import HEADER, repeat_rows, StreamingResultWriter
+from src.kv_cache import SQLiteCache, digest
+from src.prescreen import Prescreen
+from src.hmm_cache import HMMCache
+from src.instrumentation import StageTimer, RunProfiler
+from src.scheduler import (BudgetExceeded, CostModel, Quarantine, time_budget, set_memory_budget, memory_budget,
+                           detector_failures, run_in_pool)
+from src.windowing import SequenceWindows, detect_denovo
+from src.raw_store import RawRepeatStore, raw_rows
+
+# Thresholds used by filter_repeatlist(), these are also part of the result cache key
+PVALUE_THRESHOLD = 0.05
+DIVERGENCE_THRESHOLD = 0.1
+N_THRESHOLD = 2.5
+
+# cpHMM cache of this process, shared by all proteins it handles (see get_hmm_cache())
+_HMM_CACHE = None
+
+
+def find_protein_repeats(sequences_file, result_dir, workers=1, resume=False, shard=None, single_file=False,
+                         batch_size=100, cache_file=None, cache_size=None, prescreen=None, hmm_cache=False,
+                         hmm_cache_file=None, profile=None, timeout=None, memory_limit=None,
+                         cost_model=None, retry_quarantined=False, windows=None, deduplicate=True, raw_store=False):
     """Detect TRs in all protein entries in a specified .fasta file
     IMPORTANT: fasta files are assumed to have UniProt/ SwissProt headers, e.g.:
         >sp|Q8N2I9|STK40_HUMAN Serine/threonine-protein kinase 40 OS=Homo sapiens OX=9606 GN=STK40 PE=1 SV=2
@@ -38,8 +69,59 @@ def find_protein_repeats(sequences_file, result_dir):
     sequences_file (str):   path to .fasta file containing sequences for TR detection
     result_dir (str):       path to directory where results will be deposited (one file will be generated
                             per protein entry in the input file)
+    workers (int):          number of worker processes. With more than one worker, every protein is a separate work
+                            unit in a process pool (default: 1, run serially in this process)
+    resume (bool):          If True, skip proteins recorded in the checkpoint manifest of result_dir by a previous
+                            (interrupted) run. Result files of proteins that were not finished are removed and redone
+    shard (tuple(int, int)):
+                            (i, N): only process shard i out of N (see src.sharding), results are written to
+                            {result_dir}/shard_i_of_N. If None (default), all proteins are processed
+    single_file (bool):     If True, the repeats of all proteins are appended to {result_dir}/merged.tsv (with ID
+                            column) instead of writing one file per protein, no separate merge step is needed
+    batch_size (int):       (only relevant with single_file) number of proteins buffered per write to disk
+    cache_file (str):       path to a persistent result cache (SQLite database, created if it does not exist). Results
+                            are looked up by hash of the sequence and TRAL settings (see cache_settings()), only
+                            sequences that are not in the cache are run through TRAL. If None (default), no cache is
+                            used
+    cache_size (int):       maximum size of the result cache in bytes, least recently used results are evicted when it
+                            grows larger. If None (default), the cache size is not limited
+    prescreen (src.prescreen.Prescreen):
+                            periodicity screen that is run before TRAL, proteins that do not pass skip TRAL. If None
+                            (default), all proteins are run through TRAL
+    hmm_cache (bool):       If True, cpHMMs are cached by repeat alignment, so identical alignments only need one
+                            hmmbuild call per process (default: False)
+    hmm_cache_file (str):   SQLite file for an on-disk cpHMM cache that is shared between worker processes and runs.
+                            Implies hmm_cache
+    profile (str):          path prefix for timing reports: {profile}.csv with wall clock and CPU time per stage for
+                            every protein, {profile}.json with percentiles per stage and throughput of the run. If None
+                            (default), no reports are written
+    timeout (float):        wall clock budget per protein in seconds. Proteins that take longer are stopped and moved
+                            to the quarantine file ({result_dir}/quarantine.txt) together with the stage they were in.
+                            With windows, the protein is given up without waiting for its running windows. If None
+                            (default), there is no time limit
+    memory_limit (float):   memory (address space) budget per worker process in MB. Proteins for which an allocation
+                            fails are moved to the quarantine file. Without workers, the limit applies to this process.
+                            The limit is inherited by the external detectors, proteins for which a detector fails are
+                            quarantined too. If None (default), there is no memory limit
+    cost_model (src.scheduler.CostModel):
+                            model of the processing time per protein as function of its length, e.g. fitted on the
+                            profile of an earlier run. Used to balance shards and, with more than one worker, to submit
+                            the most expensive proteins first. If None (default), shards are balanced on sequence length
+                            and proteins are submitted longest first
+    retry_quarantined (bool):
+                            If True, only process the proteins in the quarantine file of a previous run (e.g. with a
+                            larger budget), proteins that succeed are removed from it. Implies resume
+    windows (src.windowing.SequenceWindows):
+                            If given, de novo detection on long proteins is done in overlapping windows that are
+                            processed in parallel (see src.windowing). Filtering, clustering and refinement are still
+                            done on the complete protein. If None (default), proteins are never split
+    deduplicate (bool):     If True (default), proteins with identical sequences are run through TRAL once, the
+                            result is written for every accession with that sequence
+    raw_store (bool):       If True, all de novo repeats and the cpHMM refined versions of all repeats that passed
+                            the filters (before clustering) are stored with their statistics in
+                            {result_dir}/raw_repeats.tsv.gz, to apply other thresholds later with refilter.py. This
+                            needs p-values for all de novo repeats and more refinement work (default: False)
     """
-    # TODO implement checking of potential results dir for proteins to skip
     logging.config.fileConfig(config_file("logging.ini"))
     log = logging.getLogger('root')
 
@@ -47,85 +129,458 @@ def find_protein_repeats(sequences_file, result_dir):
     CONFIG = CONFIG_GENERAL["repeat_list"]
     score = CONFIG["model"]
 
-    proteins = SeqIO.parse(sequences_file, "fasta")
-
-    all_denovo_repeats = 0
-    all_filtered_repeats = 0
+    resume = resume or retry_quarantined
+    records = SeqIO.parse(sequences_file, "fasta")
+    if shard:
+        # all shards of a run have to use the same cost model, otherwise shards overlap
+        records = select_shard(list(records), shard, key=lambda record: record.id.split("|")[1],
+                               cost=lambda record: cost_model.predict(len(record.seq)) if cost_model else len(record))
+        result_dir = shard_dir(result_dir, shard)
+        print("Shard {}/{}: {} protein(s), {} residues".format(
+            shard[0], shard[1], len(records), sum(len(record.seq) for record in records)))
+
+    # Create output directory if not already exists.
+    try:
+        if not os.path.isdir(result_dir):
+            os.makedirs(result_dir)
+    except:
+        raise Exception(
+            "Could not create path to result directory: {}".format(
+                os.path.dirname(result_dir)))
+
+    if shard:
+        clear_shard_done(result_dir)
+    checkpoint = Checkpoint(result_dir, resume=resume)
+    writer = None
+    if single_file:
+        writer = StreamingResultWriter(
+            os.path.join(result_dir, "merged.tsv"), checkpoint=checkpoint, resume=resume, batch_size=batch_size)
+        if resume:
+            print("Resuming run: {} protein(s) already finished".format(len(checkpoint)))
+    elif resume:
+        redo = checkpoint.remove_unfinished()
+        print("Resuming run: {} protein(s) already finished, {} unfinished result file(s) will be redone".format(
+            len(checkpoint), len(redo)))
+
+    raw = RawRepeatStore(os.path.join(result_dir, "raw_repeats.tsv.gz"), resume=resume) if raw_store else None
+
+    # proteins that exceeded their budget in a previous run are skipped, unless only these are retried
+    quarantine = Quarantine(result_dir, resume=resume)
+    if retry_quarantined:
+        print("Retrying {} quarantined protein(s)".format(len(quarantine)))
+    elif len(quarantine):
+        print("Skipping {} quarantined protein(s), use --retry-quarantined to process them".format(len(quarantine)))
+    proteins = ((record.id.split("|")[1], str(record.seq)) for record in records)
+    proteins = ((seq_name, protein_sequence) for seq_name, protein_sequence in proteins
+                if not checkpoint.is_done(seq_name) and (seq_name in quarantine) == retry_quarantined)
+    duplicates = dict()
+    if deduplicate:
+        proteins, duplicates = collapse_duplicates(proteins)
+        if duplicates:
+            print("{} protein(s) have the same sequence as another protein and are only run once".format(
+                sum(len(accessions) for accessions in duplicates.values())))
+
+    cache = None
+    cache_keys = dict()
+    cached_results = []
+    if cache_file:
+        # only sequences that are not in the cache have to be run through TRAL
+        cache = SQLiteCache(cache_file, max_bytes=cache_size)
+        settings = cache_settings(CONFIG_GENERAL, windows, raw_store)
+        misses = []
+        for seq_name, protein_sequence in proteins:
+            cache_keys[seq_name] = digest(protein_sequence, settings)
+            cached = cache.get(cache_keys[seq_name])
+            if cached is None:
+                misses.append((seq_name, protein_sequence))
+                continue
+            cached_results.append(dict(json.loads(cached), id=seq_name, length=len(protein_sequence), error=None,
+                                       cached=True))
+        proteins = misses
+
+    options = {"prescreen": prescreen, "hmm_cache": hmm_cache or bool(hmm_cache_file),
+               "hmm_cache_file": hmm_cache_file, "timeout": timeout,
+               "windows": windows, "raw_store": raw_store}
+    if workers > 1:
+        # longest first: a giant protein that starts last would keep one worker busy after all others are done
+        cost_model = cost_model or CostModel()
+        proteins = cost_model.order(proteins)
+        print("Scheduling {} protein(s) over {} workers, most expensive first: predicted makespan >= {:.0f} s "
+              "({})".format(len(proteins), workers, cost_model.makespan(proteins, workers), cost_model))
+        results = detect_in_pool(proteins, workers, options, memory_limit)
+    else:
+        set_memory_budget(memory_limit)
+        results = (detect_protein_repeats_safely(seq_name, protein_sequence, options)
+                   for seq_name, protein_sequence in proteins)
+    results = itertools.chain(cached_results, results)
+    if duplicates:
+        results = expand_duplicates(results, duplicates)
+
+    # repeats of proteins finished in a previous run are included in the totals
+    all_denovo_repeats, all_filtered_repeats = checkpoint.totals()
+    failed = []
+    collapsed = 0
+    quarantined = []
+    released = []
+    screened_out = 0
+    pvalues_saved = 0
+    hmm_cache_stats = collections.Counter()
+    profiler = RunProfiler(profile) if profile else None
 
     counter = 1
-    for record in proteins:
-        print("Started work on protein number {}".format(counter))
+    for result in results:
+        print("Finished work on protein number {}".format(counter))
         counter += 1
-        seq_name = record.id.split("|")[1]
+        seq_name = result["id"]
+
+        if result.get("quarantine"):
+            print("WARNING: protein {} ({} residues) exceeded its {} budget in stage '{}', moved to quarantine".format(
+                seq_name, result["length"], result["quarantine"]["reason"], result["quarantine"]["stage"]))
+            if seq_name not in quarantine:
+                quarantine.add(seq_name, result["length"], result["quarantine"]["stage"],
+                               result["quarantine"]["reason"])
+            quarantined.append(seq_name)
+            continue
+        if result["error"]:
+            print("WARNING: TR detection failed for protein {}:\n{}".format(seq_name, result["error"]))
+            failed.append(seq_name)
+            continue
+        duplicate = result.get("duplicate_of") is not None
+        if duplicate:
+            collapsed += 1
+        else:
+            hmm_cache_stats.update(result.get("hmm_cache", dict()))
+            pvalues_saved += result.get("pvalues_saved", 0)
+        if result.get("screened"):
+            screened_out += 1
+        # proteins that skipped TRAL are not cached, the outcome of the screen depends on its settings
+        elif cache is not None and not result.get("cached") and not duplicate:
+            cache.put(cache_keys[seq_name], json.dumps(
+                {"denovo": result["denovo"], "repeats": result["repeats"], "raw": result.get("raw")}))
+
+        if seq_name in quarantine:
+            released.append(seq_name)
 
-        # name is protein identifier
-        seq = sequence.Sequence(seq=str(record.seq), name=seq_name)
+        # add number of denovo found repeats
+        all_denovo_repeats += result["denovo"]
+        write_timer = StageTimer()
+        with write_timer.stage("write"):
+            if raw is not None and result.get("raw"):
+                raw.add(seq_name, result["raw"])
+            store_result(result, result_dir, checkpoint, writer)
+        if profiler is not None and not duplicate:
+            timings = result.get("timings", {"wall": dict(), "cpu": dict()})
+            timings["wall"].update(write_timer.wall)
+            timings["cpu"].update(write_timer.cpu)
+            profiler.add(seq_name, result["length"], result["denovo"], len(result["repeats"]), timings)
+        if not result["repeats"]:
+            continue
 
-        denovo_list = seq.detect(denovo=True, repeat={"calc_pvalue": True})
+        all_filtered_repeats += len(result["repeats"])
+        print("\n***", seq_name, "***")
+        print("denovo repeats:", result["denovo"])
+        print("repeats after filtering and clustering:", len(result["repeats"]))
+
+        for row in result["repeats"]:
+            print("\t".join(row))
+
+    if writer:
+        writer.close()
+    checkpoint.close()
+    if released:
+        quarantine.release(released)
+    if profiler is not None:
+        profiler.write()
+        print("\nTiming report written to {0}.json (per protein: {0}.csv)".format(profile))
+    if shard:
+        mark_shard_done(result_dir, proteins=len(checkpoint), failed=len(failed), quarantined=len(quarantine))
+    print("\n{} p-value calculation(s) saved by filtering on n_effective first".format(pvalues_saved))
+    if prescreen:
+        print("\n{} protein(s) did not pass the pre-screen and skipped TRAL".format(screened_out))
+    if duplicates:
+        print("\n{} duplicate sequence(s) collapsed onto {} unique sequence(s), results were written for {} "
+              "duplicate accession(s)".format(sum(len(accessions) for accessions in duplicates.values()),
+                                              len(duplicates), collapsed))
+    if options["hmm_cache"]:
+        print("\ncpHMM cache: {} memory hits, {} disk hits, {} built with hmmbuild (hit rate {:.1%})".format(
+            hmm_cache_stats["memory_hits"], hmm_cache_stats["disk_hits"], hmm_cache_stats["misses"],
+            (hmm_cache_stats["memory_hits"] + hmm_cache_stats["disk_hits"]) / max(sum(hmm_cache_stats.values()), 1)))
+    if cache is not None:
+        print("\n" + cache.report())
+        cache.close()
+    if failed:
+        print("\nTR detection failed for {} protein(s): {}".format(len(failed), ", ".join(failed)))
+    if quarantined:
+        print("\n{} protein(s) exceeded their budget and were quarantined ({}): {}".format(
+            len(quarantined), quarantine.path, ", ".join(quarantined)))
+    if released:
+        print("\n{} quarantined protein(s) finished and were released from quarantine".format(len(released)))
 
-        if not denovo_list and len(denovo_list) == 0:
-            continue
+    return print("\nThere where {} repeats found de novo.".format(all_denovo_repeats),
+                 "After filtering and clustering there where only {} repeats left.\n".format(
+                     all_filtered_repeats))
 
-        for TR in denovo_list.repeats:
-            TR.model = None
 
-        seq.set_repeatlist(denovo_list, "denovo_all")
+def collapse_duplicates(proteins):
+    """Keep one protein per unique sequence
 
-        # add number of denovo found repeats
-        all_denovo_repeats += len(seq.get_repeatlist("denovo_all").repeats)
+    Parameters
+    proteins (iterable):    (protein identifier, sequence) tuples
 
-        ##########################################################################
-        # Filtering TRs
-        denovo_list_filtered = filter_repeatlist(seq.get_repeatlist("denovo_all"))
+    Returns
+    unique_proteins (list): (protein identifier, sequence) tuples of the first protein with every sequence
+    duplicates (dict):      protein identifier of a kept protein -> identifiers of the proteins with the same sequence,
+                            only for sequences that occur more than once
+    """
 
-        if not denovo_list_filtered or len(denovo_list_filtered.repeats) == 0:
+    representatives = dict()
+    unique_proteins = []
+    duplicates = collections.defaultdict(list)
+    for seq_name, protein_sequence in proteins:
+        key = digest(protein_sequence)
+        if key in representatives:
+            duplicates[representatives[key]].append(seq_name)
             continue
+        representatives[key] = seq_name
+        unique_proteins.append((seq_name, protein_sequence))
+    return unique_proteins, dict(duplicates)
+
+
+def expand_duplicates(results, duplicates):
+    """Yield every result, followed by a copy for every protein with the same sequence (see collapse_duplicates()).
+    Copies get the identifier of the duplicate protein and "duplicate_of": identifier of the protein that was run
+    """
 
+    for result in results:
+        yield result
+        for seq_name in duplicates.get(result["id"], []):
+            yield dict(result, id=seq_name, duplicate_of=result["id"])
+
+
+def store_result(result, result_dir, checkpoint, writer=None):
+    """Save the repeats of a protein and mark the protein as finished in the checkpoint manifest
+
+    Parameters
+    result (dict):          see detect_protein_repeats()
+    result_dir (str):       directory for the per protein .tsv files
+    checkpoint (src.checkpoint.Checkpoint):
+                            manifest of finished proteins
+    writer (src.result_writer.StreamingResultWriter):
+                            If given, repeats are appended to a single results file instead of a per protein file
+    """
+
+    seq_name = result["id"]
+    if writer:
+        # proteins are marked as finished once their batch has been written
+        writer.add(seq_name, result["repeats"], result["denovo"])
+    elif result["repeats"]:
         ##########################################################################
-        # Clustering
-        # De novo TRs are clustered for overlap (common ancestry). Only best =
-        # lowest p-Value and lowest divergence are retained.
+        # Save Tandem Repeats TODO: implement pickle binary dump
+        # save TR-file in tsv format, only then mark protein as finished
+        write_file(result["repeats"], os.path.join(result_dir, seq_name + ".tsv"))
+        checkpoint.record(seq_name, result["denovo"], len(result["repeats"]))
+    else:
+        checkpoint.record(seq_name, result["denovo"], 0)
+
+
+def cache_settings(config, windows=None, raw_store=False):
+    """Serialize all settings that determine the outcome of detect_protein_repeats() for a given sequence: the TRAL
+    configuration (repeat_list model, de novo detectors), the filter thresholds and the clustering and refinement
+    settings. Combined with the sequence, this is hashed to obtain the result cache key, so results are recomputed
+    whenever one of these changes
+
+    Parameters
+    config (dict):  TRAL configuration (configuration.Configuration.instance().config)
+    windows (src.windowing.SequenceWindows):
+                    windowed de novo detection settings, None if proteins are not split
+    raw_store (bool):
+                    are raw repeats stored (cached results then include them)
+
+    Returns
+    settings (str): JSON representation of the settings
+    """
+
+    try:
+        tral_version = importlib.metadata.version("tral")
+    except importlib.metadata.PackageNotFoundError:
+        tral_version = None
+    return json.dumps({
+        "tral": tral_version,
+        "repeat_list": config["repeat_list"],
+        "sequence": config.get("sequence"),
+        "filter": {"pvalue": PVALUE_THRESHOLD, "divergence": DIVERGENCE_THRESHOLD, "n_effective": N_THRESHOLD},
+        "clustering": {"overlap": "common_ancestry", "criteria": ["pvalue", "divergence"], "score": "phylo_gap01"},
+        "refinement": {"model": "cpHMM", "overlap": "shared_char"},
+        "windows": {"size": windows.size, "overlap": windows.overlap, "min_length": windows.min_length,
+                    "margin": windows.margin, "max_stitch": windows.max_stitch} if windows else None,
+        "raw_store": raw_store,
+    }, sort_keys=True, default=str)
+
+
+def detect_protein_repeats(seq_name, protein_sequence, options=None, timer=None):
+    """Run the full TR detection pipeline (de novo detection, filtering, clustering and cpHMM refinement) on a
+    single protein. This is the unit of work that is distributed over worker processes in parallel runs.
+
+    Parameters
+    seq_name (str):         protein identifier (UniProt accession)
+    protein_sequence (str): amino acid sequence of the protein
+    options (dict):         pipeline options, see find_protein_repeats(). "prescreen": Prescreen or None,
+                            "hmm_cache": bool, "hmm_cache_file": str or None, "timeout": float or None,
+                            "windows": SequenceWindows or None, "raw_store": bool
+    timer (src.instrumentation.StageTimer):
+                            timer for the pipeline stages, a new one is made if None (default)
+
+    Returns
+    result (dict):          "id": protein identifier, "denovo": number of de novo detected repeats, "repeats": rows
+                            (see repeat_rows()) of the repeats that remain after filtering, clustering and
+                            refinement, "error": None, "screened": True if the protein skipped TRAL because it did
+                            not pass the pre-screen, "hmm_cache": cpHMM cache hits and misses for this protein,
+                            "pvalues_saved": number of de novo repeats removed before their p-value was calculated,
+                            "length": sequence length, "timings": wall clock and CPU time per stage, "raw": (with
+                            options["raw_store"]) rows for the raw repeat store (see src.raw_store.raw_rows())
+    """
+
+    options = options or dict()
+    timer = timer or StageTimer()
+    result = {"id": seq_name, "denovo": 0, "repeats": [], "error": None, "screened": False,
+              "length": len(protein_sequence), "timings": {"wall": timer.wall, "cpu": timer.cpu}}
+
+    if options.get("prescreen"):
+        with timer.stage("prescreen"):
+            if not options["prescreen"].passes(protein_sequence):
+                result["screened"] = True
+                return result
+
+    # name is protein identifier
+    seq = sequence.Sequence(seq=protein_sequence, name=seq_name)
+
+    # p-values are not calculated here, but after the cheap attribute filters
+    with timer.stage("denovo"):
+        denovo_list = detect_denovo(seq, options.get("windows"))
+
+    if not denovo_list and len(denovo_list) == 0:
+        return result
+
+    for TR in denovo_list.repeats:
+        TR.model = None
+
+    seq.set_repeatlist(denovo_list, "denovo_all")
+    denovo_repeats = seq.get_repeatlist("denovo_all").repeats
+    result["denovo"] = len(denovo_repeats)
+
+    ##########################################################################
+    # Filtering TRs
+    with timer.stage("filter"):
+        denovo_list_candidates = filter_attributes(seq.get_repeatlist("denovo_all"))
+    # the raw store needs p-values of all de novo repeats
+    raw_store = options.get("raw_store", False)
+    if not raw_store:
+        result["pvalues_saved"] = result["denovo"] - len(denovo_list_candidates.repeats)
+    with timer.stage("pvalue"):
+        for TR in (denovo_repeats if raw_store else denovo_list_candidates.repeats):
+            TR.pvalue("phylo_gap01")
+            TR.divergence("phylo_gap01")
+    with timer.stage("filter"):
+        denovo_list_filtered = filter_repeatlist(denovo_list_candidates)
+
+    if not denovo_list_filtered or len(denovo_list_filtered.repeats) == 0:
+        if raw_store:
+            result["raw"] = raw_rows(denovo_repeats, [])
+        return result
+    filtered_repeats = list(denovo_list_filtered.repeats)
+
+    ##########################################################################
+    # Clustering
+    # De novo TRs are clustered for overlap (common ancestry). Only best =
+    # lowest p-Value and lowest divergence are retained.
+    with timer.stage("clustering"):
         denovo_list_filtered = denovo_list_filtered.filter(
             "none_overlapping", ["common_ancestry"], [("pvalue", "phylo_gap01"), ("divergence", "phylo_gap01")])
-        seq.set_repeatlist(denovo_list_filtered, "denovo_filtered")
+    seq.set_repeatlist(denovo_list_filtered, "denovo_filtered")
+
+    ##########################################################################
+    # De novo TRs are refined with HMMs
+    hmm_cache = get_hmm_cache(options.get("hmm_cache_file")) if options.get("hmm_cache") else None
+    if hmm_cache:
+        before = hmm_cache.stats()
+    with timer.stage("refinement"):
+        refined_repeats = None
+        if raw_store:
+            # all filtered repeats are refined for the raw store, the clustered ones reuse their refinement
+            refined_all = refine_candidates(seq, filtered_repeats, hmm_cache=hmm_cache)
+            refined_by_id = {id(TR): TR_refined for TR, TR_refined in zip(filtered_repeats, refined_all)}
+            refined_repeats = [refined_by_id[id(TR)] for TR in seq.get_repeatlist("denovo_filtered").repeats]
+        final_list = refine_repeatlist(seq, "denovo_filtered", hmm_cache=hmm_cache, refined_repeats=refined_repeats)
+    seq.set_repeatlist(final_list, "denovo_final")
+    if raw_store:
+        index = {id(TR): i for i, TR in enumerate(denovo_repeats)}
+        result["raw"] = raw_rows(denovo_repeats, [
+            (index[id(TR)], TR_refined, repeat_list.two_repeats_overlap("shared_char", TR, TR_refined))
+            for TR, TR_refined in zip(filtered_repeats, refined_all) if TR_refined is not None])
+    if hmm_cache:
+        result["hmm_cache"] = {key: value - before[key] for key, value in hmm_cache.stats().items()}
+
+    result["repeats"] = repeat_rows(seq.get_repeatlist("denovo_final"))
+    return result
+
+
+def detect_protein_repeats_safely(seq_name, protein_sequence, options=None):
+    """Wrapper around detect_protein_repeats() that catches any exception raised while processing a protein, such
+    that one problematic protein does not end the whole run. The traceback is reported in result["error"].
+    Proteins that exceed their wall clock budget (options["timeout"]) or the memory budget of the process are
+    reported in result["quarantine"]: {"stage": stage the protein was in, "reason": "timeout" or "memory"}
+    External detectors inherit the memory budget and TRAL only logs their failures, so with a memory budget a protein
+    for which a detector failed is quarantined as well (reason "memory"), instead of silently missing its repeats.
+    """
 
-        ##########################################################################
-        # De novo TRs are refined with HMMs
-        final_list = refine_repeatlist(seq, "denovo_filtered")
-        seq.set_repeatlist(final_list, "denovo_final")
+    timer = StageTimer()
+    quarantine = None
+    try:
+        with detector_failures(lambda: timer.current_stage) as failures, \
+                time_budget((options or dict()).get("timeout")):
+            result = detect_protein_repeats(seq_name, protein_sequence, options, timer)
+        if not (failures and memory_budget()):
+            return result
+        quarantine = {"stage": failures[0][0], "reason": "memory"}
+    except (BudgetExceeded, MemoryError) as budget_error:
+        reason = "timeout" if isinstance(budget_error, BudgetExceeded) else "memory"
+        quarantine = {"stage": timer.current_stage, "reason": reason}
+    except Exception:
+        return {"id": seq_name, "denovo": 0, "repeats": [], "error": traceback.format_exc()}
+    return {"id": seq_name, "denovo": 0, "repeats": [], "error": None, "length": len(protein_sequence),
+            "quarantine": quarantine}
+
+
+def init_worker(memory_limit=None):
+    """Initializer for worker processes: set up TRAL logging the same way as in the main process and apply the memory
+    budget (in MB) of the worker"""
 
-        ##########################################################################
-        # Save Tandem Repeats TODO: implement pickle binary dump
-        # Create output directory if not already exists.
-        try:
-            if not os.path.isdir(result_dir):
-                os.makedirs(result_dir)
-        except:
-            raise Exception(
-                "Could not create path to result directory: {}".format(
-                    os.path.dirname(result_dir)))
-
-        # create filename
-        output_tsv_file = os.path.join(result_dir, seq_name + ".tsv")
-
-        # save TR-file in tsv format TODO: prevent file creation if no TRs remain after filter and cluster
-        write_file(seq.get_repeatlist("denovo_final"), output_tsv_file)
-
-        all_filtered_repeats += len(seq.get_repeatlist("denovo_final"))
-        print("\n***", seq_name, "***")
-        print("denovo repeats:", len(denovo_list.repeats))
-        print("repeats after filtering and clustering:",
-              len(seq.get_repeatlist("denovo_final")))
+    logging.config.fileConfig(config_file("logging.ini"))
+    set_memory_budget(memory_limit)
 
-        for i in range(len(seq.get_repeatlist("denovo_final"))):
-            print(seq.get_repeatlist("denovo_final")[i])
 
-    return print("\nThere where {} repeats found de novo.".format(all_denovo_repeats),
-                 "After filtering and clustering there where only {} repeats left.\n".format(
-                     all_filtered_repeats))
+def detect_in_pool(proteins, workers, options=None, memory_limit=None):
+    """Distribute TR detection over a pool of worker processes, one protein per work unit.
+    Results are yielded in order of completion. If a worker process dies (e.g. segfault in an external tool),
+    the proteins that were in the pool are retried in processes of their own, so only the protein that crashed is
+    reported (by accession) instead of ending the run. See src.scheduler.run_in_pool()
+
+    Parameters
+    proteins (iterable):    (protein identifier, sequence) tuples
+    workers (int):          number of worker processes
+    options (dict):         pipeline options, see detect_protein_repeats()
+    memory_limit (float):   memory budget per worker process in MB, None (default) for no limit
+
+    Yields
+    result (dict):          see detect_protein_repeats()
+    """
 
+    return run_in_pool(detect_protein_repeats_safely, proteins, workers, options, initializer=init_worker,
+                       initargs=(memory_limit,))
 
-def filter_repeatlist(tr_list, pvalue_threshold=0.05, divergence_threshold=0.1, n_threshold=2.5):
+
+def filter_repeatlist(tr_list, pvalue_threshold=PVALUE_THRESHOLD, divergence_threshold=DIVERGENCE_THRESHOLD,
+                      n_threshold=N_THRESHOLD):
     """Filter a list of tandem repeats based on specified criteria
 
     Parameters
@@ -142,8 +597,12 @@ def filter_repeatlist(tr_list, pvalue_threshold=0.05, divergence_threshold=0.1,
                             Filtered list of repeats
     """
 
+    # filtering for number of repeat units first: this is a cheap attribute filter, TRAL calculates p-values and
+    # divergences on first use, so these are only calculated for the repeats that pass
+    tr_list_filtered = filter_attributes(tr_list, n_threshold)
+
     # filtering for pvalue
-    tr_list_filtered = tr_list.filter(
+    tr_list_filtered = tr_list_filtered.filter(
         "pvalue",
         "phylo_gap01",
         pvalue_threshold)
@@ -154,17 +613,87 @@ def filter_repeatlist(tr_list, pvalue_threshold=0.05, divergence_threshold=0.1,
         "phylo_gap01",
         divergence_threshold)
 
-    # filtering for number of repeat units
-    tr_list_filtered = tr_list_filtered.filter(
+    return tr_list_filtered
+
+
+def filter_attributes(tr_list, n_threshold=N_THRESHOLD):
+    """Filter a list of tandem repeats on attributes that do not require a p-value or divergence calculation
+
+    Parameters
+    tr_list (tral.repeat_list.RepeatList):
+                            List of repeats to filter
+    n_threshold (float):    Minimum number of repeat unit repetitions for repeat to be kept
+
+    Returns
+    tr_list_filtered (RepeatList):
+                            Filtered list of repeats
+    """
+
+    return tr_list.filter(
         "attribute",
         "n_effective",
         "min",
         n_threshold)
 
-    return tr_list_filtered
 
+def get_hmm_cache(path=None):
+    """Get the cpHMM cache of this process, it is created on first use
+
+    Parameters
+    path (str):     SQLite file for the on-disk layer of the cache (only used when the cache is created)
+    """
+
+    global _HMM_CACHE
+    if _HMM_CACHE is None:
+        _HMM_CACHE = HMMCache(path)
+    return _HMM_CACHE
 
-def refine_repeatlist(seq, tag):
+
+def create_hmm(TR):
+    """Build a cpHMM for a tandem repeat with hmmbuild"""
+
+    return hmm.HMM.create(input_format='repeat', repeat=TR)
+
+
+def refine_candidates(seq, denovo_repeats, hmm_cache=None):
+    """Create a cpHMM for each tandem repeat and detect TRs in the sequence again with it. Every cpHMM gets its own
+    detection call: TRAL runs Viterbi once per cpHMM anyway, and leaves out cpHMMs without a hit without telling which
+    cpHMM a repeat came from, so a single call for all cpHMMs cannot be mapped back to the de novo TRs
+
+    seq (tral.sequence.Sequence):
+                    Sequence the repeats were found in
+    denovo_repeats (list):
+                    Repeats to refine
+    hmm_cache (src.hmm_cache.HMMCache):
+                    Cache to get cpHMMs from, if None (default) every cpHMM is built with hmmbuild
+
+    Returns
+    refined_repeats (list):
+                    refined_repeats[i] is the repeat found with the cpHMM of denovo_repeats[i], or None
+    """
+
+    if hmm_cache:
+        denovo_hmms = [hmm_cache.get_or_create(TR, create_hmm) for TR in denovo_repeats]
+    else:
+        denovo_hmms = [create_hmm(TR) for TR in denovo_repeats]
+
+    # Run HMMs on sequence, refined_repeats[i] is the repeat found with the HMM of denovo_repeats[i] (or None)
+    refined_repeats = []
+    for denovo_hmm in denovo_hmms:
+        denovo_refined_list = seq.detect(lHMM=[denovo_hmm])
+        if denovo_refined_list and denovo_refined_list.repeats:
+            refined_repeats.append(denovo_refined_list.repeats[0])
+        else:
+            refined_repeats.append(None)
+
+    for TR, TR_refined in zip(denovo_repeats, refined_repeats):
+        if TR_refined is not None:
+            TR_refined.TRD = TR.TRD
+            TR_refined.model = "cpHMM"
+    return refined_repeats
+
+
+def refine_repeatlist(seq, tag, hmm_cache=None, refined_repeats=None):
     """Take a sequence with one or more repeat lists associated to it, and a tag specifying repeat list of interest
     (one sequence can have multiple repeat lists associated to it, each identifiable with a tag). Then, create a cpHMM
     for each tandem repeat, detect TRs in sequence again and see if this improves (refines) the de novo TR
@@ -172,72 +701,64 @@ def refine_repeatlist(seq, tag):
     seq (tral.sequence.Sequence):
                     A sequence with one or more RepeatLists associated to it
     tag (str):      Which RepeatList associated to seq should be used?
+    hmm_cache (src.hmm_cache.HMMCache):
+                    Cache to get cpHMMs from, if None (default) every cpHMM is built with hmmbuild
+    refined_repeats (list):
+                    refined versions of the repeats (see refine_candidates()) if these are already known, if None
+                    (default) they are detected here
 
     Returns
     refined_list (list):
                     A list containing HMM refined tandem repeats
     """
 
+    denovo_repeats = seq.get_repeatlist(tag).repeats
+    if refined_repeats is None:
+        refined_repeats = refine_candidates(seq, denovo_repeats, hmm_cache=hmm_cache)
+
+    # Check whether new and old TR overlap. Check whether new TR is
+    # significant. If not both, put unrefined TR into final.
+    overlapping = []
+    for TR, TR_refined in zip(denovo_repeats, refined_repeats):
+        if TR_refined is None:
+            continue
+        if repeat_list.two_repeats_overlap(
+                "shared_char",
+                TR,
+                TR_refined):
+            overlapping.append(TR_refined)
+    # filters work per repeat, so all refined TRs can be checked for significance at once
+    significant = set()
+    if overlapping:
+        significant = {id(TR_refined) for TR_refined in
+                       filter_repeatlist(repeat_list.RepeatList(overlapping)).repeats}
+
     refined_list = []
-    for TR in seq.get_repeatlist(tag).repeats:
-        use_refined = False
-        denovo_hmm = hmm.HMM.create(input_format='repeat', repeat=TR)
-        # Run HMM on sequence
-        denovo_refined_list = seq.detect(lHMM=[denovo_hmm])
-        if denovo_refined_list and denovo_refined_list.repeats:
-            TR_refined = denovo_refined_list.repeats[0]
-            TR_refined.TRD = TR.TRD
-            TR_refined.model = "cpHMM"
-            # Check whether new and old TR overlap. Check whether new TR is
-            # significant. If not both, put unrefined TR into final.
-            if repeat_list.two_repeats_overlap(
-                    "shared_char",
-                    TR,
-                    TR_refined):
-                tmp_repeatlist = repeat_list.RepeatList([TR_refined])
-                tmp_repeatlist_filtered = filter_repeatlist(tmp_repeatlist)
-                if tmp_repeatlist_filtered.repeats:
-                    use_refined = True
-        if use_refined:
+    for TR, TR_refined in zip(denovo_repeats, refined_repeats):
+        if TR_refined is not None and id(TR_refined) in significant:
             refined_list.append(TR_refined)
         else:
             refined_list.append(TR)
     return refined_list
 
 
-def write_file(tr_list, destination):
-    """Write all tandem repeats from a RepeatList to a specified output file (.tsv format)
+def write_file(rows, destination):
+    """Write tandem repeat rows (see repeat_rows()) to a specified output file (.tsv format). The file is first
+    written under a temporary name and then renamed, so an interrupted write never leaves a partial file behind
 
     Parameters
-    tr_list (tral.repeat_list.RepeatList):
-                    A list of TRs to be written to file
+    rows (list[list[str]]):
+                    Tandem repeats to be written to file
     destination (str):
                     Name of file to be made
     """
 
-    header = "\t".join(["begin",
-                        "msa_original",
-                        "l_effective",
-                        "n_effective",
-                        "repeat_region_length",
-                        "divergence",
-                        "pvalue"])
-    with open(destination, "w") as f:
-        f.write(header)
-        for tr in tr_list:
-            line = [
-                str(i) for i in [
-                    tr.begin,
-                    ",".join(tr.msa),
-                    tr.l_effective,
-                    tr.n_effective,
-                    tr.repeat_region_length,
-                    tr.divergence("phylo_gap01"),
-                    tr.pvalue("phylo_gap01")
-                ]
-            ]
+    tmp_destination = destination + ".tmp"
+    with open(tmp_destination, "w") as f:
+        f.write("\t".join(HEADER))
+        for line in rows:
             f.write("\n" + "\t".join(line))
-
+    os.replace(tmp_destination, destination)
 
 
 def parser():
@@ -249,6 +770,115 @@ def parser():
     parser.add_argument(
         "--outdir", "-o", type=str, required=True, help="Path to output directory"
     )
+    parser.add_argument(
+        "--workers", "-w", type=int, default=1,
+        help="Number of worker processes, each protein is processed as a separate work unit (default: 1)"
+    )
+    parser.add_argument(
+        "--resume", "-r", action="store_true",
+        help="Skip proteins that were finished by a previous run with the same output directory (default: False)"
+    )
+    parser.add_argument(
+        "--shard", "-s", type=parse_shard, default=None,
+        help="Only process shard i out of N ('i/N'), with shards balanced on sequence length. Results are written to "
+             "{outdir}/shard_i_of_N, merge all shards with 'merge_tral_results.py --shards N'"
+    )
+    parser.add_argument(
+        "--single-file", action="store_true",
+        help="Append the repeats of all proteins to one file ({outdir}/merged.tsv) instead of writing one file per "
+             "protein (default: False)"
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=100,
+        help="(only relevant with --single-file) Number of proteins that are buffered per write (default: 100)"
+    )
+    parser.add_argument(
+        "--cache", "-c", type=str, default=None,
+        help="Persistent result cache (SQLite file). Proteins of which the sequence and TRAL settings are unchanged "
+             "since an earlier run are taken from the cache instead of running TRAL"
+    )
+    parser.add_argument(
+        "--cache-size", type=float, default=None,
+        help="Maximum size of the result cache in MB, least recently used results are evicted (default: no limit)"
+    )
+    parser.add_argument(
+        "--prescreen", action="store_true",
+        help="Skip TRAL for proteins that do not pass a periodicity pre-screen. This is a heuristic, TRs with "
+             "insertions or deletions may be missed (validate settings with validate_prescreen.py) (default: False)"
+    )
+    parser.add_argument(
+        "--prescreen-max-period", type=int, default=100,
+        help="(only relevant with --prescreen) Longest repeat unit that is screened for (default: 100)"
+    )
+    parser.add_argument(
+        "--prescreen-identity", type=float, default=0.7,
+        help="(only relevant with --prescreen) Minimal fraction of identical residues between neighbouring repeat "
+             "units (default: 0.7)"
+    )
+    parser.add_argument(
+        "--hmm-cache", action="store_true",
+        help="Cache cpHMMs by repeat alignment, identical alignments are only built once per process (default: False)"
+    )
+    parser.add_argument(
+        "--hmm-cache-file", type=str, default=None,
+        help="SQLite file for an on-disk cpHMM cache shared between worker processes and runs (implies --hmm-cache)"
+    )
+    parser.add_argument(
+        "--profile", "-p", type=str, default=None,
+        help="Path prefix for timing reports: per stage wall clock and CPU time per protein ({profile}.csv) and "
+             "aggregated percentiles and throughput ({profile}.json)"
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=None,
+        help="Wall clock budget per protein in seconds, proteins that take longer are moved to "
+             "{outdir}/quarantine.txt (default: no limit)"
+    )
+    parser.add_argument(
+        "--memory-limit", type=float, default=None,
+        help="Memory budget per worker process in MB, proteins that exceed it are moved to {outdir}/quarantine.txt. "
+             "The budget also applies to the external detectors, proteins for which a detector fails to run are "
+             "quarantined as well (default: no limit)"
+    )
+    parser.add_argument(
+        "--cost-profile", type=str, default=None,
+        help="Timing report (.csv) of an earlier run (see --profile) to fit the cost per protein on sequence length. "
+             "Used to balance shards and to start the most expensive proteins first (default: power law in length)"
+    )
+    parser.add_argument(
+        "--windows", action="store_true",
+        help="Run de novo detection on long proteins in overlapping windows that are processed in parallel "
+             "(default: False)"
+    )
+    parser.add_argument(
+        "--window-size", type=int, default=2000, help="(only relevant with --windows) Window length (default: 2000)"
+    )
+    parser.add_argument(
+        "--window-overlap", type=int, default=500,
+        help="(only relevant with --windows) Number of residues shared by neighbouring windows (default: 500)"
+    )
+    parser.add_argument(
+        "--window-min-length", type=int, default=5000,
+        help="(only relevant with --windows) Only proteins of at least this length are split (default: 5000)"
+    )
+    parser.add_argument(
+        "--window-threads", type=int, default=4,
+        help="(only relevant with --windows) Number of windows of a protein processed at the same time (default: 4)"
+    )
+    parser.add_argument(
+        "--keep-duplicates", action="store_true",
+        help="Run every protein through TRAL, also proteins with the same sequence as another protein. By default, "
+             "identical sequences are run once and the result is written for all of their accessions"
+    )
+    parser.add_argument(
+        "--raw-store", action="store_true",
+        help="Store all unfiltered de novo and refined repeats with their statistics in {outdir}/raw_repeats.tsv.gz, "
+             "to try other thresholds with refilter.py without running TRAL again (default: False)"
+    )
+    parser.add_argument(
+        "--retry-quarantined", action="store_true",
+        help="Only process the quarantined proteins of a previous run with the same output directory, e.g. with a "
+             "larger --timeout or --memory-limit (default: False)"
+    )
 
     return parser.parse_args()
 
@@ -256,4 +886,16 @@ def parser():
 if __name__ == "__main__":
     args = parser()
 
-    find_protein_repeats(args.fasta, args.outdir)
+    find_protein_repeats(args.fasta, args.outdir, workers=args.workers, resume=args.resume, shard=args.shard,
+                         single_file=args.single_file, batch_size=args.batch_size, cache_file=args.cache,
+                         cache_size=int(args.cache_size * 1e6) if args.cache_size else None,
+                         prescreen=Prescreen(max_period=args.prescreen_max_period, min_identity=args.prescreen_identity,
+                                             n_threshold=N_THRESHOLD) if args.prescreen else None,
+                         hmm_cache=args.hmm_cache, hmm_cache_file=args.hmm_cache_file,
+                         profile=args.profile, timeout=args.timeout, memory_limit=args.memory_limit,
+                         cost_model=CostModel.from_profile(args.cost_profile) if args.cost_profile else None,
+                         retry_quarantined=args.retry_quarantined,
+                         windows=SequenceWindows(size=args.window_size, overlap=args.window_overlap,
+                                                 min_length=args.window_min_length,
+                                                 threads=args.window_threads) if args.windows else None,
+                         deduplicate=not args.keep_duplicates, raw_store=args.raw_store)
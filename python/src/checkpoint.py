@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+"""
+Checkpoint manifest for TR detection runs. The manifest is a tab separated file in the result directory with one line
+per protein that has been processed completely (also proteins without any TRs), so an interrupted run can be restarted
+without redoing finished proteins.
+
+Author: Max Verbiest
+Contact: max.verbiest@zhaw.ch
+"""
+
+import os
+
+__all__ = [
+    "Checkpoint",
+]
+
+
+class Checkpoint(object):
+    """
+    Manifest of finished proteins in a result directory. Every line has the format:
+        accession\tnumber_of_denovo_repeats\tnumber_of_final_repeats\n
+    Lines are appended (and flushed to disk) only after the results of a protein have been written, so any protein
+    that is not in the manifest has to be (re)done.
+    """
+
+    def __init__(self, result_dir, resume=False, file_name="checkpoint.txt"):
+        """
+        Parameters
+        result_dir (str):   directory where the results and the manifest are stored
+        resume (bool):      If True, read an existing manifest and continue from there. If False (default), an
+                            existing manifest is discarded and the run starts from scratch
+        file_name (str):    name of the manifest file in result_dir
+        """
+
+        self.result_dir = result_dir
+        self.path = os.path.join(result_dir, file_name)
+        if not resume and os.path.exists(self.path):
+            os.remove(self.path)
+        self.done = self.read_manifest()
+        self.handle = open(self.path, "a")
+
+    def read_manifest(self):
+        """Read all complete lines from the manifest. A last line without newline was being written when the
+        previous run was interrupted: it is ignored and removed from the file
+
+        Returns
+        done (dict):    accession -> (number of de novo repeats, number of final repeats)
+        """
+
+        done = dict()
+        if not os.path.exists(self.path):
+            return done
+        with open(self.path, "r") as f:
+            content = f.read()
+        complete = content[:content.rfind("\n") + 1]
+        if len(complete) != len(content):
+            with open(self.path, "w") as f:
+                f.write(complete)
+        for line in complete.splitlines():
+            accession, denovo, final = line.split("\t")
+            done[accession] = (int(denovo), int(final))
+        return done
+
+    def is_done(self, accession):
+        return accession in self.done
+
+    def record(self, accession, denovo, final):
+        """Mark a protein as finished
+
+        Parameters
+        accession (str):    protein identifier
+        denovo (int):       number of de novo detected repeats
+        final (int):        number of repeats after filtering, clustering and refinement
+        """
+
+        self.record_many([(accession, denovo, final)])
+
+    def record_many(self, entries):
+        """Mark several proteins as finished with a single write to disk
+
+        Parameters
+        entries (list[tuple(str, int, int)]):
+                            (accession, number of de novo repeats, number of final repeats) per protein
+        """
+
+        self.handle.write("".join("{}\t{}\t{}\n".format(*entry) for entry in entries))
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+        for accession, denovo, final in entries:
+            self.done[accession] = (denovo, final)
+
+    def remove_unfinished(self, extension=".tsv", keep=("merged.tsv",)):
+        """Remove result files of proteins that are not in the manifest (written by an interrupted protein) and
+        forget finished proteins of which the result file has gone missing, so both will be redone
+
+        Parameters
+        extension (str):    extension of the per protein result files
+        keep (tuple[str]):  files in the result directory with the same extension that are not per protein results
+
+        Returns
+        removed (list[str]):
+                            accessions of proteins that will be redone
+        """
+
+        removed = []
+        present = set()
+        for file_name in os.listdir(self.result_dir):
+            if file_name.endswith(extension + ".tmp"):
+                os.remove(os.path.join(self.result_dir, file_name))
+                continue
+            if not file_name.endswith(extension) or file_name in keep:
+                continue
+            accession = file_name[:-len(extension)]
+            if accession in self.done:
+                present.add(accession)
+            else:
+                os.remove(os.path.join(self.result_dir, file_name))
+                removed.append(accession)
+        for accession, (_, final) in list(self.done.items()):
+            if final and accession not in present:
+                del self.done[accession]
+                removed.append(accession)
+        return removed
+
+    def totals(self):
+        """Summed number of de novo and final repeats of all finished proteins"""
+
+        return sum(i[0] for i in self.done.values()), sum(i[1] for i in self.done.values())
+
+    def close(self):
+        self.handle.close()
+
+    def __len__(self):
+        return len(self.done)
+
+    def __str__(self):
+        return "Checkpoint manifest at '{}' ({} finished proteins)".format(self.path, len(self.done))
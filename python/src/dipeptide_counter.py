@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+Vectorized counting of dipeptides inside and outside of STRs. Sequences of a batch of proteins are integer encoded
+(src/sequence_encoding.py) and concatenated, STR regions are turned into one boolean mask for the batch, and all 400
+dipeptides are counted in both classes with a single np.bincount over dipeptide codes (20 * first + second).
+
+A dipeptide is inside an STR if either of its residues is part of an STR. Dipeptides with a residue that is not one of
+the 20 standard amino acids are not counted.
+
+Author: Max Verbiest
+Contact: max.verbiest@zhaw.ch
+"""
+
+import numpy as np
+
+try:
+    from src.sequence_encoding import AMINO_ACIDS, UNKNOWN, encode
+except ModuleNotFoundError:
+    from sequence_encoding import AMINO_ACIDS, UNKNOWN, encode
+
+__all__ = [
+    "DIPEPTIDES",
+    "dipeptide_code",
+    "str_mask",
+    "DipeptideCounter",
+]
+
+# all dipeptides in the order of their code
+DIPEPTIDES = [first + second for first in AMINO_ACIDS for second in AMINO_ACIDS]
+_N = len(DIPEPTIDES)
+
+
+def dipeptide_code(dipeptide):
+    """Code of a dipeptide (str of two standard amino acids), its index in DIPEPTIDES"""
+
+    return DIPEPTIDES.index(dipeptide.upper())
+
+
+def str_mask(length, begins, ends, offsets=None):
+    """Boolean mask of the positions covered by regions
+
+    Parameters
+    length (int):           length of the masked sequence (or concatenated sequences)
+    begins, ends (array-like):
+                            first and last position of every region (1-based, inclusive as in TRAL output)
+    offsets (array-like):   If given, position in the concatenated sequence where the protein of every region starts
+
+    Returns
+    mask (np.ndarray):      True for every position in a region
+    """
+
+    begins, ends = np.asarray(begins, dtype=np.int64), np.asarray(ends, dtype=np.int64)
+    if offsets is not None:
+        begins, ends = begins + offsets, ends + offsets
+    # +1 where a region starts, -1 after it ends: positive cumulative sums are covered positions
+    steps = np.zeros(length + 1, dtype=np.int64)
+    np.add.at(steps, begins - 1, 1)
+    np.add.at(steps, ends, -1)
+    return np.cumsum(steps[:-1]) > 0
+
+
+class DipeptideCounter(object):
+    """
+    Counts of all dipeptides inside and outside of STRs, accumulated over batches of proteins
+    """
+
+    def __init__(self, str_regions=None):
+        """
+        Parameters
+        str_regions (dict): protein ID -> (begins, ends) arrays of its STRs (1-based, inclusive). Proteins that are
+                            not in str_regions have no STRs
+        """
+
+        self.str_regions = str_regions if str_regions is not None else dict()
+        # row 0: outside of STRs, row 1: inside of STRs
+        self.counts = np.zeros((2, _N), dtype=np.int64)
+        self.n_proteins = 0
+        self.n_residues = 0
+
+    def add(self, proteins):
+        """Count the dipeptides of a batch of proteins
+
+        Parameters
+        proteins (list[tuple(str, str)]):
+                            (ID, sequence) of every protein
+        """
+
+        if not proteins:
+            return
+        # one unknown residue between proteins, so no dipeptide spans two proteins
+        lengths = np.array([len(sequence) + 1 for _, sequence in proteins], dtype=np.int64)
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        codes = encode("X".join(sequence for _, sequence in proteins) + "X").astype(np.int64)
+
+        begins, ends, region_offsets = [], [], []
+        for (prot_id, _), offset in zip(proteins, offsets):
+            if prot_id in self.str_regions:
+                prot_begins, prot_ends = self.str_regions[prot_id]
+                begins.append(prot_begins)
+                ends.append(prot_ends)
+                region_offsets.append(np.full(len(prot_begins), offset, dtype=np.int64))
+        if begins:
+            mask = str_mask(len(codes), np.concatenate(begins), np.concatenate(ends), np.concatenate(region_offsets))
+        else:
+            mask = np.zeros(len(codes), dtype=bool)
+
+        first, second = codes[:-1], codes[1:]
+        valid = (first != UNKNOWN) & (second != UNKNOWN)
+        inside = mask[:-1] | mask[1:]
+        dipeptides = (first * len(AMINO_ACIDS) + second + _N * inside)[valid]
+        self.counts += np.bincount(dipeptides, minlength=2 * _N).reshape(2, _N)
+        self.n_proteins += len(proteins)
+        self.n_residues += int(lengths.sum()) - len(proteins)
+
+    def outside(self, dipeptide):
+        return int(self.counts[0, dipeptide_code(dipeptide)])
+
+    def inside(self, dipeptide):
+        return int(self.counts[1, dipeptide_code(dipeptide)])
+
+    def write(self, output_file):
+        """Write the counts of all dipeptides (columns: dipeptide, outside_str, inside_str)"""
+
+        with open(output_file, "w") as o:
+            o.write("dipeptide\toutside_str\tinside_str\n")
+            for dipeptide, outside, inside in zip(DIPEPTIDES, self.counts[0].tolist(), self.counts[1].tolist()):
+                o.write("{}\t{}\t{}\n".format(dipeptide, outside, inside))
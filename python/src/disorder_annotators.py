@@ -9,11 +9,20 @@ Author: Max Verbiest
 Contact: max.verbiest@zhaw.ch
 """
 
+import collections
+import concurrent.futures
+import json
+import shutil
 import subprocess
 import os
-import json
-import urllib.request
-import urllib.error
+import tempfile
+
+try:
+    from src.mobidb_client import MOBIDB_URL, FOUND, NOT_FOUND, FAILED, MobiDBClient, MobiDBResult
+    from src.kv_cache import SQLiteCache, digest
+except ModuleNotFoundError:
+    from mobidb_client import MOBIDB_URL, FOUND, NOT_FOUND, FAILED, MobiDBClient, MobiDBResult
+    from kv_cache import SQLiteCache, digest
 
 try:
     from Bio import SeqIO
@@ -24,9 +33,38 @@ __all__ = [
     "DisorderAnnotator",
     "APIDisorderAnnotator",
     "LocalDisorderAnnotator",
+    "OfflineCacheMiss",
+    "read_fasta_records",
 ]
 
 
+class OfflineCacheMiss(LookupError):
+    """Raised in offline mode when a protein is not in the MobiDB response cache"""
+
+
+def read_fasta_records(fasta):
+    """Read the records of a fasta file as text, without Bio.SeqIO (not available in the MobiDB-Lite docker)
+
+    Yields
+    record (str):   header and sequence lines of a record
+    length (int):   number of residues
+    """
+
+    lines, length = [], 0
+    with open(fasta, "r") as f:
+        for line in f:
+            if line.startswith(">") and lines:
+                yield "".join(lines), length
+                lines, length = [], 0
+            if not line.endswith("\n"):
+                line += "\n"
+            lines.append(line)
+            if not line.startswith(">"):
+                length += len(line.strip())
+    if lines:
+        yield "".join(lines), length
+
+
 class DisorderAnnotator(object):
     """Abstract class to outline functionality.
     Subclasses implement methods for annotating disorder in protein sequences, extracted from
@@ -63,84 +101,173 @@ class APIDisorderAnnotator(DisorderAnnotator):
     UniProt/ SwissProt format. Protein IDs are queried to MobiDB and predicted disordered regions (from MobiDB-Lite)
     are extracted and written to an output file.
 
+    Responses can be kept in a persistent cache (SQLite, see src/kv_cache.py), keyed by accession, projection and
+    sequence checksum, so proteins are only downloaded again when their sequence changed or their entry expired. Found
+    entries and 404s are cached, failed requests are not.
+
     For information on MobiDB API, see:
             https://mobidb.bio.unipd.it/help/apidoc
         and
             https://mobidb.bio.unipd.it/about/mobidb
     """
 
-    def __init__(self, fasta, out_file, curated=False):
+    def __init__(self, fasta, out_file, curated=False, base_url=MOBIDB_URL, concurrency=8, rate=10, retries=5,
+                 cache_file=None, cache_ttl=None, cache_size=None, offline=False):
         """
         Parameters
-        curated (bool): (Not implemented!) Should curated information from
-                        MobiDB be incorporated in output? (default:False)
+        curated (bool):     (Not implemented!) Should curated information from
+                            MobiDB be incorporated in output? (default:False)
+        base_url (str):     URL of the MobiDB download endpoint (default: the public MobiDB API)
+        concurrency (int):  number of concurrent requests (default: 8)
+        rate (float):       maximum number of requests per second, None for no limit (default: 10)
+        retries (int):      number of retries after a transient error (timeout, HTTP 429 or 5xx) (default: 5)
+        cache_file (str):   SQLite file for the response cache, None (default) for no cache
+        cache_ttl (float):  time in seconds after which cached responses expire, None (default) for no expiration
+        cache_size (int):   maximum size of the cache in bytes, least recently used responses are evicted when it is
+                            exceeded, None (default) for no limit
+        offline (bool):     If True, never query MobiDB: proteins that are not in the cache raise OfflineCacheMiss
         """
 
         super().__init__(fasta, out_file)
         self.fasta = SeqIO.parse(fasta, "fasta")
-        self.base_url = "https://mobidb.bio.unipd.it/api/download?acc={}{}&format=json"
-        self.filter = "&projection=prediction-disorder-mobidb_lite"
+        self.projection = "prediction-disorder-mobidb_lite"
         if curated:
-            # self.filter += ",curated-disorder-priority"
+            # self.projection += ",curated-disorder-priority"
             raise NotImplementedError("Handling of curated MobiDB annotations is not yet supported")
-
-    def query_mobidb(self, prot_id):
-        """Construct url for current protein id and filter, query MobiDB
+        self.client = MobiDBClient(base_url, projection=self.projection, concurrency=concurrency, rate=rate,
+                                   retries=retries)
+        if offline and not cache_file:
+            raise ValueError("Offline mode needs a response cache")
+        self.cache = SQLiteCache(cache_file, max_bytes=cache_size, ttl=cache_ttl) if cache_file else None
+        self.offline = offline
+
+    def cache_key(self, prot_id, sequence):
+        return digest(prot_id, self.projection, digest(sequence))
+
+    def cached_response(self, prot_id, sequence):
+        """Response for a protein from the cache, None on a cache miss (OfflineCacheMiss in offline mode)"""
+
+        if self.cache is None:
+            return None
+        cached = self.cache.get(self.cache_key(prot_id, sequence))
+        if cached is not None:
+            response = json.loads(cached)
+            # no attempts: answered from the cache
+            return MobiDBResult(prot_id, response["status"], response["data"], None, 0)
+        if self.offline:
+            raise OfflineCacheMiss("{} is not in the MobiDB response cache (offline mode)".format(prot_id))
+        return None
+
+    def cache_response(self, result, sequence):
+        """Store the response for a protein in the cache (failed queries are not stored)"""
+
+        if self.cache is not None and result.attempts and result.status in {FOUND, NOT_FOUND}:
+            self.cache.put(self.cache_key(result.accession, sequence),
+                           json.dumps({"status": result.status, "data": result.data}))
+
+    def query_mobidb(self, prot_id, sequence=None):
+        """Query MobiDB for a single protein id, answered from the cache if possible
 
         Parameters
         prot_id (str):  UniProt identifier of protein of interest
+        sequence (str): sequence of the protein, needed to use the cache
 
         Returns
-        disorder_dict (dict):
-                        Dictionary containing all information available for protein entry in MobiDB after filter.
-                        If only part of this information is of interest, it can be extracted from the dictionary later
+        result (src.mobidb_client.MobiDBResult):
+                        status ('found', 'not_found' or 'failed') and, if found, a dictionary containing all
+                        information available for protein entry in MobiDB after filter. If only part of this
+                        information is of interest, it can be extracted from the dictionary later
         """
 
-        prot_url = self.base_url.format(prot_id, self.filter)
-        with urllib.request.urlopen(prot_url) as response:
-            disorder = response.read().decode("utf-8")
-            disorder_dict = json.loads(disorder)
-        return disorder_dict
+        if sequence is None:
+            return self.client.fetch(prot_id)
+        result = self.cached_response(prot_id, sequence)
+        if result is None:
+            result = self.client.fetch(prot_id)
+            self.cache_response(result, sequence)
+        return result
 
     def get_disorder_annotations(self):
         """ Retrieve MobiDB-Lite annotations through MobiDB web API.
         Implements method DisorderAnnotator.get_disorder_annotations(). Output is generated to mimic MobiDB-Lite output
-        when run with the '-f interpro' and '-sf' options, and is written to an output file.
+        when run with the '-f interpro' and '-sf' options, and is written to an output file in the order of the fasta
+        file. Proteins are queried concurrently (see src.mobidb_client.MobiDBClient). Accessions for which all requests
+        failed are written to {out_file}.failed.txt, so they can be queried again later. With a response cache, only
+        proteins that are not in the cache are queried.
+
+        Returns
+        counts (dict):  number of proteins with disordered regions, without disordered regions, not found in MobiDB
+                        and failed
         """
 
-        with open(self.out_file, "w") as o:
+        counts = collections.Counter({"disordered": 0, "no_disorder": 0, "not_found": 0, "failed": 0})
+        records = collections.deque()
+
+        def accessions():
             for record in self.fasta:
-                prot_id = record.id.split("|")[1]
-                print("Started work on sequence '{}'...".format(prot_id))
-                try:
-                    disorder_dict = self.query_mobidb(prot_id)
-                except urllib.error.URLError:
-                    print("{} was not found in MobiDB".format(prot_id))
-                    continue
+                records.append((record.id, str(record.seq)))
+                yield record.id.split("|")[1]
 
-                try:
-                    disorder_regions = [(i[0], i[1]) for i in
-                                        disorder_dict["prediction-disorder-mobidb_lite"]["regions"]]
-                except KeyError:
-                    print("No disorder predicted".format(prot_id))
-                    continue
-                print("Predicted disordered regions: {}".format(disorder_regions))
-                for coords in disorder_regions:
-                    o.write("{}\t{}\t{}\n".format(record.id, coords[0], coords[1]))
+        def lookup(prot_id):
+            # called right after the accession is read, so its record is the last one
+            return self.cached_response(prot_id, records[-1][1])
+
+        try:
+            with open(self.out_file, "w") as o, open(self.out_file + ".failed.txt", "w") as failed:
+                for result in self.client.fetch_all(accessions(), lookup=lookup):
+                    record_id, sequence = records.popleft()
+                    self.cache_response(result, sequence)
+                    if result.status == NOT_FOUND:
+                        print("{} was not found in MobiDB".format(result.accession))
+                        counts["not_found"] += 1
+                        continue
+                    if result.status == FAILED:
+                        print("Query for {} failed after {} attempt(s): {}".format(
+                            result.accession, result.attempts, result.error))
+                        failed.write("{}\t{}\n".format(result.accession, result.error))
+                        counts["failed"] += 1
+                        continue
+
+                    try:
+                        disorder_regions = [(i[0], i[1]) for i in result.data[self.projection]["regions"]]
+                    except KeyError:
+                        print("No disorder predicted for {}".format(result.accession))
+                        counts["no_disorder"] += 1
+                        continue
+                    print("Predicted disordered regions in {}: {}".format(result.accession, disorder_regions))
+                    counts["disordered"] += 1
+                    for coords in disorder_regions:
+                        o.write("{}\t{}\t{}\n".format(record_id, coords[0], coords[1]))
+            print("MobiDB: {disordered} protein(s) with disordered regions, {no_disorder} without, {not_found} not "
+                  "found, {failed} failed".format(**counts))
+        finally:
+            self.client.close()
+            if self.cache is not None:
+                print(self.cache.report())
+                self.cache.close()
+        return dict(counts)
 
 
 class LocalDisorderAnnotator(DisorderAnnotator):
     """
     Class to run MobiDB-lite disorder annotations locally. Will only work using the docker image provided
     on https://github.com/BioComputingUP/MobiDB-lite_docker
+
+    With an index file, annotations are incremental: the index maps the digest of every annotated sequence to its
+    MobiDB-Lite output lines, only sequences that are not in the index are annotated and the output file is rebuilt
+    from the index. Index lines have the format:
+        digest\t<output line without ID>\n    (one line per region, only the digest for sequences without regions)
+    Sequences that are no longer in the fasta file stay in the index.
     """
 
-    def __init__(self, fasta, out_file, out_format="interpro", silence_sf=True):
+    def __init__(self, fasta, out_file, out_format="interpro", silence_sf=True, index_file=None):
         """
         Parameters
         out_format (str):   Output format, define output detail (MobiDB-lite gitbub for details). Accepted values
                             are: "interpro (default)", "fasta", "caid", "mobidb4"
         silence_sf (bool):  If True (default), sequence features (e.g. polar, polyampholyte) will be silenced in output
+        index_file (str):   Index of earlier annotations (created if it does not exist), None (default) to annotate
+                            all sequences. Only supported for the 'interpro' output format
         """
 
         super().__init__(fasta, out_file)
@@ -148,6 +275,9 @@ class LocalDisorderAnnotator(DisorderAnnotator):
         self.out_format = self.check_out_format(out_format)
         self.silence_sf = silence_sf
         self.mobidb_path = "/usr/src/mobidb/mobidb_lite.py"
+        if index_file and self.out_format != "interpro":
+            raise ValueError("Incremental annotation is only supported for the 'interpro' output format")
+        self.index_file = index_file
 
     def check_out_format(self, format):
         """Check whether the specified output format is supported by MobiDB-lite"""
@@ -156,7 +286,7 @@ class LocalDisorderAnnotator(DisorderAnnotator):
             raise ValueError("Please pick one of the following output formats: interpro, fasta, caid, mobidb4")
         return format
 
-    def run_mobidb(self, threads=1, env=os.environ.copy()):
+    def run_mobidb(self, threads=1, env=os.environ.copy(), fasta=None, out_file=None):
         """Run MobiDB-Lite script, method taken from:
                             https://github.com/BioComputingUP/MobiDB-lite_docker/blob/master/test.ipynb
 
@@ -164,6 +294,8 @@ class LocalDisorderAnnotator(DisorderAnnotator):
         threads (int):     Number of threads involved in disordered regions computation range between 1(default) and 7
         env (dict):        Environmental variables (e.g. python path) which must be set in order
                            to correctly run MobiDB Lite script
+        fasta (str):       Input fasta file, if not the fasta file of the annotator (e.g. a chunk of it)
+        out_file (str):    Output file, if not the output file of the annotator
         """
 
         # Call subprocess
@@ -180,27 +312,250 @@ class LocalDisorderAnnotator(DisorderAnnotator):
                 # Set output file format
                 '-f', '{:s}'.format(self.out_format),
                 # Set output file
-                '-o', '{:s}'.format(self.out_file),
+                '-o', '{:s}'.format(out_file or self.out_file),
                 # Set number of threads, if any
                 *(['-t', '{:d}'.format(threads)] if threads else []),
                 # Silence sequence features, if desired
                 *(['{:s}'.format("-sf")] if self.silence_sf else []),
                 # Set input file path
-                '{:s}'.format(self.fasta)
+                '{:s}'.format(fasta or self.fasta)
             ]
         )
 
-    def get_disorder_annotations(self, threads=1):
+    def split_fasta(self, chunk_dir, n_chunks, fasta=None):
+        """Split the fasta file in at most n_chunks chunks of consecutive proteins with about equal numbers of
+        residues. Chunks keep the order of the fasta file, so their outputs can simply be concatenated
+
+        Returns
+        chunk_files (list[str]):
+                        paths of the chunk fasta files, in order
+        """
+
+        fasta = fasta or self.fasta
+        total = sum(length for _, length in read_fasta_records(fasta))
+        chunk_files = []
+        handle, chunk = None, None
+        residues = 0
+        for record, length in read_fasta_records(fasta):
+            # chunk of the first residue of the protein
+            index = min(n_chunks - 1, residues * n_chunks // total) if total else 0
+            residues += length
+            if index != chunk:
+                if handle:
+                    handle.close()
+                chunk = index
+                chunk_files.append(os.path.join(chunk_dir, "chunk_{}.fasta".format(len(chunk_files) + 1)))
+                handle = open(chunk_files[-1], "w")
+            handle.write(record)
+        if handle:
+            handle.close()
+        return chunk_files
+
+    def run_chunked(self, jobs, chunks=None, threads=1, fasta=None, out_file=None):
+        """Run MobiDB-Lite on chunks of the fasta file, with up to jobs concurrent MobiDB-Lite processes. Outputs of
+        chunks are appended to the output file in the order of the fasta file as soon as all earlier chunks are done
+
+        Parameters
+        jobs (int):         number of concurrent MobiDB-Lite processes
+        chunks (int):       number of chunks, by default 4 per job so that jobs finish at about the same time
+        threads (int):      threads per MobiDB-Lite process
+        fasta (str):        Input fasta file, if not the fasta file of the annotator
+        out_file (str):     Output file, if not the output file of the annotator
+
+        Returns
+        failed (list[tuple(str, int, str)]):
+                            chunk fasta file, exit code and stderr of every chunk for which MobiDB-Lite failed. These
+                            chunk files are kept (in a temporary directory next to the output file), so they can be
+                            annotated again
+                            Other errors (e.g. MobiDB-Lite not found) are raised after the temporary directory and the
+                            incomplete output file are removed
+        """
+
+        fasta, out_file = fasta or self.fasta, out_file or self.out_file
+        chunk_dir = tempfile.mkdtemp(prefix=".mobidb_chunks_", dir=os.path.dirname(out_file) or ".")
+        failed = []
+        finished = dict()
+        merged = 0
+        try:
+            chunk_files = self.split_fasta(chunk_dir, chunks or 4 * jobs, fasta=fasta)
+            print("Split {} in {} chunks, running {} MobiDB-Lite processes".format(fasta, len(chunk_files), jobs))
+            with open(out_file, "w") as o, concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+                futures = {executor.submit(self.run_mobidb, threads, fasta=chunk_file, out_file=chunk_file + ".out"):
+                           i for i, chunk_file in enumerate(chunk_files)}
+                try:
+                    for future in concurrent.futures.as_completed(futures):
+                        i = futures[future]
+                        try:
+                            future.result()
+                            finished[i] = True
+                        except subprocess.CalledProcessError as err:
+                            print("MobiDB Lite exited with code {} for chunk {}".format(err.returncode,
+                                                                                       chunk_files[i]))
+                            failed.append((chunk_files[i], err.returncode, err.stderr))
+                            finished[i] = False
+                        # stream all chunks up to the first unfinished chunk into the output file
+                        while merged in finished:
+                            if finished[merged]:
+                                with open(chunk_files[merged] + ".out", "r") as f:
+                                    shutil.copyfileobj(f, o)
+                            merged += 1
+                except BaseException:
+                    # do not start the remaining chunks, running chunks are awaited when the executor shuts down
+                    for future in futures:
+                        future.cancel()
+                    raise
+        except BaseException:
+            # any other failure (e.g. no MobiDB-Lite, error while copying a chunk): no partial output is left behind
+            shutil.rmtree(chunk_dir, ignore_errors=True)
+            if os.path.isfile(out_file):
+                os.remove(out_file)
+            raise
+        failed_files = {chunk_file for chunk_file, _, _ in failed}
+        for chunk_file in chunk_files:
+            if chunk_file not in failed_files:
+                os.remove(chunk_file)
+            if os.path.isfile(chunk_file + ".out"):
+                os.remove(chunk_file + ".out")
+        if not failed:
+            os.rmdir(chunk_dir)
+        return failed
+
+    def read_index(self):
+        """Read the index of earlier annotations
+
+        Returns
+        index (dict):   sequence digest -> list of output lines without ID (empty for sequences without regions)
+        """
+
+        index = dict()
+        if not self.index_file or not os.path.isfile(self.index_file):
+            return index
+        with open(self.index_file, "r") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    # incomplete last line of an interrupted run
+                    break
+                key, _, region = line.rstrip("\n").partition("\t")
+                index.setdefault(key, [])
+                if region:
+                    index[key].append(region)
+        return index
+
+    def write_index(self, index):
+        tmp_file = self.index_file + ".tmp"
+        with open(tmp_file, "w") as o:
+            for key, regions in index.items():
+                if not regions:
+                    o.write("{}\n".format(key))
+                for region in regions:
+                    o.write("{}\t{}\n".format(key, region))
+        os.replace(tmp_file, self.index_file)
+
+    def annotate_incremental(self, threads=1, jobs=1, chunks=None):
+        """Annotate only the sequences that are not in the index, then rebuild the output file (in the order of the
+        fasta file) from the index and update the index. Identical sequences are annotated once
+
+        Returns
+        failed (list):      see annotate(), the proteins of failed runs are missing from the output and the index
+        """
+
+        settings = "silence_sf={}".format(self.silence_sf)
+        index = self.read_index()
+        if index.pop("#" + settings, None) is None:
+            # index made with other settings (or new)
+            index = dict()
+        work_dir = tempfile.mkdtemp(prefix=".mobidb_new_", dir=os.path.dirname(self.out_file) or ".")
+        new_fasta, new_out = os.path.join(work_dir, "new.fasta"), os.path.join(work_dir, "new.out")
+
+        records = []
+        queued = dict()
+        with open(new_fasta, "w") as o:
+            for record, _ in read_fasta_records(self.fasta):
+                header, _, sequence = record.partition("\n")
+                prot_id = header[1:].split()[0] if header[1:].strip() else ""
+                key = digest("".join(sequence.split()))
+                records.append((prot_id, key))
+                if key not in index and key not in queued:
+                    queued[key] = prot_id
+                    o.write(record)
+        print("{} of {} sequence(s) are in the index, {} are annotated with MobiDB-Lite".format(
+            sum(1 for _, key in records if key in index), len(records), len(queued)))
+
+        failed = []
+        if queued:
+            failed = self.annotate(threads=threads, jobs=jobs, chunks=chunks, fasta=new_fasta, out_file=new_out)
+            failed_ids = set()
+            for failed_fasta, _, _ in failed:
+                failed_ids.update(record.split(None, 1)[0][1:] for record, _ in read_fasta_records(failed_fasta))
+            regions = dict()
+            if os.path.isfile(new_out):
+                with open(new_out, "r") as f:
+                    for line in f:
+                        prot_id, _, region = line.rstrip("\n").partition("\t")
+                        regions.setdefault(prot_id, []).append(region)
+            for key, prot_id in queued.items():
+                if prot_id not in failed_ids:
+                    index[key] = regions.get(prot_id, [])
+
+        with open(self.out_file, "w") as o:
+            for prot_id, key in records:
+                for region in index.get(key, []):
+                    o.write("{}\t{}\n".format(prot_id, region))
+        index = dict([("#" + settings, [])] + list(index.items()))
+        self.write_index(index)
+        if not failed:
+            shutil.rmtree(work_dir)
+        return failed
+
+    def get_disorder_annotations(self, threads=1, jobs=1, chunks=None):
         """Run MobiDB-Lite locally and report output/ errors
-        Implements method DisorderAnnotator.get_disorder_annotations() Annotations are written to output file.
+        Implements method DisorderAnnotator.get_disorder_annotations() Annotations are written to output file. With
+        an index file, only sequences that are not in the index are annotated (see annotate_incremental())
 
         Parameters
         threads (int):   How many threads MobiDB-Lite should use: range between 1(default) and 7
+        jobs (int):      If more than 1, the fasta file is split in chunks that are annotated by this many concurrent
+                         MobiDB-Lite processes (see run_chunked())
+        chunks (int):    number of chunks (default: 4 per job)
+
+        Returns
+        failed (list):   see annotate()
         """
 
+        if self.index_file:
+            return self.annotate_incremental(threads=threads, jobs=jobs, chunks=chunks)
+        return self.annotate(threads=threads, jobs=jobs, chunks=chunks)
+
+    def annotate(self, threads=1, jobs=1, chunks=None, fasta=None, out_file=None):
+        """Run MobiDB-Lite on all sequences of a fasta file, in a single process or in chunks (jobs > 1)
+
+        Parameters
+        threads, jobs, chunks:
+                         see get_disorder_annotations()
+        fasta (str):     Input fasta file, if not the fasta file of the annotator
+        out_file (str):  Output file, if not the output file of the annotator
+
+        Returns
+        failed (list[tuple(str, int, str)]):
+                         fasta file, exit code and stderr of every failed MobiDB-Lite run (see run_chunked())
+        """
+
+        fasta, out_file = fasta or self.fasta, out_file or self.out_file
+        if jobs > 1:
+            failed = self.run_chunked(jobs, chunks=chunks, threads=threads, fasta=fasta, out_file=out_file)
+            for chunk_file, returncode, stderr in failed:
+                print("Chunk {} failed (exit code {}), its proteins are missing from {}. stderr:".format(
+                    chunk_file, returncode, out_file))
+                print(stderr)
+            if failed:
+                print("MobiDB Lite failed for {} chunk(s)".format(len(failed)))
+            else:
+                print("MobiDB Lite succesfully completed")
+            return failed
+
         try:
             # Run MobiDB Lite
-            ran = self.run_mobidb(threads)
+            ran = self.run_mobidb(threads, fasta=fasta, out_file=out_file)
             print('MobiDB Lite succesfully completed')
             # If annotations were not written to file: retrieve stdout and stderr
             if ran.stdout:
@@ -220,3 +575,5 @@ class LocalDisorderAnnotator(DisorderAnnotator):
             print('stderr:')
             print(err.stderr)
             print()
+            return [(fasta, err.returncode, err.stderr)]
+        return []
@@ -7,18 +7,39 @@ from Bio import SeqIO
 from tral.sequence import sequence
 from tral.hmm import hmm
 
+try:
+    from src.sharding import parse_shard, select_shard, shard_dir, mark_shard_done, clear_shard_done
+    from src.result_writer import repeat_rows, StreamingResultWriter
+    from src.hmm_cache import HMMCache
+    from src.windowing import SequenceWindows, detect_denovo
+    from src.result_merger import merge_result_files
+except ModuleNotFoundError:
+    # script is run directly from the src directory
+    from sharding import parse_shard, select_shard, shard_dir, mark_shard_done, clear_shard_done
+    from result_writer import repeat_rows, StreamingResultWriter
+    from hmm_cache import HMMCache
+    from windowing import SequenceWindows, detect_denovo
+    from result_merger import merge_result_files
+
 __all__ = [
     "TRFinder",
 ]
 
 
 class TRFinder(object):
-    def __init__(self, fasta_file, output_dir, score="phylo_gap01"):
+    def __init__(self, fasta_file, output_dir, score="phylo_gap01", shard=None):
         if not fasta_file.endswith(".fasta"):
             raise ValueError("Input file needs to have '.fasta' extension.")
         self.fasta_handle = fasta_file
+        self.shard = shard
         self.sequences = SeqIO.parse(self.fasta_handle, "fasta")
+        if shard:
+            # only keep proteins of shard i out of N, results go to a separate directory per shard
+            self.sequences = select_shard(list(self.sequences), shard, key=lambda record: record.id.split("|")[1])
+            output_dir = shard_dir(output_dir, shard)
         self.output_dir = self.generate_output_dir(output_dir)
+        if shard:
+            clear_shard_done(self.output_dir)
         self.score = score
 
     def generate_output_dir(self, output_dir):
@@ -27,35 +48,26 @@ class TRFinder(object):
         return output_dir
 
     def merge_repeat_files(self):
-        file_list = [os.path.join(self.output_dir, f) for f in os.listdir(self.output_dir) if f.endswith(".tsv")]
-        # get header
-        with open(file_list[0], "r") as f:
-            header_line = f.readline().strip()
-            if not header_line.startswith("begin"):
-                raise ValueError("File layout different than expected!")
-            header_line = "ID\t{}\n".format(header_line)
-        output_file = "{}/merged.tsv".format(self.output_dir)
-        with open(output_file, "w") as o:
-            o.write(header_line)
-            for file_name in file_list:
-                handle = file_name.split("/")[-1]
-                prot_id = handle.split(".")[0]
-                with open(file_name, "r") as f:
-                    for line in f:
-                        if not line.startswith("begin"):
-                            o.write("{}\t{}".format(prot_id, line))
-
-    def detect_in_sequence(self, record, remaster=True):
+        # only files that are new or changed since the last merge are read (see src.result_merger)
+        counts = merge_result_files([self.output_dir], "{}/merged.tsv".format(self.output_dir))
+        print("Merged result files: {added} added, {replaced} replaced, {removed} removed, "
+              "{unchanged} unchanged".format(**counts))
+
+    def detect_in_sequence(self, record, remaster=True, hmm_cache=None, windows=None):
         seq_name = record.id.split("|")[1]
         # name is protein identifier
         seq = sequence.Sequence(seq=str(record.seq), name=seq_name)
-        denovo_list = seq.detect(denovo=True)
+        # long sequences can be split in overlapping windows for de novo detection (see src.windowing)
+        denovo_list = detect_denovo(seq, windows)
         ##########################################################################
         # Building HMM with hmmbuild
         # De novo TRs are remastered with HMM
         if remaster:
-            denovo_hmm = [hmm.HMM.create(input_format='repeat', repeat=iTR)
-                          for iTR in denovo_list.repeats]  # only possible with hmmbuild
+            if hmm_cache:
+                # identical repeat alignments only need to be built once
+                denovo_hmm = [hmm_cache.get_or_create(iTR, self.create_hmm) for iTR in denovo_list.repeats]
+            else:
+                denovo_hmm = [self.create_hmm(iTR) for iTR in denovo_list.repeats]
             denovo_list = seq.detect(lHMM=denovo_hmm)
         if not denovo_list:
             return
@@ -63,6 +75,10 @@ class TRFinder(object):
             TR.calculate_pvalues()
         return denovo_list
 
+    @staticmethod
+    def create_hmm(repeat):
+        return hmm.HMM.create(input_format='repeat', repeat=repeat)  # only possible with hmmbuild
+
     def filter(self, repeat_list, criterion, threshold, **kwargs):
         try:
             if criterion in {"pvalue", "divergence"}:
@@ -92,15 +108,41 @@ def parser():
     parser.add_argument(
         "--outdir", "-o", type=str, required=True, help="Path to output directory"
     )
+    parser.add_argument(
+        "--shard", "-s", type=parse_shard, default=None,
+        help="Only process shard i out of N ('i/N'), with shards balanced on sequence length. Results are written to "
+             "{outdir}/shard_i_of_N"
+    )
+    parser.add_argument(
+        "--single-file", action="store_true",
+        help="Append the repeats of all proteins to one file ({outdir}/merged.tsv) instead of writing a .tsv and .pkl "
+             "file per protein (default: False)"
+    )
+    parser.add_argument(
+        "--hmm-cache-file", type=str, default=None,
+        help="SQLite file for an on-disk cpHMM cache shared between runs (cpHMMs are always cached in memory)"
+    )
+    parser.add_argument(
+        "--windows", action="store_true",
+        help="Run de novo detection on proteins of 5000 residues or more in overlapping windows of 2000 residues "
+             "(default: False)"
+    )
 
     return parser.parse_args()
 
 
 if __name__ == "__main__":
     args = parser()
-    finder = TRFinder(fasta_file=args.fasta, output_dir=args.outdir)
+    finder = TRFinder(fasta_file=args.fasta, output_dir=args.outdir, shard=args.shard)
+    writer = None
+    if args.single_file:
+        writer = StreamingResultWriter(os.path.join(finder.output_dir, "merged.tsv"))
+    hmm_cache = HMMCache(args.hmm_cache_file)
+    windows = SequenceWindows() if args.windows else None
+    n_proteins = 0
     for record in finder.sequences:
-        repeat_list = finder.detect_in_sequence(record)
+        n_proteins += 1
+        repeat_list = finder.detect_in_sequence(record, hmm_cache=hmm_cache, windows=windows)
         if not repeat_list:
             continue
 
@@ -112,8 +154,13 @@ if __name__ == "__main__":
             continue
         clustered_list = finder.cluster(repeat_list)
 
-        # create filename
         seq_name = record.id.split("|")[1]
+        if writer:
+            writer.add(seq_name, repeat_rows(clustered_list, score=finder.score))
+            print("Found {} TR(s) in protein {} (after filtering and clustering)".format(len(clustered_list.repeats), seq_name))
+            continue
+
+        # create filename
         output_pickle_file = os.path.join(finder.output_dir, seq_name + ".pkl")
         output_tsv_file = os.path.join(finder.output_dir, seq_name + ".tsv")
 
@@ -122,4 +169,12 @@ if __name__ == "__main__":
         clustered_list.write(output_format="tsv", file=output_tsv_file)
 
         print("Found {} TR(s) in protein {} (after filtering and clustering)".format(len(clustered_list.repeats), seq_name))
-    finder.merge_repeat_files()
+    print("cpHMM cache: {memory_hits} memory hits, {disk_hits} disk hits, {misses} built with hmmbuild".format(
+        **hmm_cache.stats()))
+    hmm_cache.close()
+    if writer:
+        writer.close()
+    else:
+        finder.merge_repeat_files()
+    if finder.shard:
+        mark_shard_done(finder.output_dir, proteins=n_proteins)
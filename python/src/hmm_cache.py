@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+Cache for circular profile HMMs (cpHMMs) built from tandem repeat alignments. Building a cpHMM calls hmmbuild, while
+the same repeat alignments (e.g. poly-A, poly-Q, 'PS,PS,PS') occur in thousands of proteins. HMMs are kept in memory
+per process and, optionally, in an on-disk layer that is shared between processes and runs.
+
+Author: Max Verbiest
+Contact: max.verbiest@zhaw.ch
+"""
+
+import collections
+import pickle
+
+try:
+    from src.kv_cache import SQLiteCache, digest
+except ModuleNotFoundError:
+    from kv_cache import SQLiteCache, digest
+
+__all__ = [
+    "HMMCache",
+]
+
+
+class HMMCache(object):
+    """
+    Two-layer cache of HMMs keyed by the multiple sequence alignment (and sequence type) of the repeat they were
+    built from: an in-memory layer holding the most recently used HMMs, and an optional SQLite layer with pickled HMMs.
+    """
+
+    def __init__(self, path=None, max_entries=10000):
+        """
+        Parameters
+        path (str):         SQLite file for the on-disk layer, None (default) for an in-memory cache only
+        max_entries (int):  maximum number of HMMs kept in memory
+        """
+
+        self.path = path
+        self.max_entries = max_entries
+        self.memory = collections.OrderedDict()
+        self.disk = SQLiteCache(path) if path else None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(repeat):
+        """Cache key of a repeat: hash of its sequence type and msa"""
+
+        return digest(getattr(repeat, "sequence_type", "AA"), *repeat.msa)
+
+    def get_or_create(self, repeat, create):
+        """Get the HMM for a repeat from the cache, or create (and cache) it
+
+        Parameters
+        repeat (tral.repeat.repeat.Repeat):
+                            repeat to get the HMM for
+        create (function):  function that builds the HMM from the repeat, e.g.
+                            lambda repeat: hmm.HMM.create(input_format='repeat', repeat=repeat)
+
+        Returns
+        hmm (tral.hmm.hmm.HMM)
+        """
+
+        key = self.key(repeat)
+        if key in self.memory:
+            self.memory_hits += 1
+            self.memory.move_to_end(key)
+            return self.memory[key]
+
+        cached = self.disk.get(key) if self.disk is not None else None
+        if cached is not None:
+            self.disk_hits += 1
+            hmm = pickle.loads(cached)
+        else:
+            self.misses += 1
+            hmm = create(repeat)
+            if self.disk is not None:
+                self.disk.put(key, pickle.dumps(hmm))
+
+        self.memory[key] = hmm
+        if len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+        return hmm
+
+    def stats(self):
+        """Counts of this process as a dict: memory_hits, disk_hits, misses (= hmmbuild calls)"""
+
+        return {"memory_hits": self.memory_hits, "disk_hits": self.disk_hits, "misses": self.misses}
+
+    def close(self):
+        if self.disk is not None:
+            self.disk.close()
+
+    def __str__(self):
+        return "HMMCache ({} HMMs in memory{})".format(
+            len(self.memory), ", on disk at '{}'".format(self.path) if self.path else "")
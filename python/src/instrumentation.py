@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""
+Per-stage timing of the TR detection pipeline. StageTimer measures wall clock and CPU time for the named stages of one
+protein (e.g. de novo detection, p-values, clustering, refinement), RunProfiler collects these per protein records for a
+whole run and writes them to a per protein .csv file and an aggregated .json report with percentiles.
+
+Author: Max Verbiest
+Contact: max.verbiest@zhaw.ch
+"""
+
+import collections
+import contextlib
+import csv
+import json
+import os
+import time
+
+import numpy as np
+
+__all__ = [
+    "StageTimer",
+    "RunProfiler",
+]
+
+
+def cpu_time():
+    """CPU time (user + system) of this process and of its finished child processes (e.g. external TR detectors and
+    hmmbuild, which do most of the work)
+    """
+
+    times = os.times()
+    return time.process_time() + times.children_user + times.children_system
+
+
+class StageTimer(object):
+    """
+    Wall clock and CPU timers for the stages of processing one protein. Stages that are entered more than once are
+    summed. The stage that is currently running is available as current_stage. When a stage is left because of an
+    exception, current_stage keeps its value, e.g. to report where a protein got stuck.
+    """
+
+    def __init__(self):
+        self.wall = collections.OrderedDict()
+        self.cpu = collections.OrderedDict()
+        self.current_stage = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context manager timing the code in its block as stage 'name'"""
+
+        self.current_stage = name
+        wall_start, cpu_start = time.perf_counter(), cpu_time()
+        try:
+            yield
+        finally:
+            self.wall[name] = self.wall.get(name, 0.0) + time.perf_counter() - wall_start
+            self.cpu[name] = self.cpu.get(name, 0.0) + cpu_time() - cpu_start
+        self.current_stage = None
+
+    def as_dict(self):
+        return {"wall": dict(self.wall), "cpu": dict(self.cpu)}
+
+
+def percentiles(values, q=(50, 90, 99)):
+    """Summary statistics of a list of numbers"""
+
+    values = np.asarray(values, dtype=float)
+    if len(values) == 0:
+        return dict()
+    summary = {"n": int(len(values)), "total": float(values.sum()), "mean": float(values.mean())}
+    for i in q:
+        summary["p{}".format(i)] = float(np.percentile(values, i))
+    summary["max"] = float(values.max())
+    return summary
+
+
+class RunProfiler(object):
+    """
+    Collects per protein records (sequence length, repeat counts and stage timings) during a run and writes:
+        {prefix}.csv:   one row per protein with wall and CPU time for every stage
+        {prefix}.json:  per stage percentiles of wall and CPU time, throughput of the run and the slowest proteins
+    """
+
+    def __init__(self, prefix, n_slowest=20):
+        """
+        Parameters
+        prefix (str):       path prefix of the output files
+        n_slowest (int):    number of slowest proteins listed in the .json report
+        """
+
+        self.prefix = prefix
+        self.n_slowest = n_slowest
+        self.records = []
+        self.stages = []
+        self.start = time.perf_counter()
+
+    def add(self, accession, length, denovo, final, timings):
+        """Add the record of one protein
+
+        Parameters
+        accession (str):    protein identifier
+        length (int):       sequence length
+        denovo (int):       number of de novo repeats
+        final (int):        number of repeats after filtering, clustering and refinement
+        timings (dict):     {"wall": {stage: seconds}, "cpu": {stage: seconds}}, see StageTimer.as_dict()
+        """
+
+        for stage in timings["wall"]:
+            if stage not in self.stages:
+                self.stages.append(stage)
+        self.records.append({"id": accession, "length": length, "denovo": denovo, "final": final,
+                             "wall": timings["wall"], "cpu": timings["cpu"]})
+
+    def write_csv(self):
+        columns = ["id", "length", "denovo", "final", "wall_total", "cpu_total"]
+        for stage in self.stages:
+            columns += ["wall_{}".format(stage), "cpu_{}".format(stage)]
+        with open(self.prefix + ".csv", "w", newline="") as o:
+            writer = csv.writer(o)
+            writer.writerow(columns)
+            for record in self.records:
+                row = [record["id"], record["length"], record["denovo"], record["final"],
+                       "{:.6f}".format(sum(record["wall"].values())), "{:.6f}".format(sum(record["cpu"].values()))]
+                for stage in self.stages:
+                    row += ["{:.6f}".format(record["wall"].get(stage, 0.0)),
+                            "{:.6f}".format(record["cpu"].get(stage, 0.0))]
+                writer.writerow(row)
+
+    def report(self):
+        """Aggregated statistics of the run as a dict"""
+
+        elapsed = time.perf_counter() - self.start
+        residues = sum(record["length"] for record in self.records)
+        totals = [sum(record["wall"].values()) for record in self.records]
+        slowest = sorted(zip(totals, self.records), key=lambda i: -i[0])[:self.n_slowest]
+        return {
+            "proteins": len(self.records),
+            "residues": residues,
+            "elapsed_seconds": elapsed,
+            "proteins_per_second": len(self.records) / elapsed if elapsed else 0.0,
+            "residues_per_second": residues / elapsed if elapsed else 0.0,
+            "wall": {stage: percentiles([record["wall"].get(stage, 0.0) for record in self.records])
+                     for stage in self.stages},
+            "cpu": {stage: percentiles([record["cpu"].get(stage, 0.0) for record in self.records])
+                    for stage in self.stages},
+            "wall_per_protein": percentiles(totals),
+            "length": percentiles([record["length"] for record in self.records]),
+            "slowest": [{"id": record["id"], "length": record["length"], "wall": total,
+                         "stages": record["wall"]} for total, record in slowest],
+        }
+
+    def write(self):
+        """Write the per protein .csv file and the aggregated .json report"""
+
+        self.write_csv()
+        with open(self.prefix + ".json", "w") as o:
+            json.dump(self.report(), o, indent=2)
+
+    def __str__(self):
+        return "RunProfiler writing to '{0}.csv' and '{0}.json' ({1} proteins)".format(self.prefix, len(self.records))
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+"""
+Vectorized interval operations on per protein intervals (e.g. tandem repeat regions). Intervals of all proteins are
+kept in flat numpy arrays; sorting them on (protein, begin) makes the intervals of every protein a contiguous block in
+which overlapping intervals are found with binary search, in O(n log n + number of overlapping pairs).
+
+Coordinates are 1-based and inclusive, as begin and end in TRAL output.
+
+Author: Max Verbiest
+Contact: max.verbiest@zhaw.ch
+"""
+
+import numpy as np
+
+__all__ = [
+    "RULES",
+    "overlapping_pairs",
+    "cross_overlapping_pairs",
+    "resolve_overlaps",
+]
+
+# order in which overlapping intervals are kept: columns to sort on, lowest first
+RULES = {
+    "pvalue": ["pvalue", "divergence", "-length"],
+    "divergence": ["divergence", "pvalue", "-length"],
+    "length": ["-length", "pvalue", "divergence"],
+}
+
+
+def sorted_intervals(ids, begins, ends):
+    """Sort intervals on protein and begin
+
+    Returns
+    order (np.ndarray):     indices that sort the intervals
+    groups (np.ndarray):    integer protein index of every sorted interval
+    """
+
+    protein_ids, groups = np.unique(np.asarray(ids), return_inverse=True)
+    order = np.lexsort((np.asarray(ends), np.asarray(begins), groups))
+    return order, groups[order]
+
+
+def overlapping_pairs(ids, begins, ends):
+    """All pairs of overlapping intervals within the same protein
+
+    Parameters
+    ids (array-like):       protein of every interval
+    begins, ends (array-like):
+                            first and last position of every interval
+
+    Returns
+    first, second (tuple(np.ndarray, np.ndarray)):
+                            indices (into the input) of the intervals of every overlapping pair, first starts before
+                            or at the same position as second
+    """
+
+    begins, ends = np.asarray(begins, dtype=np.int64), np.asarray(ends, dtype=np.int64)
+    if len(begins) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    order, groups = sorted_intervals(ids, begins, ends)
+    # one sorted key for (protein, position), so a single binary search stays within the protein
+    span = int(max(ends.max(), begins.max())) + 2
+    keys = groups * span + begins[order]
+    # interval i overlaps all later intervals of its protein that begin at or before its end
+    last = np.searchsorted(keys, groups * span + ends[order], side="right")
+    counts = np.maximum(last - np.arange(len(order)) - 1, 0)
+    first = np.repeat(np.arange(len(order)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    second = first + 1 + offsets
+    return order[first], order[second]
+
+
+def range_pairs(keys, lower, upper):
+    """Pairs of queries and sorted keys with lower <= key < upper, for every query
+
+    Returns
+    queries, targets (tuple(np.ndarray, np.ndarray)):
+                            index of the query and of the key of every pair
+    """
+
+    first = np.searchsorted(keys, lower, side="left")
+    counts = np.maximum(np.searchsorted(keys, upper, side="left") - first, 0)
+    queries = np.repeat(np.arange(len(lower)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return queries, np.repeat(first, counts) + offsets
+
+
+def cross_overlapping_pairs(ids_a, begins_a, ends_a, ids_b, begins_b, ends_b):
+    """All pairs of overlapping intervals of two sets (e.g. tandem repeats and disordered regions) within the same
+    protein. Two intervals overlap if the one that begins last begins within the other, so every pair is found by a
+    binary search for the intervals of one set that begin within an interval of the other set
+
+    Parameters
+    ids_a, ids_b (array-like):
+                            protein of every interval in set a and set b
+    begins_a, ends_a, begins_b, ends_b (array-like):
+                            first and last position of every interval
+
+    Returns
+    a, b (tuple(np.ndarray, np.ndarray)):
+                            indices (into set a and set b) of the intervals of every overlapping pair
+    """
+
+    begins_a, ends_a = np.asarray(begins_a, dtype=np.int64), np.asarray(ends_a, dtype=np.int64)
+    begins_b, ends_b = np.asarray(begins_b, dtype=np.int64), np.asarray(ends_b, dtype=np.int64)
+    if len(begins_a) == 0 or len(begins_b) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    _, groups = np.unique(np.concatenate((np.asarray(ids_a), np.asarray(ids_b))), return_inverse=True)
+    groups_a, groups_b = groups[:len(begins_a)], groups[len(begins_a):]
+    # one sorted key for (protein, position), so a single binary search stays within the protein
+    span = int(max(ends_a.max(), ends_b.max(), begins_a.max(), begins_b.max())) + 2
+    order_a = np.argsort(groups_a * span + begins_a, kind="stable")
+    order_b = np.argsort(groups_b * span + begins_b, kind="stable")
+    keys_a = (groups_a * span + begins_a)[order_a]
+    keys_b = (groups_b * span + begins_b)[order_b]
+
+    # b begins within a (at or after the begin of a)
+    a_first, b_second = range_pairs(keys_b, groups_a * span + begins_a, groups_a * span + ends_a + 1)
+    # a begins within b (after the begin of b)
+    b_first, a_second = range_pairs(keys_a, groups_b * span + begins_b + 1, groups_b * span + ends_b + 1)
+    return (np.concatenate((a_first, order_a[a_second])),
+            np.concatenate((order_b[b_second], b_first)))
+
+
+def resolve_overlaps(ids, begins, ends, values, rule="pvalue"):
+    """Remove overlapping intervals: within a protein, intervals are kept in the order of the rule and intervals that
+    overlap a kept interval are removed
+
+    Parameters
+    ids (array-like):       protein of every interval
+    begins, ends (array-like):
+                            first and last position of every interval
+    values (dict):          columns used by the rules, e.g. {"pvalue": array, "divergence": array}. "length" is
+                            calculated from begins and ends
+    rule (str):             one of RULES: lowest p-value, lowest divergence or longest interval first
+
+    Returns
+    keep (np.ndarray):      boolean array, True for intervals that are kept
+    n_pairs (int):          number of overlapping pairs
+    """
+
+    if rule not in RULES:
+        raise ValueError("Unknown rule '{}', choose from: {}".format(rule, ", ".join(RULES)))
+    begins, ends = np.asarray(begins, dtype=np.int64), np.asarray(ends, dtype=np.int64)
+    keep = np.ones(len(begins), dtype=bool)
+    first, second = overlapping_pairs(ids, begins, ends)
+    if len(first) == 0:
+        return keep, 0
+
+    columns = dict(values, length=ends - begins + 1)
+    sort_keys = [-np.asarray(columns[name[1:]], dtype=float) if name.startswith("-")
+                 else np.asarray(columns[name], dtype=float) for name in RULES[rule]]
+    # rank of every interval in the order of the rule (np.lexsort sorts on the last key first)
+    rank = np.empty(len(begins), dtype=np.int64)
+    rank[np.lexsort(sort_keys[::-1])] = np.arange(len(begins))
+
+    # only intervals with overlaps need the greedy pass, in order of their rank
+    neighbours = dict()
+    for i, j in zip(first.tolist(), second.tolist()):
+        neighbours.setdefault(i, []).append(j)
+        neighbours.setdefault(j, []).append(i)
+    for i in sorted(neighbours, key=lambda i: rank[i]):
+        if keep[i]:
+            for j in neighbours[i]:
+                if rank[j] > rank[i]:
+                    keep[j] = False
+    return keep, len(first)
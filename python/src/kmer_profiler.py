@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+"""
+Compositional background of proteins: counts of all k-mers (k = 1-4) per region class, e.g. inside STRs, inside
+intrinsically disordered regions (IDRs), inside signal peptides or elsewhere. Regions are read from any number of
+interval tables (ID, begin, end), sequences are streamed from a fasta file in batches that are counted in worker
+processes, so memory use is bounded by the interval tables and a few batches of sequences.
+
+Counting is vectorized as in src/dipeptide_counter.py: every residue gets the class of the first table (in the order
+the tables are given) with a region that covers it, or 'other'. A k-mer belongs to the first class of any of its
+residues, so k-mers that overlap a region are counted for that region (for k = 2 and a single STR table, this matches
+the inside/outside STR counts of dipeptide_counts.py). K-mers with a residue that is not a standard amino acid are not
+counted.
+
+Author: Max Verbiest
+Contact: max.verbiest@zhaw.ch
+"""
+
+import concurrent.futures
+import itertools
+
+import numpy as np
+
+try:
+    from src.sequence_encoding import AMINO_ACIDS, UNKNOWN, encode
+    from src.dipeptide_counter import str_mask
+except ModuleNotFoundError:
+    from sequence_encoding import AMINO_ACIDS, UNKNOWN, encode
+    from dipeptide_counter import str_mask
+
+__all__ = [
+    "OTHER",
+    "read_intervals",
+    "kmer_names",
+    "KmerProfiler",
+    "load_profile",
+]
+
+OTHER = "other"
+_ALPHABET = len(AMINO_ACIDS)
+
+
+def protein_id(identifier):
+    """UniProt accession from a fasta style identifier ('sp|P12345|NAME_HUMAN'), other identifiers are kept"""
+
+    fields = identifier.split("|")
+    return fields[1] if len(fields) == 3 else identifier
+
+
+def read_intervals(path):
+    """Read an interval table: a tab separated file with protein ID, first and last position (1-based, inclusive) of
+    every region. Files with a header line (e.g. merged TRAL output) are read from their ID, begin and end columns, end
+    is calculated from repeat_region_length if there is no end column. Files without header (e.g. disorder annotation
+    or signal peptide output) are read from their first three columns
+
+    Returns
+    regions (dict):     protein ID -> (begins, ends) arrays
+    """
+
+    regions = dict()
+    with open(path, "r") as f:
+        first_line = f.readline().rstrip("\n").split("\t")
+        if len(first_line) > 1 and first_line[1].isdigit():
+            columns = lambda fields: (fields[0], int(fields[1]), int(fields[2]))
+            lines = itertools.chain(["\t".join(first_line)], f)
+        else:
+            id_column, begin_column = first_line.index("ID"), first_line.index("begin")
+            if "end" in first_line:
+                end_column = first_line.index("end")
+                columns = lambda fields: (fields[id_column], int(fields[begin_column]), int(fields[end_column]))
+            else:
+                length_column = first_line.index("repeat_region_length")
+                columns = lambda fields: (fields[id_column], int(fields[begin_column]),
+                                          int(fields[begin_column]) + int(fields[length_column]) - 1)
+            lines = f
+        for line in lines:
+            if not line.strip():
+                continue
+            prot_id, begin, end = columns(line.rstrip("\n").split("\t"))
+            begins, ends = regions.setdefault(protein_id(prot_id), ([], []))
+            begins.append(begin)
+            ends.append(end)
+    return {prot_id: (np.array(begins, dtype=np.int64), np.array(ends, dtype=np.int64))
+            for prot_id, (begins, ends) in regions.items()}
+
+
+def kmer_names(k):
+    """All k-mers in the order of their code (the columns of the count matrices)"""
+
+    return ["".join(kmer) for kmer in itertools.product(AMINO_ACIDS, repeat=k)]
+
+
+def count_batch(proteins, regions, k_values, n_classes):
+    """Count k-mers per region class in a batch of proteins
+
+    Parameters
+    proteins (list[tuple(str, str)]):
+                        (ID, sequence) of every protein
+    regions (list[dict]):
+                        for every region class (in order of priority), protein ID -> (begins, ends) of the proteins
+                        in the batch
+    k_values (list[int]):
+                        k-mer lengths
+    n_classes (int):    number of region classes, including 'other'
+
+    Returns
+    counts (dict):      k -> array (n_classes, 20^k) with k-mer counts
+    """
+
+    max_k = max(k_values)
+    # unknown residues between proteins, so no k-mer spans two proteins
+    separator = "X" * max_k
+    sequence_lengths = {prot_id: len(sequence) for prot_id, sequence in proteins}
+    lengths = np.array([len(sequence) + max_k for _, sequence in proteins], dtype=np.int64)
+    offsets = dict(zip([prot_id for prot_id, _ in proteins], np.concatenate(([0], np.cumsum(lengths)[:-1]))))
+    codes = encode(separator.join(sequence for _, sequence in proteins) + separator).astype(np.int64)
+
+    # class of every residue: highest priority (lowest index) region that covers it
+    residue_classes = np.full(len(codes), n_classes - 1, dtype=np.int64)
+    for index in reversed(range(len(regions))):
+        prot_ids = [prot_id for prot_id in regions[index] if prot_id in offsets]
+        if not prot_ids:
+            continue
+        begins = np.concatenate([regions[index][prot_id][0] for prot_id in prot_ids])
+        ends = np.concatenate([regions[index][prot_id][1] for prot_id in prot_ids])
+        n_regions = [len(regions[index][prot_id][0]) for prot_id in prot_ids]
+        region_offsets = np.repeat([offsets[prot_id] for prot_id in prot_ids], n_regions)
+        # regions that extend beyond the end of a sequence (e.g. annotation of another isoform) are cut at its end
+        ends = np.minimum(ends, np.repeat([sequence_lengths[prot_id] for prot_id in prot_ids], n_regions))
+        residue_classes[str_mask(len(codes), begins, ends, region_offsets)] = index
+
+    counts = dict()
+    kmers = np.zeros(len(codes), dtype=np.int64)
+    unknown = np.zeros(len(codes), dtype=bool)
+    kmer_classes = np.full(len(codes), n_classes - 1, dtype=np.int64)
+    for k in range(1, max_k + 1):
+        # extend the k-1-mers that start at every position with the residue k-1 positions further
+        n = len(codes) - k + 1
+        kmers = kmers[:n] * _ALPHABET + codes[k - 1:]
+        unknown = unknown[:n] | (codes[k - 1:] == UNKNOWN)
+        kmer_classes = np.minimum(kmer_classes[:n], residue_classes[k - 1:])
+        if k in k_values:
+            n_kmers = _ALPHABET ** k
+            counts[k] = np.bincount((kmer_classes * n_kmers + kmers)[~unknown],
+                                    minlength=n_classes * n_kmers).reshape(n_classes, n_kmers)
+    return counts
+
+
+class KmerProfiler(object):
+    """
+    K-mer counts per region class, accumulated over batches of proteins
+    """
+
+    def __init__(self, k_values=(1, 2), regions=None):
+        """
+        Parameters
+        k_values (iterable[int]):
+                            k-mer lengths (1-4)
+        regions (dict):     region class name -> regions (see read_intervals()). Classes are assigned in the order
+                            of this dict, residues outside of all regions are in class OTHER
+        """
+
+        self.k_values = sorted(set(k_values))
+        if not self.k_values or self.k_values[0] < 1 or self.k_values[-1] > 4:
+            raise ValueError("k-mer lengths have to be between 1 and 4, got: {}".format(self.k_values))
+        self.regions = dict(regions) if regions else dict()
+        if OTHER in self.regions:
+            raise ValueError("'{}' is reserved for residues outside of all regions".format(OTHER))
+        self.classes = list(self.regions) + [OTHER]
+        self.counts = {k: np.zeros((len(self.classes), _ALPHABET ** k), dtype=np.int64) for k in self.k_values}
+        self.n_proteins = 0
+        self.n_residues = 0
+
+    def batch_regions(self, proteins):
+        """Regions of the proteins in a batch, for every region class"""
+
+        return [{prot_id: regions[prot_id] for prot_id, _ in proteins if prot_id in regions}
+                for regions in self.regions.values()]
+
+    def add_counts(self, proteins, counts):
+        for k in self.k_values:
+            self.counts[k] += counts[k]
+        self.n_proteins += len(proteins)
+        self.n_residues += sum(len(sequence) for _, sequence in proteins)
+
+    def add(self, proteins):
+        """Count the k-mers of a batch of (ID, sequence) tuples in this process"""
+
+        if proteins:
+            self.add_counts(proteins, count_batch(proteins, self.batch_regions(proteins), self.k_values,
+                                                  len(self.classes)))
+
+    def profile(self, proteins, batch_size=10000, workers=1):
+        """Count the k-mers of all proteins
+
+        Parameters
+        proteins (iterable[tuple(str, str)]):
+                            (ID, sequence) of every protein, read lazily
+        batch_size (int):   number of proteins per batch
+        workers (int):      number of worker processes. Only 2 batches per worker are read ahead, so at most
+                            2 * workers batches are in memory
+        """
+
+        proteins = iter(proteins)
+        batches = iter(lambda: list(itertools.islice(proteins, batch_size)), [])
+        if workers <= 1:
+            for batch in batches:
+                self.add(batch)
+            return
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            running = dict()
+            for batch in batches:
+                if len(running) >= 2 * workers:
+                    # wait for a batch to finish before reading the next one
+                    done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        self.add_counts(running.pop(future), future.result())
+                future = executor.submit(count_batch, batch, self.batch_regions(batch), self.k_values,
+                                         len(self.classes))
+                running[future] = batch
+            for future in concurrent.futures.as_completed(running):
+                self.add_counts(running[future], future.result())
+
+    def write(self, output_file):
+        """Write the count matrices to a compressed .npz file: counts_k{k} (classes x k-mers in the order of
+        kmer_names(k)), classes and the number of proteins and residues
+        """
+
+        np.savez_compressed(output_file, classes=np.array(self.classes), k_values=np.array(self.k_values),
+                            n_proteins=self.n_proteins, n_residues=self.n_residues,
+                            **{"counts_k{}".format(k): counts for k, counts in self.counts.items()})
+
+
+def load_profile(path):
+    """Load a profile written by KmerProfiler.write()
+
+    Returns
+    classes (list[str]):    region classes (rows of the count matrices)
+    counts (dict):          k -> count matrix (columns in the order of kmer_names(k))
+    """
+
+    with np.load(path) as profile:
+        return (profile["classes"].tolist(),
+                {int(k): profile["counts_k{}".format(k)] for k in profile["k_values"]})
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+"""
+Persistent key-value cache backed by a local SQLite database, with size and age based eviction and hit/miss
+statistics. Used to avoid recomputing results for inputs (e.g. protein sequences) that have not changed between runs.
+
+Author: Max Verbiest
+Contact: max.verbiest@zhaw.ch
+"""
+
+import hashlib
+import sqlite3
+import time
+
+__all__ = [
+    "SQLiteCache",
+    "digest",
+]
+
+
+def digest(*parts):
+    """Content hash (sha256, hex) of one or more strings, used as cache key"""
+
+    hasher = hashlib.sha256()
+    for part in parts:
+        hasher.update(part.encode("utf-8"))
+        # separator, so ("ab", "c") and ("a", "bc") give different digests
+        hasher.update(b"\0")
+    return hasher.hexdigest()
+
+
+class SQLiteCache(object):
+    """
+    Key-value store in a SQLite database. Values are str or bytes. Every entry keeps track of its size and of when it
+    was stored and last used: entries older than ttl are treated as missing, and when the cache grows beyond
+    max_bytes the least recently used entries are evicted.
+    """
+
+    def __init__(self, path, max_bytes=None, ttl=None, evict_interval=1000):
+        """
+        Parameters
+        path (str):         path to the SQLite database file (created if it does not exist)
+        max_bytes (int):    maximum total size of stored values, None (default) for no limit
+        ttl (float):        time in seconds after which an entry expires, None (default) for no expiration
+        evict_interval (int):
+                            number of stored entries after which eviction is checked (it is always checked when the
+                            cache is closed)
+        """
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.evict_interval = evict_interval
+        self.connection = sqlite3.connect(path, timeout=60)
+        # write-ahead logging: readers do not block the writer, several processes can share one cache
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries "
+            "(key TEXT PRIMARY KEY, value BLOB, size INTEGER, created REAL, accessed REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+        self.connection.commit()
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evicted = 0
+
+    def get(self, key):
+        """Look up a key
+
+        Returns
+        value (str or bytes):
+                    stored value, or None if the key is not in the cache (or expired)
+        """
+
+        row = self.connection.execute("SELECT value, created FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None or (self.ttl is not None and time.time() - row[1] > self.ttl):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.connection.execute("UPDATE entries SET accessed = ? WHERE key = ?", (time.time(), key))
+        self.connection.commit()
+        return row[0]
+
+    def put(self, key, value):
+        """Store a value (str or bytes) under key, replacing any previous value"""
+
+        now = time.time()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO entries (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+            (key, value, len(value), now, now))
+        self.connection.commit()
+        self.stored += 1
+        if self.stored % self.evict_interval == 0:
+            self.evict()
+
+    def evict(self):
+        """Remove expired entries and, if the cache is larger than max_bytes, the least recently used entries until
+        it fits again
+        """
+
+        if self.ttl is not None:
+            cursor = self.connection.execute("DELETE FROM entries WHERE created < ?", (time.time() - self.ttl,))
+            self.evicted += cursor.rowcount
+        if self.max_bytes is not None:
+            excess = self.size() - self.max_bytes
+            if excess > 0:
+                freed = 0
+                keys = []
+                for key, size in self.connection.execute("SELECT key, size FROM entries ORDER BY accessed"):
+                    keys.append((key,))
+                    freed += size
+                    if freed >= excess:
+                        break
+                self.connection.executemany("DELETE FROM entries WHERE key = ?", keys)
+                self.evicted += len(keys)
+        self.connection.commit()
+
+    def size(self):
+        """Total size (bytes) of all stored values"""
+
+        return self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def stats(self):
+        """Usage statistics of this session"""
+
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "stored": self.stored,
+            "evicted": self.evicted,
+            "entries": len(self),
+            "bytes": self.size(),
+        }
+
+    def report(self):
+        """Stats as a printable string"""
+
+        return "Cache '{path}': {hits} hits, {misses} misses (hit rate {hit_rate:.1%}), {stored} stored, " \
+               "{evicted} evicted, {entries} entries ({bytes} bytes)".format(path=self.path, **self.stats())
+
+    def close(self):
+        self.evict()
+        self.connection.commit()
+        self.connection.close()
+
+    def __str__(self):
+        return "SQLiteCache at '{}'".format(self.path)
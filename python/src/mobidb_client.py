@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+"""
+Concurrent client for the MobiDB web API. Requests are spread over a pool of threads that each keep one HTTP
+keep-alive connection open, the request rate is limited with a token bucket, and transient errors (connection errors,
+timeouts, HTTP 429 and 5xx) are retried with exponential backoff. Accessions that are not in MobiDB (HTTP 404) are
+reported separately from requests that failed. Results are returned in input order.
+
+Author: Max Verbiest
+Contact: max.verbiest@zhaw.ch
+"""
+
+import collections
+import concurrent.futures
+import http.client
+import itertools
+import json
+import random
+import threading
+import time
+import urllib.parse
+
+__all__ = [
+    "MOBIDB_URL",
+    "TokenBucket",
+    "MobiDBResult",
+    "MobiDBClient",
+    "FOUND",
+    "NOT_FOUND",
+    "FAILED",
+]
+
+MOBIDB_URL = "https://mobidb.bio.unipd.it/api/download"
+
+# status of a MobiDB query
+FOUND = "found"
+NOT_FOUND = "not_found"
+FAILED = "failed"
+
+MobiDBResult = collections.namedtuple("MobiDBResult", ["accession", "status", "data", "error", "attempts"])
+MobiDBResult.__doc__ = """Result of a MobiDB query: status is 'found' (data is the decoded JSON entry), 'not_found'
+(HTTP 404) or 'failed' (error describes the last error)"""
+
+
+class TransientError(Exception):
+    """Error after which a request can be retried"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket: on average at most rate acquisitions per second, with bursts of up to burst
+    """
+
+    def __init__(self, rate, burst=1):
+        """
+        Parameters
+        rate (float):   tokens added per second
+        burst (int):    maximum number of tokens in the bucket
+        """
+
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take one token, waiting until one is available"""
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class MobiDBClient(object):
+    """
+    Thread pooled MobiDB client, see module docstring
+    """
+
+    def __init__(self, base_url=MOBIDB_URL, projection="prediction-disorder-mobidb_lite", concurrency=8, rate=10,
+                 retries=5, backoff=0.5, timeout=30):
+        """
+        Parameters
+        base_url (str):     URL of the MobiDB download endpoint (e.g. a local server for testing)
+        projection (str):   MobiDB projection, the part of the entries that is retrieved
+        concurrency (int):  number of concurrent requests (threads, each with its own connection)
+        rate (float):       maximum number of requests per second, None for no limit
+        retries (int):      number of retries of a request after a transient error
+        backoff (float):    wait before the first retry in seconds, doubled (with jitter) for every next retry
+        timeout (float):    timeout of a single request in seconds
+        """
+
+        url = urllib.parse.urlsplit(base_url)
+        if url.scheme not in {"http", "https"}:
+            raise ValueError("MobiDB URL has to start with http:// or https://, got: {}".format(base_url))
+        self.base_url = base_url
+        self.scheme, self.host, self.path = url.scheme, url.netloc, url.path or "/"
+        self.projection = projection
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate, burst=concurrency) if rate else None
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.local = threading.local()
+        self.connections = []
+        self.connections_lock = threading.Lock()
+
+    def connection(self):
+        """Keep-alive connection of the current thread"""
+
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection_class = http.client.HTTPSConnection if self.scheme == "https" else http.client.HTTPConnection
+            connection = connection_class(self.host, timeout=self.timeout)
+            self.local.connection = connection
+            with self.connections_lock:
+                self.connections.append(connection)
+        return connection
+
+    def reset_connection(self):
+        """Close the connection of the current thread, the next request opens a new one"""
+
+        connection = getattr(self.local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+    def request_path(self, accession):
+        query = {"acc": accession, "format": "json"}
+        if self.projection:
+            query["projection"] = self.projection
+        return "{}?{}".format(self.path, urllib.parse.urlencode(query, safe=",-_"))
+
+    def request(self, accession):
+        """Send one request for an accession
+
+        Returns
+        status (str), data (dict):
+                        FOUND and the decoded entry, or NOT_FOUND and None
+
+        Raises
+        TransientError: for errors after which the request can be retried
+        ValueError:     for other HTTP errors and responses that can not be decoded
+        """
+
+        if self.bucket:
+            self.bucket.acquire()
+        try:
+            connection = self.connection()
+            connection.request("GET", self.request_path(accession), headers={"Accept": "application/json"})
+            response = connection.getresponse()
+            # the body has to be read completely before the connection can be reused
+            body = response.read()
+        except (OSError, http.client.HTTPException) as err:
+            self.reset_connection()
+            raise TransientError("{}: {}".format(type(err).__name__, err))
+        if response.getheader("Connection", "").lower() == "close":
+            self.reset_connection()
+
+        if response.status == 404:
+            return NOT_FOUND, None
+        if response.status == 429 or response.status >= 500:
+            retry_after = response.getheader("Retry-After")
+            raise TransientError("HTTP {} {}".format(response.status, response.reason),
+                                 retry_after=float(retry_after) if retry_after and retry_after.isdigit() else None)
+        if response.status != 200:
+            raise ValueError("HTTP {} {}".format(response.status, response.reason))
+        return FOUND, json.loads(body.decode("utf-8")) if body.strip() else dict()
+
+    def fetch(self, accession):
+        """Query MobiDB for one accession, retrying transient errors
+
+        Returns
+        result (MobiDBResult)
+        """
+
+        for attempt in range(1, self.retries + 2):
+            try:
+                status, data = self.request(accession)
+                return MobiDBResult(accession, status, data, None, attempt)
+            except TransientError as err:
+                error = str(err)
+                if attempt > self.retries:
+                    break
+                wait = err.retry_after if err.retry_after is not None else \
+                    self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+                time.sleep(wait)
+            except ValueError as err:
+                return MobiDBResult(accession, FAILED, None, str(err), attempt)
+        return MobiDBResult(accession, FAILED, None, error, self.retries + 1)
+
+    def fetch_all(self, accessions, lookup=None):
+        """Query MobiDB for all accessions with concurrent requests
+
+        Parameters
+        accessions (iterable[str]):
+                        accessions, read lazily. At most 4 requests per thread are queued ahead of the result that is
+                        yielded next
+        lookup (callable):
+                        If given, called (in the calling thread) with every accession before it is queried. If it
+                        returns a MobiDBResult (e.g. from a cache), that result is used instead of querying MobiDB
+
+        Yields
+        result (MobiDBResult):
+                        one result per accession, in input order
+        """
+
+        def submit(accession):
+            result = lookup(accession) if lookup else None
+            if result is None:
+                return executor.submit(self.fetch, accession)
+            future = concurrent.futures.Future()
+            future.set_result(result)
+            return future
+
+        accessions = iter(accessions)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            pending = collections.deque(submit(accession)
+                                        for accession in itertools.islice(accessions, 4 * self.concurrency))
+            while pending:
+                result = pending.popleft().result()
+                for accession in itertools.islice(accessions, 1):
+                    pending.append(submit(accession))
+                yield result
+
+    def close(self):
+        """Close the connections of all threads"""
+
+        with self.connections_lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""
+Cheap periodicity pre-screen for protein sequences. A tandem repeat with unit length l and n_effective >= n is a region
+of n * l residues where every residue is (mostly) identical to the residue l positions further. For every period l up
+to max_period, the sequence is compared to itself shifted by l and the best window of (n - 1) * l comparisons (at
+least min_length - l, short repeats are never significant) is checked for a minimal fraction of identical residues.
+Proteins without any such window are unlikely to contain a TR that passes the n_effective, divergence and p-value
+filters of run_tral.py, and skip TRAL. This is a heuristic: repeats with insertions or deletions do not line up with
+the sequence shifted by l, and TRAL's alignment-based divergence and p-value do not follow from per-column identity.
+With the default settings, validate_prescreen.py misses none of the 3699 TRs in data_for_sub/str_sp_final.tsv (unit
+lengths 1 and 2, each checked on its own region), which is a sample, not a guarantee.
+
+Author: Max Verbiest
+Contact: max.verbiest@zhaw.ch
+"""
+
+import numpy as np
+
+try:
+    from src.sequence_encoding import encode, UNKNOWN
+except ModuleNotFoundError:
+    from sequence_encoding import encode, UNKNOWN
+
+__all__ = [
+    "Prescreen",
+]
+
+
+class Prescreen(object):
+    """
+    Periodicity screen on integer encoded sequences. All comparisons for one period are done in a single vectorized
+    operation, so the screen costs O(length * max_period) numpy work per protein, which is negligible compared to TRAL
+    de novo detection.
+    """
+
+    def __init__(self, max_period=100, min_identity=0.7, n_threshold=2.5, min_length=6):
+        """
+        Parameters
+        max_period (int):   longest repeat unit that is screened for. TRs with longer units are not detected
+        min_identity (float):
+                            minimal fraction of identical residues between neighbouring repeat units. Low values
+                            keep more proteins (TRs with indels break the shifted comparison, so this should be
+                            well below 1 - divergence threshold)
+        n_threshold (float):
+                            minimal number of repeat units (same as the n_effective filter of run_tral.py)
+        min_length (int):   minimal length of a repeat region. Shorter regions do not pass the p-value filter
+        """
+
+        self.max_period = max_period
+        self.min_identity = min_identity
+        self.n_threshold = n_threshold
+        self.min_length = min_length
+
+    def window_identities(self, sequence):
+        """For every period, the fraction of identical residues in the best window of comparisons between residues
+        that are one period apart
+
+        Parameters
+        sequence (str):     protein sequence
+
+        Yields
+        period, identity (tuple(int, float)):
+                            periods for which the sequence is long enough to contain a window
+        """
+
+        codes = encode(sequence)
+        for period in range(1, self.max_period + 1):
+            window = max(int(np.ceil((self.n_threshold - 1) * period)), self.min_length - period)
+            if len(codes) - period < window:
+                return
+            matches = (codes[:-period] == codes[period:]) & (codes[period:] != UNKNOWN)
+            cumulative = np.concatenate(([0], np.cumsum(matches, dtype=np.int64)))
+            yield period, (cumulative[window:] - cumulative[:-window]).max() / window
+
+    def best_period(self, sequence):
+        """Period with the highest identity in its best window, (0, 0.0) if the sequence is too short for any window"""
+
+        return max(self.window_identities(sequence), key=lambda i: i[1], default=(0, 0.0))
+
+    def passes(self, sequence):
+        """Can the sequence contain a tandem repeat that passes the filters? Stops at the first period that passes"""
+
+        return any(identity >= self.min_identity for _, identity in self.window_identities(sequence))
+
+    def __str__(self):
+        return "Prescreen(max_period={}, min_identity={}, n_threshold={}, min_length={})".format(
+            self.max_period, self.min_identity, self.n_threshold, self.min_length)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""
+Store of all unfiltered de novo repeats and their cpHMM refined versions, with all statistics, so that other filter
+thresholds can be applied afterwards without running TRAL again (see refilter.py). During a run, rows are appended to
+a gzipped table; for re-filtering this is converted once to a compressed columnar .npz file with one numpy array per
+column.
+
+Author: Max Verbiest
+Contact: max.verbiest@zhaw.ch
+"""
+
+import gzip
+import os
+
+import numpy as np
+
+__all__ = [
+    "RAW_HEADER",
+    "raw_rows",
+    "RawRepeatStore",
+    "load_columns",
+]
+
+RAW_HEADER = ["ID",
+              "stage",
+              "index",
+              "detector",
+              "begin",
+              "msa_original",
+              "l_effective",
+              "n_effective",
+              "repeat_region_length",
+              "divergence",
+              "pvalue",
+              "overlaps_denovo"]
+
+# numpy type of every column in the .npz store
+_COLUMN_TYPES = {"ID": str, "stage": str, "index": np.int32, "detector": str, "begin": np.int32,
+                 "msa_original": str, "l_effective": np.int32, "n_effective": np.float64,
+                 "repeat_region_length": np.int32, "divergence": np.float64, "pvalue": np.float64,
+                 "overlaps_denovo": bool}
+
+
+def raw_rows(denovo_repeats, refined, score="phylo_gap01"):
+    """Rows (without ID column) for the raw store
+
+    Parameters
+    denovo_repeats (list[tral.repeat.repeat.Repeat]):
+                    all de novo repeats of a protein, the position in this list is their index
+    refined (list[tuple(int, tral.repeat.repeat.Repeat, bool)]):
+                    (index of the de novo repeat, repeat found with its cpHMM, does it overlap the de novo repeat)
+    score (str):    model used for divergence and p-value
+
+    Returns
+    rows (list[list[str]]):
+                    stage "denovo" rows for all de novo repeats, followed by stage "refined" rows
+    """
+
+    def row(stage, index, tr, overlaps):
+        return [str(i) for i in [stage, index, getattr(tr, "TRD", ""), tr.begin, ",".join(tr.msa), tr.l_effective,
+                                 tr.n_effective, tr.repeat_region_length, tr.divergence(score), tr.pvalue(score),
+                                 int(overlaps)]]
+
+    rows = [row("denovo", index, tr, False) for index, tr in enumerate(denovo_repeats)]
+    rows += [row("refined", index, tr, overlaps) for index, tr, overlaps in refined]
+    return rows
+
+
+class RawRepeatStore(object):
+    """
+    Append-only gzipped table with the raw repeats of every protein (columns RAW_HEADER). Every call to add() appends
+    a complete gzip member, so the file stays readable when a run is interrupted. Proteins that are added more than
+    once (redone after resuming a run) are only read with their last rows.
+    """
+
+    def __init__(self, path, resume=False):
+        """
+        Parameters
+        path (str):     .tsv.gz file
+        resume (bool):  If True, append to an existing file. If False (default), start a new file
+        """
+
+        self.path = path
+        if not resume or not os.path.isfile(path):
+            with gzip.open(path, "wt") as o:
+                o.write("\t".join(RAW_HEADER) + "\n")
+
+    def add(self, accession, rows):
+        """Append the raw repeats of one protein"""
+
+        with gzip.open(self.path, "at") as o:
+            o.write("".join("{}\t{}\n".format(accession, "\t".join(row)) for row in rows))
+
+    def __str__(self):
+        return "RawRepeatStore at '{}'".format(self.path)
+
+
+def read_rows(path):
+    """Read the rows of a raw store, keeping only the last rows of every protein. Reading stops at a truncated end"""
+
+    proteins = dict()
+    try:
+        with gzip.open(path, "rt") as f:
+            next(f)
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                row = line.rstrip("\n").split("\t")
+                if row[1] == "denovo" and row[2] == "0":
+                    # the rows of a protein start with its first de novo repeat, a new block replaces earlier ones
+                    proteins[row[0]] = []
+                proteins.setdefault(row[0], []).append(row)
+    except (EOFError, OSError):
+        pass
+    return [row for rows in proteins.values() for row in rows]
+
+
+def compact(path, npz_path):
+    """Convert a raw store to a compressed columnar .npz file"""
+
+    rows = read_rows(path)
+    columns = dict()
+    for i, name in enumerate(RAW_HEADER):
+        values = [row[i] for row in rows]
+        if _COLUMN_TYPES[name] is bool:
+            columns[name] = np.array([value == "1" for value in values], dtype=bool)
+        elif _COLUMN_TYPES[name] is str:
+            columns[name] = np.array(values, dtype=str)
+        else:
+            columns[name] = np.array(values, dtype=float).astype(_COLUMN_TYPES[name])
+    np.savez_compressed(npz_path, **columns)
+
+
+def load_columns(path):
+    """Load a raw store as dict of numpy arrays (one per column of RAW_HEADER). The columnar version ({path}.npz) is
+    made on first use and remade when the raw store has changed since
+    """
+
+    npz_path = path + ".npz"
+    if not os.path.isfile(npz_path) or os.path.getmtime(npz_path) < os.path.getmtime(path):
+        compact(path, npz_path)
+    with np.load(npz_path) as store:
+        return {name: store[name] for name in RAW_HEADER}
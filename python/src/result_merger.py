@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+"""
+Incremental merging of per protein TRAL output files (run_tral.py, find_trs.py) into one file with an ID column. A
+manifest next to the merged file records the size and modification time of every merged file and where its lines are
+in the merged file, so merging again after a partial rerun only reads the files that are new or have changed:
+    - only new files: their lines are appended to the merged file
+    - changed or removed files: the merged file is rewritten, copying the lines of unchanged files from the previous
+      merged file instead of reading every per protein file again
+Result directories are listed with os.scandir(), all writes go through large buffers.
+
+Author: Max Verbiest
+Contact: max.verbiest@zhaw.ch
+"""
+
+import os
+
+__all__ = [
+    "scan_result_files",
+    "merge_result_files",
+]
+
+# buffer size for reading and writing merged files
+_BUFFER_SIZE = 1 << 22
+
+
+def scan_result_files(directories, exclude=("merged.tsv",)):
+    """Find all per protein .tsv files in directories
+
+    Parameters
+    directories (list[str]):    result directories
+    exclude (tuple(str)):       file names that are not per protein results (previously merged output)
+
+    Returns
+    files (dict):               path -> (size, modification time in ns), in order of directories and file names
+    """
+
+    files = dict()
+    for directory in directories:
+        with os.scandir(directory) as entries:
+            found = [(entry.path, entry.stat()) for entry in entries
+                     if entry.name.endswith(".tsv") and entry.name not in exclude and entry.is_file()]
+        for path, stat in sorted(found):
+            files[path] = (stat.st_size, stat.st_mtime_ns)
+    return files
+
+
+def protein_lines(path):
+    """Lines of a per protein result file with ID column (the ID is taken from the file name)
+
+    Returns
+    header (str):   header line of the file (without ID column)
+    content (str):  all other lines, with ID column
+    """
+
+    prot_id = os.path.basename(path).split(".")[0]
+    with open(path, "r") as f:
+        header = f.readline()
+        content = f.read()
+    if not header.startswith("begin"):
+        raise ValueError("File layout different than expected: {}".format(path))
+    if content and not content.endswith("\n"):
+        content += "\n"
+    prefix = prot_id + "\t"
+    return header.rstrip("\n") + "\n", "".join(prefix + line for line in content.splitlines(True))
+
+
+class MergeManifest(object):
+    """
+    Manifest of a merged file ({merged file}.manifest.txt). The first line describes the merged file itself, every
+    other line one merged result file:
+        path\tsize\tmtime_ns\toffset\tlength\n
+    where offset and length locate the lines of the result file (in bytes) in the merged file. The manifest is only
+    trusted if the merged file still has the size and modification time it had when the manifest was written.
+    """
+
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self.path = output_file + ".manifest.txt"
+        self.entries = dict()
+        self.valid = self.read()
+
+    def read(self):
+        """Read the manifest, returns False if there is no manifest or it does not match the merged file"""
+
+        if not os.path.isfile(self.path) or not os.path.isfile(self.output_file):
+            return False
+        with open(self.path, "r") as f:
+            lines = f.read().splitlines()
+        if not lines:
+            return False
+        _, size, mtime = lines[0].split("\t")[:3]
+        stat = os.stat(self.output_file)
+        if (stat.st_size, stat.st_mtime_ns) != (int(size), int(mtime)):
+            return False
+        for line in lines[1:]:
+            path, size, mtime, offset, length = line.split("\t")
+            self.entries[path] = (int(size), int(mtime), int(offset), int(length))
+        return True
+
+    def write(self, entries):
+        """Write the manifest for the merged file as it is now
+
+        Parameters
+        entries (dict): path -> (size, mtime_ns, offset, length)
+        """
+
+        stat = os.stat(self.output_file)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", buffering=_BUFFER_SIZE) as o:
+            o.write("{}\t{}\t{}\n".format(self.output_file, stat.st_size, stat.st_mtime_ns))
+            for path, entry in entries.items():
+                o.write("{}\t{}\n".format(path, "\t".join(str(i) for i in entry)))
+        os.replace(tmp_path, self.path)
+        self.entries = dict(entries)
+        self.valid = True
+
+
+def merge_result_files(directories, output_file, incremental=True):
+    """Merge all per protein result files in directories into output_file, using its manifest to only read new and
+    changed files
+
+    Parameters
+    directories (list[str]):    result directories
+    output_file (str):          merged file (ID column followed by the columns of the result files)
+    incremental (bool):         If False, the merged file is rebuilt from all result files
+
+    Returns
+    counts (dict):              number of result files that were unchanged, added, replaced and removed
+    """
+
+    files = scan_result_files(directories, exclude=(os.path.basename(output_file),))
+    if not files:
+        raise ValueError("No result files found in: {}".format(", ".join(directories)))
+    manifest = MergeManifest(output_file)
+    previous = manifest.entries if incremental and manifest.valid else dict()
+
+    unchanged = [path for path, entry in previous.items() if files.get(path) == entry[:2]]
+    changed = [path for path in previous if path in files and files[path] != previous[path][:2]]
+    added = [path for path in files if path not in previous]
+    counts = {"unchanged": len(unchanged), "added": len(added), "replaced": len(changed),
+              "removed": len(previous) - len(unchanged) - len(changed)}
+
+    entries = {path: previous[path] for path in unchanged}
+    if previous and len(unchanged) == len(previous):
+        # nothing changed or was removed: only append new files
+        offset = os.path.getsize(output_file)
+        with open(output_file, "ab", buffering=_BUFFER_SIZE) as o:
+            for path in added:
+                content = protein_lines(path)[1].encode()
+                o.write(content)
+                entries[path] = files[path] + (offset, len(content))
+                offset += len(content)
+    else:
+        # rewrite: copy the lines of unchanged files from the previous merged file (in their previous order), read
+        # only the other files
+        tmp_file = output_file + ".tmp"
+        old = open(output_file, "rb") if previous else None
+        try:
+            header = old.readline() if old else None
+            with open(tmp_file, "wb", buffering=_BUFFER_SIZE) as o:
+                offset = 0
+                for path in [path for path in previous if path in files] + added:
+                    if path in entries:
+                        _, _, old_offset, length = previous[path]
+                        old.seek(old_offset)
+                        content = old.read(length)
+                    else:
+                        file_header, content = protein_lines(path)
+                        content = content.encode()
+                    if header is None:
+                        header = ("ID\t" + file_header).encode()
+                    if offset == 0:
+                        o.write(header)
+                        offset = len(header)
+                    o.write(content)
+                    entries[path] = files[path] + (offset, len(content))
+                    offset += len(content)
+        finally:
+            if old:
+                old.close()
+        os.replace(tmp_file, output_file)
+    manifest.write(entries)
+    return counts
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""
+Writing of detected tandem repeats. Besides formatting repeats as rows, this module contains a streaming writer that
+appends the repeats of all proteins (with an ID column) to one results file, instead of writing one small file per
+protein that has to be merged afterwards.
+
+Author: Max Verbiest
+Contact: max.verbiest@zhaw.ch
+"""
+
+import os
+
+__all__ = [
+    "HEADER",
+    "repeat_rows",
+    "StreamingResultWriter",
+]
+
+HEADER = ["begin",
+          "msa_original",
+          "l_effective",
+          "n_effective",
+          "repeat_region_length",
+          "divergence",
+          "pvalue"]
+
+
+def repeat_rows(tr_list, score="phylo_gap01"):
+    """Convert all tandem repeats from a RepeatList to rows of strings, one per repeat, in the column order of
+    HEADER
+
+    Parameters
+    tr_list (tral.repeat_list.RepeatList):
+                    A list of TRs to be converted
+    score (str):    Model used for divergence and p-value
+
+    Returns
+    rows (list[list[str]]):
+                    One row per tandem repeat
+    """
+
+    return [
+        [
+            str(i) for i in [
+                tr.begin,
+                ",".join(tr.msa),
+                tr.l_effective,
+                tr.n_effective,
+                tr.repeat_region_length,
+                tr.divergence(score),
+                tr.pvalue(score)
+            ]
+        ]
+        for tr in tr_list
+    ]
+
+
+class StreamingResultWriter(object):
+    """
+    Append-only writer for the repeats of many proteins to a single file, in the same format as the output of
+    merge_tral_results.py (ID column followed by HEADER). Rows are buffered and written in batches of proteins, every
+    batch is flushed and synced to disk before the proteins in it are recorded as finished in the (optional)
+    checkpoint manifest. After a crash, rows of proteins that are not in the manifest are removed when the file is
+    reopened, so the file never contains partial or duplicated proteins.
+    """
+
+    def __init__(self, path, checkpoint=None, resume=False, batch_size=100):
+        """
+        Parameters
+        path (str):         results file
+        checkpoint (src.checkpoint.Checkpoint):
+                            manifest in which proteins are recorded once their rows are on disk
+        resume (bool):      If True, keep the rows of proteins that are in the checkpoint manifest and continue
+                            appending. If False (default), start a new file
+        batch_size (int):   number of proteins that are buffered before writing to disk
+        """
+
+        self.path = path
+        self.checkpoint = checkpoint
+        self.batch_size = batch_size
+        self.buffer = []
+        self.pending = []
+        if resume and os.path.isfile(self.path):
+            self.recover()
+        else:
+            with open(self.path, "w") as o:
+                o.write("ID\t{}\n".format("\t".join(HEADER)))
+        self.handle = open(self.path, "a")
+
+    def recover(self):
+        """Remove rows of proteins that were written but not recorded as finished in the manifest, as well as a
+        truncated last line
+        """
+
+        finished = self.checkpoint.done if self.checkpoint is not None else dict()
+        tmp_path = self.path + ".tmp"
+        with open(self.path, "r") as f, open(tmp_path, "w") as o:
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                if line.startswith("ID\t") or line.split("\t", 1)[0] in finished:
+                    o.write(line)
+        os.replace(tmp_path, self.path)
+
+    def add(self, accession, rows, denovo=0):
+        """Add the repeats of one protein. Proteins without repeats are recorded in the manifest directly
+
+        Parameters
+        accession (str):    protein identifier, written to the ID column
+        rows (list[list[str]]):
+                            repeats of the protein (see repeat_rows())
+        denovo (int):       number of de novo repeats for the protein, recorded in the manifest
+        """
+
+        if not rows:
+            if self.checkpoint is not None:
+                self.checkpoint.record(accession, denovo, 0)
+            return
+        self.buffer += ["{}\t{}\n".format(accession, "\t".join(row)) for row in rows]
+        self.pending.append((accession, denovo, len(rows)))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write all buffered rows, sync them to disk and record their proteins in the manifest"""
+
+        if not self.pending:
+            return
+        self.handle.write("".join(self.buffer))
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+        if self.checkpoint is not None:
+            self.checkpoint.record_many(self.pending)
+        self.buffer = []
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        self.handle.close()
+
+    def __str__(self):
+        return "StreamingResultWriter to '{}' (batches of {} proteins)".format(self.path, self.batch_size)
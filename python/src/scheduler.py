@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+"""
+Scheduling of proteins in parallel or sharded TR detection runs. A cost model fitted on sequence length is used to
+start the most expensive proteins first (so a few giant proteins do not decide the makespan), every protein gets a
+wall clock budget (and every worker process a memory budget), and proteins that exceed their budget are moved to a
+quarantine file to be retried separately. When a worker process dies, only the protein that crashed it is reported as
+failed: the proteins that were in the pool at that moment are retried in isolation.
+
+Author: Max Verbiest
+Contact: max.verbiest@zhaw.ch
+"""
+
+import concurrent.futures
+import contextlib
+import csv
+import itertools
+import logging
+import os
+import resource
+import signal
+import threading
+import traceback
+
+import numpy as np
+
+__all__ = [
+    "BudgetExceeded",
+    "CostModel",
+    "Quarantine",
+    "time_budget",
+    "set_memory_budget",
+    "memory_budget",
+    "detector_failures",
+    "run_in_pool",
+]
+
+# logger of the TRAL module that runs the external detectors, failures of detector processes are only logged there
+DETECTOR_LOGGER = "tral.sequence.repeat_detection_run"
+
+# memory budget (MB) of this process, set by set_memory_budget()
+_memory_budget = None
+
+
+class BudgetExceeded(BaseException):
+    """Raised when a protein exceeds its wall clock budget. Like KeyboardInterrupt, this is not an Exception, so it is
+    not swallowed by 'except Exception' clauses in the code that is interrupted (e.g. around external detectors)
+    """
+
+    pass
+
+
+class CostModel(object):
+    """
+    Power law model of the processing time of a protein as function of its length: seconds = scale * length ** exponent
+    """
+
+    def __init__(self, exponent=2.0, scale=1e-6):
+        self.exponent = exponent
+        self.scale = scale
+
+    @classmethod
+    def from_profile(cls, profile_csv):
+        """Fit the model on the per protein timings of an earlier run (.csv file written by run_tral.py --profile)
+
+        Parameters
+        profile_csv (str):  path to a RunProfiler .csv file, with columns 'length' and 'wall_total'
+        """
+
+        lengths, seconds = [], []
+        with open(profile_csv, "r") as f:
+            for row in csv.DictReader(f):
+                lengths.append(float(row["length"]))
+                seconds.append(float(row["wall_total"]))
+        model = cls()
+        model.fit(lengths, seconds)
+        return model
+
+    def fit(self, lengths, seconds):
+        """Least squares fit of log(seconds) on log(length), proteins without length or time are ignored"""
+
+        lengths, seconds = np.asarray(lengths, dtype=float), np.asarray(seconds, dtype=float)
+        keep = (lengths > 0) & (seconds > 0)
+        if keep.sum() < 2:
+            raise ValueError("Need at least two proteins with a length and processing time to fit a cost model")
+        exponent, intercept = np.polyfit(np.log(lengths[keep]), np.log(seconds[keep]), 1)
+        self.exponent, self.scale = float(exponent), float(np.exp(intercept))
+
+    def predict(self, length):
+        """Predicted processing time (seconds) for a protein of a given length"""
+
+        return self.scale * length ** self.exponent
+
+    def order(self, proteins):
+        """Sort (identifier, sequence) tuples from most to least expensive"""
+
+        return sorted(proteins, key=lambda protein: -self.predict(len(protein[1])))
+
+    def makespan(self, proteins, workers):
+        """Lower bound on the makespan of a run: the largest of the average load per worker and the most expensive
+        protein
+        """
+
+        costs = [self.predict(len(protein[1])) for protein in proteins]
+        if not costs:
+            return 0.0
+        return max(sum(costs) / workers, max(costs))
+
+    def __str__(self):
+        return "CostModel(seconds = {:.3g} * length ^ {:.3f})".format(self.scale, self.exponent)
+
+
+@contextlib.contextmanager
+def time_budget(seconds):
+    """Context manager raising BudgetExceeded when its block runs longer than the given number of seconds. Uses
+    SIGALRM, so it only works in the main thread of a process (as in pool worker processes). No budget if seconds is
+    None or 0
+    """
+
+    if not seconds:
+        yield
+        return
+
+    def handler(signum, frame):
+        raise BudgetExceeded("Wall clock budget of {} seconds exceeded".format(seconds))
+
+    previous = signal.signal(signal.SIGALRM, handler)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def set_memory_budget(megabytes):
+    """Limit the address space of the current process (and the processes it starts). Allocations beyond the limit
+    raise MemoryError. No limit if megabytes is None or 0
+
+    The limit is inherited by the external detectors that TRAL starts, which may then fail to start (e.g. a JVM that
+    reserves a large heap). TRAL only logs such failures, use detector_failures() to notice them
+    """
+
+    global _memory_budget
+    if not megabytes:
+        return
+    _memory_budget = megabytes
+    limit = int(megabytes * 1024 ** 2)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, resource.getrlimit(resource.RLIMIT_AS)[1]))
+
+
+def memory_budget():
+    """Memory budget (MB) of the current process, None if there is none"""
+
+    return _memory_budget
+
+
+@contextlib.contextmanager
+def detector_failures(stage=None):
+    """Context manager collecting the failures of external detectors that TRAL logs (warnings and errors of
+    DETECTOR_LOGGER) in its block, instead of raising them. Failures logged by other threads that were already running
+    when the block was entered are ignored: these are windows of an earlier protein that timed out (see
+    src.windowing), not detectors of the current protein
+
+    Parameters
+    stage (callable):   If given, called on every failure, e.g. to return the pipeline stage it occurred in
+
+    Yields
+    failures (list[tuple]):
+                        (stage, message) of every failure
+    """
+
+    failures = []
+    earlier = {thread.ident for thread in threading.enumerate()} - {threading.get_ident()}
+
+    class Collector(logging.Handler):
+        def emit(self, record):
+            if record.thread not in earlier:
+                failures.append((stage() if stage else None, record.getMessage()))
+
+    handler = Collector(logging.WARNING)
+    logger = logging.getLogger(DETECTOR_LOGGER)
+    logger.addHandler(handler)
+    try:
+        yield failures
+    finally:
+        logger.removeHandler(handler)
+
+
+def run_in_pool(function, proteins, workers, options=None, initializer=None, initargs=(), max_pending=None):
+    """Run function(seq_name, sequence, options) for every protein in a pool of worker processes. Results are yielded
+    in order of completion. Only max_pending proteins are submitted at a time. When a worker process dies (e.g. a
+    segfault in an external tool), all proteins in the pool fail with BrokenProcessPool: these are run again, each in
+    a process of its own, and the pool is rebuilt for the remaining proteins. Proteins that also crash their own
+    process, or raise an exception, are reported as {"id": seq_name, "denovo": 0, "repeats": [], "error": traceback}
+
+    Parameters
+    function (function):    picklable function returning a result dict with at least "id"
+    proteins (iterable):    (protein identifier, sequence) tuples
+    workers (int):          number of worker processes
+    options (dict):         passed on to function
+    initializer (function), initargs (tuple):
+                            initializer of every worker process
+    max_pending (int):      number of proteins submitted at a time, 2 * workers by default
+
+    Yields
+    result (dict):          result of function for every protein
+    """
+
+    def new_pool(processes):
+        return concurrent.futures.ProcessPoolExecutor(max_workers=processes, initializer=initializer,
+                                                      initargs=initargs)
+
+    def failed(seq_name, message=None):
+        return {"id": seq_name, "denovo": 0, "repeats": [], "error": (message or "") + traceback.format_exc()}
+
+    def in_isolation(suspects):
+        for start in range(0, len(suspects), workers):
+            pools = [new_pool(1) for _ in suspects[start:start + workers]]
+            try:
+                futures = {pool.submit(function, seq_name, sequence, options): seq_name
+                           for pool, (seq_name, sequence) in zip(pools, suspects[start:start + workers])}
+                for future in concurrent.futures.as_completed(futures):
+                    try:
+                        yield future.result()
+                    except concurrent.futures.process.BrokenProcessPool:
+                        yield failed(futures[future], "Worker process died while processing this protein (also when "
+                                                      "retried in a process of its own)\n")
+                    except Exception:
+                        yield failed(futures[future])
+            finally:
+                for pool in pools:
+                    pool.shutdown(wait=True, cancel_futures=True)
+
+    proteins = iter(proteins)
+    max_pending = max_pending or 2 * workers
+    pool = new_pool(workers)
+    pending = dict()
+    try:
+        while True:
+            for seq_name, sequence in itertools.islice(proteins, max_pending - len(pending)):
+                pending[pool.submit(function, seq_name, sequence, options)] = (seq_name, sequence)
+            if not pending:
+                return
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            suspects = []
+            for future in done:
+                protein = pending.pop(future)
+                try:
+                    yield future.result()
+                except concurrent.futures.process.BrokenProcessPool:
+                    suspects.append(protein)
+                except Exception:
+                    yield failed(protein[0])
+            if not suspects:
+                continue
+
+            # the pool is broken: proteins that finished before are kept, all others are retried in isolation
+            for future, protein in pending.items():
+                if future.done() and not future.cancelled() and future.exception() is None:
+                    yield future.result()
+                else:
+                    suspects.append(protein)
+            pending = dict()
+            pool.shutdown(wait=True, cancel_futures=True)
+            print("WARNING: a worker process died, retrying {} protein(s) in processes of their own: {}".format(
+                len(suspects), ", ".join(seq_name for seq_name, _ in suspects)))
+            yield from in_isolation(suspects)
+            pool = new_pool(workers)
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+class Quarantine(object):
+    """
+    File with proteins that exceeded their time or memory budget, one per line:
+        accession\tlength\tstage\treason\n
+    with 'stage' the pipeline stage the protein was in (see src.instrumentation.StageTimer) and 'reason' either
+    'timeout' or 'memory'.
+    """
+
+    def __init__(self, result_dir, resume=False, file_name="quarantine.txt"):
+        """
+        Parameters
+        result_dir (str):   directory where the results and the quarantine file are stored
+        resume (bool):      If True, read an existing quarantine file. If False (default), it is discarded
+        file_name (str):    name of the quarantine file in result_dir (not .tsv, these are taken as results)
+        """
+
+        self.path = os.path.join(result_dir, file_name)
+        if not resume and os.path.exists(self.path):
+            os.remove(self.path)
+        self.entries = self.read()
+
+    def read(self):
+        entries = dict()
+        if not os.path.exists(self.path):
+            return entries
+        with open(self.path, "r") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                accession, length, stage, reason = line.rstrip("\n").split("\t")
+                entries[accession] = (int(length), stage, reason)
+        return entries
+
+    def add(self, accession, length, stage, reason):
+        with open(self.path, "a") as o:
+            o.write("{}\t{}\t{}\t{}\n".format(accession, length, stage, reason))
+        self.entries[accession] = (length, stage, reason)
+
+    def release(self, accessions):
+        """Remove proteins (e.g. that succeeded when retried) from the quarantine file"""
+
+        for accession in accessions:
+            self.entries.pop(accession, None)
+        with open(self.path + ".tmp", "w") as o:
+            for accession, (length, stage, reason) in self.entries.items():
+                o.write("{}\t{}\t{}\t{}\n".format(accession, length, stage, reason))
+        os.replace(self.path + ".tmp", self.path)
+
+    def __contains__(self, accession):
+        return accession in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __str__(self):
+        return "Quarantine at '{}' ({} proteins)".format(self.path, len(self.entries))
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+"""
+Integer encoding of protein sequences as numpy uint8 arrays, so sequences can be scanned with vectorized operations.
+The 20 standard amino acids are encoded as 0-19 (in the order of AMINO_ACIDS), any other character as UNKNOWN.
+
+Author: Max Verbiest
+Contact: max.verbiest@zhaw.ch
+"""
+
+import numpy as np
+
+__all__ = [
+    "AMINO_ACIDS",
+    "UNKNOWN",
+    "encode",
+    "decode",
+]
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+UNKNOWN = len(AMINO_ACIDS)
+
+_LOOKUP = np.full(256, UNKNOWN, dtype=np.uint8)
+for _code, _amino_acid in enumerate(AMINO_ACIDS):
+    _LOOKUP[ord(_amino_acid)] = _code
+    _LOOKUP[ord(_amino_acid.lower())] = _code
+_CHARACTERS = np.frombuffer((AMINO_ACIDS + "X").encode("ascii"), dtype=np.uint8)
+
+
+def encode(sequence):
+    """Encode a protein sequence (str) as uint8 array"""
+
+    return _LOOKUP[np.frombuffer(sequence.encode("ascii", errors="replace"), dtype=np.uint8)]
+
+
+def decode(codes):
+    """Decode a uint8 array to a protein sequence (str), UNKNOWN is decoded as 'X'"""
+
+    return _CHARACTERS[codes].tobytes().decode("ascii")
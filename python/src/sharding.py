@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""
+Deterministic sharding of protein sets over independent (cluster) jobs. Every job reads the same input and selects its
+own shard, shards are balanced on a per protein cost (by default the sequence length) so that N jobs cover the input
+exactly once and take roughly equally long.
+
+Author: Max Verbiest
+Contact: max.verbiest@zhaw.ch
+"""
+
+import os
+import heapq
+
+__all__ = [
+    "parse_shard",
+    "assign_shards",
+    "select_shard",
+    "shard_dir",
+    "mark_shard_done",
+    "clear_shard_done",
+    "missing_shards",
+]
+
+DONE_FILE = "shard.done"
+
+
+def parse_shard(shard_string):
+    """Parse a shard specification of format 'i/N' (shard i out of N, 1 <= i <= N)
+
+    Returns
+    shard (tuple(int, int)):
+                (i, N)
+    """
+
+    try:
+        index, count = (int(i) for i in shard_string.split("/"))
+    except ValueError:
+        raise ValueError("Shard must be specified as 'i/N', not '{}'".format(shard_string))
+    if not 1 <= index <= count:
+        raise ValueError("Shard index must be between 1 and {}, not {}".format(count, index))
+    return index, count
+
+
+def assign_shards(costs, count):
+    """Assign items to shards such that the total cost per shard is balanced. Items are handled from most to least
+    expensive and each goes to the shard with the lowest total cost so far (ties: lowest shard index). The result only
+    depends on the set of items and their costs, not on their order
+
+    Parameters
+    costs (dict):   item key -> cost (e.g. accession -> sequence length)
+    count (int):    number of shards
+
+    Returns
+    assignment (dict):
+                    item key -> shard index (1-based)
+    """
+
+    loads = [(0, index) for index in range(1, count + 1)]
+    assignment = dict()
+    for key, cost in sorted(costs.items(), key=lambda i: (-i[1], i[0])):
+        load, index = heapq.heappop(loads)
+        assignment[key] = index
+        heapq.heappush(loads, (load + cost, index))
+    return assignment
+
+
+def select_shard(records, shard, key=lambda record: record.id, cost=len):
+    """Select the records that belong to a shard, in input order
+
+    Parameters
+    records (list):     all records of the input, e.g. Bio.SeqRecord objects
+    shard (tuple(int, int)):
+                        (i, N) as returned by parse_shard()
+    key (function):     function returning the (unique) key of a record
+    cost (function):    function returning the cost of a record
+
+    Returns
+    selected (list):    records assigned to shard i
+    """
+
+    index, count = shard
+    costs = dict()
+    for record in records:
+        costs[key(record)] = cost(record)
+    assignment = assign_shards(costs, count)
+    return [record for record in records if assignment[key(record)] == index]
+
+
+def shard_dir(output_dir, shard):
+    """Directory where the results of a shard are written: {output_dir}/shard_{i}_of_{N}"""
+
+    return os.path.join(output_dir, "shard_{}_of_{}".format(*shard))
+
+
+def mark_shard_done(directory, **info):
+    """Write a marker file to the result directory of a shard, signalling that the job has finished. Keyword
+    arguments (e.g. number of processed proteins) are written to the marker as key\tvalue lines
+    """
+
+    with open(os.path.join(directory, DONE_FILE), "w") as o:
+        for key, value in info.items():
+            o.write("{}\t{}\n".format(key, value))
+
+
+def clear_shard_done(directory):
+    """Remove the completion marker of a shard (if any) when its job (re)starts"""
+
+    marker = os.path.join(directory, DONE_FILE)
+    if os.path.isfile(marker):
+        os.remove(marker)
+
+
+def missing_shards(output_dir, count):
+    """Check which of the N shard jobs writing to output_dir have not (successfully) finished
+
+    Returns
+    missing (list[int]):
+                indices of shards without a completion marker
+    """
+
+    return [index for index in range(1, count + 1)
+            if not os.path.isfile(os.path.join(shard_dir(output_dir, (index, count)), DONE_FILE))]
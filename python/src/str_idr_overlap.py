@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""
+Overlap of STRs (tandem repeats from merged TRAL output) with intrinsically disordered regions (disordered segments,
+DSs, from disorder annotation), and the other columns of the final STR table (str_sp_final.tsv). Both interval sets are
+loaded into flat numpy arrays, overlapping STR-DS pairs are found with one binary search sweep over intervals sorted on
+(protein, begin) (src/intervals.py), and every overlap metric is summed per STR with np.bincount, so runtime is
+O(n log n + number of overlapping pairs).
+
+Overlap columns, in residues (coordinates are 1-based and inclusive):
+    TRinDS_overlap: STR length if the STR lies completely within a DS
+    DSinTR_overlap: summed length of the DSs that lie completely within the STR
+    head_overlap:   overlap with a DS that covers the start of the STR, but not its end
+    tail_overlap:   overlap with a DS that covers the end of the STR, but not its start
+    total_overlap:  sum of the four columns above
+An STR that covers parts of two DSs has both a head and a tail overlap. DSs of the same protein are assumed not to
+overlap each other (as in MobiDB-Lite output); if they do, residues covered by several DSs are counted for each.
+
+Author: Max Verbiest
+Contact: max.verbiest@zhaw.ch
+"""
+
+import numpy as np
+
+try:
+    from src.intervals import cross_overlapping_pairs
+    from src.kmer_profiler import protein_id, read_intervals
+except ModuleNotFoundError:
+    from intervals import cross_overlapping_pairs
+    from kmer_profiler import protein_id, read_intervals
+
+__all__ = [
+    "OVERLAP_COLUMNS",
+    "ADDED_COLUMNS",
+    "DISORDER_PROMOTING",
+    "ORDER_PROMOTING",
+    "overlap_columns",
+    "promoting",
+    "tr_type",
+    "center",
+    "annotate_strs",
+]
+
+OVERLAP_COLUMNS = ["DSinTR_overlap", "TRinDS_overlap", "tail_overlap", "head_overlap", "total_overlap"]
+# columns added to the merged TRAL output, in the order of str_sp_final.tsv
+ADDED_COLUMNS = ["center", "tr_type", "end"] + OVERLAP_COLUMNS + ["promoting", "protein_length"]
+
+# amino acids that promote disorder or order
+DISORDER_PROMOTING = frozenset("ARGQSPEKHD")
+ORDER_PROMOTING = frozenset("WCFIYVLNTM")
+
+
+def overlap_columns(tr_ids, tr_begins, tr_ends, ds_ids, ds_begins, ds_ends):
+    """Overlap of every STR with the DSs of its protein (see module docstring)
+
+    Parameters
+    tr_ids, ds_ids (array-like):
+                            protein of every STR and DS
+    tr_begins, tr_ends, ds_begins, ds_ends (array-like):
+                            first and last position of every STR and DS
+
+    Returns
+    overlaps (dict):        column name (OVERLAP_COLUMNS) -> array with the overlap of every STR
+    """
+
+    tr_begins, tr_ends = np.asarray(tr_begins, dtype=np.int64), np.asarray(tr_ends, dtype=np.int64)
+    ds_begins, ds_ends = np.asarray(ds_begins, dtype=np.int64), np.asarray(ds_ends, dtype=np.int64)
+    trs, dss = cross_overlapping_pairs(tr_ids, tr_begins, tr_ends, ds_ids, ds_begins, ds_ends)
+    tr_begin, tr_end, ds_begin, ds_end = tr_begins[trs], tr_ends[trs], ds_begins[dss], ds_ends[dss]
+    covers_start, covers_end = ds_begin <= tr_begin, ds_end >= tr_end
+    overlap = np.minimum(tr_end, ds_end) - np.maximum(tr_begin, ds_begin) + 1
+
+    n = len(tr_begins)
+    overlaps = {
+        "TRinDS_overlap": np.bincount(trs, weights=overlap * (covers_start & covers_end), minlength=n),
+        "DSinTR_overlap": np.bincount(trs, weights=overlap * (~covers_start & ~covers_end), minlength=n),
+        "head_overlap": np.bincount(trs, weights=overlap * (covers_start & ~covers_end), minlength=n),
+        "tail_overlap": np.bincount(trs, weights=overlap * (~covers_start & covers_end), minlength=n),
+    }
+    overlaps = {column: counts.astype(np.int64) for column, counts in overlaps.items()}
+    overlaps["total_overlap"] = sum(overlaps.values())
+    return {column: overlaps[column] for column in OVERLAP_COLUMNS}
+
+
+def promoting(msa):
+    """'disorder' or 'order' if all residues of an STR (msa_original, units separated by ',') promote disorder or
+    order, 'mixed' otherwise"""
+
+    residues = set(msa) - {",", "-"}
+    if residues <= DISORDER_PROMOTING:
+        return "disorder"
+    if residues <= ORDER_PROMOTING:
+        return "order"
+    return "mixed"
+
+
+def tr_type(l_effective):
+    """'homo' for homorepeats (unit length 1), 'micro' for longer units"""
+
+    return "homo" if int(l_effective) == 1 else "micro"
+
+
+def center(begin, end):
+    """Center of a region, formatted without decimals if it is a whole position"""
+
+    return str((begin + end) // 2) if (begin + end) % 2 == 0 else "{}.5".format((begin + end) // 2)
+
+
+def annotate_strs(tral_file, disorder_file, output_file, protein_lengths=None):
+    """Add the overlap with DSs, and the other columns of ADDED_COLUMNS that are missing, to merged TRAL output
+
+    Parameters
+    tral_file (str):        merged TRAL output (with header, columns ID, begin, msa_original, l_effective and
+                            end or repeat_region_length)
+    disorder_file (str):    DSs per protein, e.g. disorder annotator output (see src/kmer_profiler.read_intervals())
+    output_file (str):      path of the final STR table
+    protein_lengths (dict): If given, protein ID -> sequence length. protein_length is NA for proteins without length
+
+    Returns
+    n_strs (int), n_overlapping (int):
+                            number of STRs and of STRs that overlap a DS
+    """
+
+    with open(tral_file, "r") as f:
+        header = f.readline().rstrip("\n").split("\t")
+        rows = [line.rstrip("\n").split("\t") for line in f if line.strip()]
+    column = {name: index for index, name in enumerate(header)}
+    tr_ids = [protein_id(row[column["ID"]]) for row in rows]
+    tr_begins = np.array([int(row[column["begin"]]) for row in rows], dtype=np.int64)
+    if "end" in column:
+        tr_ends = np.array([int(row[column["end"]]) for row in rows], dtype=np.int64)
+    else:
+        tr_ends = tr_begins + np.array([int(row[column["repeat_region_length"]]) for row in rows], dtype=np.int64) - 1
+
+    regions = read_intervals(disorder_file)
+    ds_ids = np.repeat(list(regions), [len(begins) for begins, _ in regions.values()])
+    ds_begins = np.concatenate([begins for begins, _ in regions.values()] + [np.zeros(0, dtype=np.int64)])
+    ds_ends = np.concatenate([ends for _, ends in regions.values()] + [np.zeros(0, dtype=np.int64)])
+    overlaps = overlap_columns(tr_ids, tr_begins, tr_ends, ds_ids, ds_begins, ds_ends)
+
+    added = {
+        "center": [center(begin, end) for begin, end in zip(tr_begins.tolist(), tr_ends.tolist())],
+        "tr_type": [tr_type(row[column["l_effective"]]) for row in rows],
+        "end": tr_ends.tolist(),
+        "promoting": [promoting(row[column["msa_original"]]) for row in rows],
+        "protein_length": [protein_lengths.get(prot_id, "NA") if protein_lengths else "NA" for prot_id in tr_ids],
+    }
+    added.update({name: values.tolist() for name, values in overlaps.items()})
+    added_columns = [name for name in ADDED_COLUMNS if name not in column]
+
+    with open(output_file, "w") as o:
+        o.write("\t".join(header + added_columns) + "\n")
+        for index, row in enumerate(rows):
+            o.write("\t".join(row + [str(added[name][index]) for name in added_columns]) + "\n")
+    return len(rows), int(np.count_nonzero(overlaps["total_overlap"]))
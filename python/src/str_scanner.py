@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+"""
+Fast detection of short tandem repeats (STRs: homo-, di- and tri-peptide repeats) without TRAL. Sequences are integer
+encoded and concatenated, separated by blocks of unknown residues, so every unit length is scanned with a few
+vectorized operations over a whole batch of proteins:
+    - residues that are identical to the residue one unit length further form runs of perfect repeats
+    - runs with the same unit (up to rotation) that are separated by a single substitution are merged and regions
+      are extended over a substituted unit at their edges (near-perfect repeats), insertions and deletions are not
+      bridged
+    - repeats that are too short, have a non-primitive unit (e.g. 'AA') or too many substitutions are removed, of
+      overlapping repeats with different unit lengths the longest is kept
+
+Repeats are reported in the columns of run_tral.py output. msa_original is the repeat region cut in consecutive units,
+divergence is the fraction of residues that differ from the consensus unit and no p-value is calculated ('nan').
+
+Author: Max Verbiest
+Contact: max.verbiest@zhaw.ch
+"""
+
+import collections
+
+import numpy as np
+
+try:
+    from src.sequence_encoding import encode, decode, UNKNOWN
+except ModuleNotFoundError:
+    from sequence_encoding import encode, decode, UNKNOWN
+
+__all__ = [
+    "STRScanner",
+]
+
+
+class STRScanner(object):
+    """
+    Vectorized scanner for perfect and near-perfect tandem repeats with short units
+    """
+
+    def __init__(self, max_period=3, min_length=6, n_threshold=2.5, max_divergence=0.14):
+        """
+        Parameters
+        max_period (int):   longest repeat unit
+        min_length (int):   minimal length of a repeat region
+        n_threshold (float):
+                            minimal number of repeat units (as the n_effective filter of run_tral.py)
+        max_divergence (float):
+                            maximal fraction of residues that differ from the consensus unit. The default is the
+                            largest fraction among the TRs in data_for_sub/str_sp_final.tsv (TRAL divergence < 0.1)
+        """
+
+        self.max_period = max_period
+        self.min_length = min_length
+        self.n_threshold = n_threshold
+        self.max_divergence = max_divergence
+
+    def concatenate(self, sequences):
+        """Encode and concatenate sequences, separated by max_period unknown residues that never match
+
+        Returns
+        codes (np.ndarray): uint8 array with all sequences
+        offsets (np.ndarray):
+                            start position of every sequence in codes
+        """
+
+        separator = "X" * self.max_period
+        lengths = np.array([len(sequence) + len(separator) for sequence in sequences], dtype=np.int64)
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        return encode(separator.join(sequences) + separator), offsets
+
+    def scan_period(self, codes, period):
+        """Find repeats with one unit length in concatenated sequences
+
+        Returns
+        starts, ends, mismatches (tuple(np.ndarray, np.ndarray, np.ndarray)):
+                            region (0-based, half-open) and number of substitutions of every repeat
+        """
+
+        matches = (codes[:-period] == codes[period:]) & (codes[:-period] != UNKNOWN)
+        steps = np.diff(np.concatenate(([0], matches.view(np.int8), [0])))
+        # runs of matches, a run [start, end) is a perfect repeat region [start, end + period)
+        starts, ends = np.flatnonzero(steps == 1), np.flatnonzero(steps == -1)
+        keep = ends - starts >= period
+        starts, ends = starts[keep], ends[keep]
+        if len(starts) == 0:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty.copy(), empty.copy()
+
+        # runs with the same unit (up to rotation) with a single substitution in between are merged
+        units = np.stack([codes[starts + k].astype(np.int64) for k in range(period)])
+        canonical = np.min([sum(units[(rotation + k) % period] * (UNKNOWN + 1) ** k for k in range(period))
+                            for rotation in range(period)], axis=0)
+        join = (starts[1:] - ends[:-1] <= period + 1) & (canonical[1:] == canonical[:-1])
+        first = np.flatnonzero(np.concatenate(([True], ~join)))
+        last = np.flatnonzero(np.concatenate((~join, [True])))
+        region_starts, region_ends = starts[first], ends[last] + period
+        region_starts, region_ends, extended = self.extend(codes, region_starts, region_ends, period)
+
+        lengths = region_ends - region_starts
+        keep = (lengths >= self.min_length) & (lengths / period >= self.n_threshold)
+        keep &= self.primitive(codes, region_starts, period)
+        region_starts, region_ends = region_starts[keep], region_ends[keep]
+        imperfect = ((last > first) | extended)[keep]
+
+        mismatches = np.zeros(len(region_starts), dtype=np.int64)
+        for i in np.flatnonzero(imperfect):
+            mismatches[i] = self.substitutions(codes[region_starts[i]:region_ends[i]], period)
+        keep = mismatches <= self.max_divergence * (region_ends - region_starts)
+        return region_starts[keep], region_ends[keep], mismatches[keep]
+
+    @staticmethod
+    def extend(codes, starts, ends, period):
+        """Extend repeat regions over a substituted unit at their edges: by two units if the unit beyond is identical
+        to the unit at the edge, otherwise by the substituted unit itself if at least half of it matches
+
+        Returns
+        starts, ends, extended (tuple(np.ndarray, np.ndarray, np.ndarray)):
+                            extended regions and whether they were extended
+        """
+
+        def units(positions):
+            # residues of the units starting at positions (one column per unit), UNKNOWN outside of codes
+            index = positions[np.newaxis, :] + np.arange(period)[:, np.newaxis]
+            inside = (index >= 0) & (index < len(codes))
+            return np.where(inside, codes[np.clip(index, 0, len(codes) - 1)], UNKNOWN)
+
+        extensions = []
+        for edge, direction in ((starts, -1), (ends - period, 1)):
+            unit, substituted = units(edge), units(edge + direction * period)
+            known = (substituted != UNKNOWN).all(axis=0)
+            beyond = known & (units(edge + 2 * direction * period) == unit).all(axis=0)
+            partial = known & ((substituted == unit).sum(axis=0) * 2 >= period)
+            extensions.append(np.where(beyond, 2 * period, np.where(partial, period, 0)))
+        return starts - extensions[0], ends + extensions[1], (extensions[0] > 0) | (extensions[1] > 0)
+
+    @staticmethod
+    def primitive(codes, starts, period):
+        """Is the unit at every start position primitive, i.e. not a repetition of a shorter unit?"""
+
+        primitive = np.ones(len(starts), dtype=bool)
+        for divisor in range(1, period):
+            if period % divisor:
+                continue
+            repetition = np.ones(len(starts), dtype=bool)
+            for k in range(period - divisor):
+                repetition &= codes[starts + k] == codes[starts + k + divisor]
+            primitive &= ~repetition
+        return primitive
+
+    @staticmethod
+    def substitutions(region, period):
+        """Number of residues in a repeat region that differ from the most common residue at their unit position"""
+
+        mismatches = 0
+        for phase in range(period):
+            column = region[phase::period]
+            mismatches += len(column) - np.bincount(column).max()
+        return int(mismatches)
+
+    def scan(self, proteins):
+        """Detect STRs in a batch of proteins
+
+        Parameters
+        proteins (list[tuple(str, str)]):
+                            (protein identifier, sequence) tuples
+
+        Returns
+        repeats (collections.OrderedDict):
+                            protein identifier -> rows (in the column order of src.result_writer.HEADER, sorted by
+                            begin), only for proteins with STRs, in input order
+        """
+
+        codes, offsets = self.concatenate([sequence for _, sequence in proteins])
+        candidates = []
+        for period in range(1, self.max_period + 1):
+            starts, ends, mismatches = self.scan_period(codes, period)
+            candidates += zip(starts.tolist(), ends.tolist(), [period] * len(starts), mismatches.tolist())
+
+        kept = []
+        for cluster in overlap_clusters(sorted(candidates)):
+            kept += resolve_overlaps(cluster)
+
+        repeats = collections.OrderedDict()
+        protein_index = np.searchsorted(offsets, [start for start, _, _, _ in kept], side="right") - 1
+        for (start, end, period, mismatches), index in zip(kept, protein_index.tolist()):
+            region = decode(codes[start:end])
+            units = [region[i:i + period].ljust(period, "-") for i in range(0, len(region), period)]
+            repeats.setdefault(proteins[index][0], []).append([
+                str(start - offsets[index] + 1),
+                ",".join(units),
+                str(period),
+                "{:g}".format(round(len(region) / period, 2)),
+                str(len(region)),
+                "{:g}".format(mismatches / len(region)),
+                "nan",
+            ])
+        return repeats
+
+    def __str__(self):
+        return "STRScanner(max_period={}, min_length={}, n_threshold={}, max_divergence={})".format(
+            self.max_period, self.min_length, self.n_threshold, self.max_divergence)
+
+
+def overlap_clusters(candidates):
+    """Group repeats sorted by start position in clusters of (transitively) overlapping repeats"""
+
+    cluster, cluster_end = [], 0
+    for candidate in candidates:
+        if cluster and candidate[0] >= cluster_end:
+            yield cluster
+            cluster = []
+        if not cluster:
+            cluster_end = candidate[1]
+        cluster.append(candidate)
+        cluster_end = max(cluster_end, candidate[1])
+    if cluster:
+        yield cluster
+
+
+def resolve_overlaps(cluster):
+    """Remove overlapping repeats from a cluster: keep the longest, then the one with the shortest unit
+
+    Returns
+    kept (list):    non-overlapping repeats, sorted by start position
+    """
+
+    if len(cluster) == 1:
+        return cluster
+    kept = []
+    for candidate in sorted(cluster, key=lambda c: (c[0] - c[1], c[2], c[0])):
+        if all(candidate[1] <= start or end <= candidate[0] for start, end, _, _ in kept):
+            kept.append(candidate)
+    return sorted(kept)
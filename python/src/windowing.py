@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+"""
+Windowed de novo detection for very long proteins. The run time of TRAL de novo detection grows much faster than
+linearly with sequence length, so long sequences are split into overlapping windows that are processed in parallel
+(the de novo detectors are external programs, so threads are sufficient). Repeats are mapped back to protein
+coordinates; repeats that touch an inner window edge may be truncated and are detected again on a region around them
+that is grown until they no longer touch its edges (stitching). Stitched regions are at most 2 * size + overlap long,
+so windowing keeps bounding the sequence length per detection. Repeats found in more than one window are reported once.
+
+Author: Max Verbiest
+Contact: max.verbiest@zhaw.ch
+"""
+
+import concurrent.futures
+import threading
+
+__all__ = [
+    "SequenceWindows",
+    "detect_denovo",
+]
+
+
+class SequenceWindows(object):
+    """
+    Splitting of long sequences in overlapping windows. Repeats with a region shorter than the overlap are completely
+    inside at least one window, longer repeats are stitched.
+    """
+
+    def __init__(self, size=2000, overlap=500, min_length=5000, margin=5, threads=4):
+        """
+        Parameters
+        size (int):         window length
+        overlap (int):      number of residues shared by neighbouring windows
+        min_length (int):   only sequences of at least this length are split in windows
+        margin (int):       repeats that start or end within this many residues of an inner window edge are
+                            considered truncated
+        threads (int):      number of windows that are processed at the same time
+        """
+
+        if not 0 <= overlap < size:
+            raise ValueError("Window overlap should be smaller than the window size")
+        self.size = size
+        self.overlap = overlap
+        self.min_length = max(min_length, size)
+        self.margin = margin
+        self.threads = threads
+        # longest region that is detected at once when stitching
+        self.max_stitch = 2 * size + overlap
+
+    def applies(self, length):
+        return length >= self.min_length
+
+    def windows(self, length):
+        """Windows covering a sequence of a given length as 0-based, half-open (start, end) tuples. The last window
+        ends at the end of the sequence
+        """
+
+        if length <= self.size:
+            return [(0, length)]
+        step = self.size - self.overlap
+        starts = list(range(0, length - self.size, step)) + [length - self.size]
+        return [(start, start + self.size) for start in starts]
+
+    def touches_edge(self, window, region, length):
+        """Does a repeat region touch an edge of the window that is not an end of the sequence?"""
+
+        start, end = window
+        begin, stop = region
+        return (start > 0 and begin < start + self.margin) or (end < length and stop > end - self.margin)
+
+    def stitch_regions(self, edges, length):
+        """Regions around truncated repeats to detect again: merged repeat regions extended by the overlap, regions
+        longer than max_stitch are split in overlapping regions of max_stitch
+        """
+
+        regions = []
+        for begin, end in merge_regions(edges):
+            start, end = max(0, begin - self.overlap), min(length, end + self.overlap)
+            if end - start <= self.max_stitch:
+                regions.append((start, end))
+                continue
+            step = self.max_stitch - self.overlap
+            starts = list(range(start, end - self.max_stitch, step)) + [end - self.max_stitch]
+            regions += [(region_start, region_start + self.max_stitch) for region_start in starts]
+        return regions
+
+    def detect(self, length, detect, span, key):
+        """Detect repeats in all windows of a sequence and stitch repeats at window edges
+
+        Parameters
+        length (int):       sequence length
+        detect (function):  detect(start, end) returns the repeats in sequence[start:end], in protein coordinates
+        span (function):    span(repeat) returns the region of a repeat as 0-based, half-open (begin, end) tuple
+        key (function):     key(repeat) identifies a repeat, repeats with the same key are reported once
+
+        Returns
+        repeats (list):     repeats in order of their window
+        """
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads)
+        stopped = threading.Event()
+
+        def checked(start, end):
+            # windows and stitched regions that start after the protein was stopped are skipped
+            return [] if stopped.is_set() else detect(start, end)
+
+        try:
+            windows = self.windows(length)
+            found = list(executor.map(lambda window: checked(*window), windows))
+
+            repeats, edges = [], []
+            for window, window_repeats in zip(windows, found):
+                for repeat in window_repeats:
+                    if self.touches_edge(window, span(repeat), length):
+                        edges.append(span(repeat))
+                    else:
+                        repeats.append(repeat)
+
+            regions = self.stitch_regions(edges, length)
+            for stitched in executor.map(lambda region: self.redetect(region, length, checked, span, stopped),
+                                         regions):
+                repeats += stitched
+        finally:
+            # on a timeout of the protein (BudgetExceeded in this thread), windows that did not start are cancelled
+            # and the protein is given up at once: running windows are not awaited, a hung detector would otherwise
+            # block the worker without limit. Their threads finish in the background and start no new detections
+            stopped.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        unique = dict()
+        for repeat in repeats:
+            unique.setdefault(key(repeat), repeat)
+        return list(unique.values())
+
+    def redetect(self, region, length, detect, span, stopped=None):
+        """Detect repeats in a region around truncated repeats, the region is grown until none of its repeats touch
+        its inner edges or it is max_stitch long (repeats may then still be truncated). Stops growing once the
+        stopped event (threading.Event) is set
+        """
+
+        start, end = region
+        while True:
+            repeats = detect(start, end)
+            if not any(self.touches_edge((start, end), span(repeat), length) for repeat in repeats):
+                return repeats
+            grow = min(self.size, (self.max_stitch - (end - start)) // 2)
+            if grow <= 0 or (start == 0 and end == length) or (stopped is not None and stopped.is_set()):
+                return repeats
+            start, end = max(0, start - grow), min(length, end + grow)
+
+    def __str__(self):
+        return "SequenceWindows(size={}, overlap={}, min_length={}, threads={})".format(
+            self.size, self.overlap, self.min_length, self.threads)
+
+
+def merge_regions(regions):
+    """Merge overlapping or adjacent (begin, end) regions"""
+
+    merged = []
+    for begin, end in sorted(regions):
+        if merged and begin <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([begin, end])
+    return [tuple(region) for region in merged]
+
+
+def detect_denovo(seq, windows=None):
+    """De novo detection on a sequence, in windows if the sequence is long enough
+
+    Parameters
+    seq (tral.sequence.Sequence):
+                    sequence to detect repeats in
+    windows (SequenceWindows):
+                    If None (default) or the sequence is shorter than windows.min_length, the complete sequence is
+                    run through de novo detection at once
+
+    Returns
+    denovo_list (tral.repeat_list.RepeatList):
+                    de novo repeats, with begin in protein coordinates
+    """
+
+    from tral.sequence import sequence
+    from tral.repeat_list import repeat_list
+
+    if windows is None or not windows.applies(len(seq.seq)):
+        return seq.detect(denovo=True)
+
+    def detect(start, end):
+        found = sequence.Sequence(seq=seq.seq[start:end], name=seq.name).detect(denovo=True)
+        repeats = found.repeats if found else []
+        for TR in repeats:
+            TR.begin += start
+        return repeats
+
+    return repeat_list.RepeatList(windows.detect(
+        len(seq.seq), detect,
+        span=lambda TR: (TR.begin - 1, TR.begin - 1 + TR.repeat_region_length),
+        key=lambda TR: (TR.begin, tuple(TR.msa))))
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the scripts import the modules in python/src as 'src.<module>'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
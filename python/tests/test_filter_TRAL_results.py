@@ -0,0 +1,30 @@
+import pytest
+
+from filter_TRAL_results import tral_file_filter
+
+HEADER = "ID\tbegin\tmsa_original\tl_effective\tn_effective\trepeat_region_length\tdivergence\tpvalue\n"
+
+
+def test_unsorted_input(tmp_path):
+    # the TRs of protein A are not listed together
+    rows = ["A\t1\tQQQ\t1\t3\t3\t0\t0.1\n",
+            "B\t2\tPPP\t1\t3\t3\t0\t0.1\n",
+            "A\t1\tQQQ\t1\t3\t3\t0\t0.1\n",
+            "A\t2\tQQQQQ\t1\t5\t5\t0\t0.01\n"]
+    merged, filtered = tmp_path / "merged.tsv", tmp_path / "filtered.tsv"
+    merged.write_text(HEADER + "".join(rows))
+
+    assert tral_file_filter(str(merged), str(filtered)) == (4, 1)
+    assert filtered.read_text() == HEADER + rows[0] + rows[1] + rows[3]
+
+    assert tral_file_filter(str(merged), str(filtered), overlap_rule="pvalue") == (4, 2)
+    assert filtered.read_text() == HEADER + rows[1] + rows[3]
+
+
+def test_malformed_line(tmp_path):
+    merged, filtered = tmp_path / "merged.tsv", tmp_path / "filtered.tsv"
+    merged.write_text(HEADER + "A\t1\tQQQ\t1\t3\t3\t0\t0.1\n" + "B\n")
+
+    with pytest.raises(IndexError):
+        tral_file_filter(str(merged), str(filtered))
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["merged.tsv"]
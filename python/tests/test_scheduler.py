@@ -0,0 +1,74 @@
+import logging
+import os
+import threading
+import time
+
+import pytest
+
+from src.instrumentation import StageTimer
+from src.scheduler import DETECTOR_LOGGER, BudgetExceeded, detector_failures, run_in_pool, time_budget
+from src.windowing import SequenceWindows
+
+
+def test_detector_failures():
+    logger = logging.getLogger(DETECTOR_LOGGER)
+    with detector_failures(lambda: "denovo") as failures:
+        logger.info("Launching detector")
+        logger.warning("Process %s has empty STDOUT but non-empty STDERR.", "T-REKS")
+    logger.warning("Process %s has empty STDOUT but non-empty STDERR.", "XSTREAM")
+    assert failures == [("denovo", "Process T-REKS has empty STDOUT but non-empty STDERR.")]
+
+
+def test_timeout_with_windows():
+    release = threading.Event()
+    timer = StageTimer()
+
+    def hung_detect(start, end):
+        logging.getLogger(DETECTOR_LOGGER).warning("Process %s has empty STDOUT but non-empty STDERR.", "T-REKS")
+        release.wait(30)
+        logging.getLogger(DETECTOR_LOGGER).warning("Process %s has empty STDOUT but non-empty STDERR.", "XSTREAM")
+        return []
+
+    # as detect_protein_repeats_safely() in run_tral.py
+    begin = time.perf_counter()
+    try:
+        with pytest.raises(BudgetExceeded):
+            with detector_failures(lambda: timer.current_stage) as failures, time_budget(0.5):
+                with timer.stage("denovo"):
+                    SequenceWindows(threads=2).detect(20000, hung_detect, span=lambda r: r, key=lambda r: r)
+        assert time.perf_counter() - begin < 2
+        assert timer.current_stage == "denovo"
+        assert [stage for stage, _ in failures] == ["denovo", "denovo"]
+
+        # the windows of the timed out protein fail while the next protein is processed
+        with detector_failures() as failures:
+            release.set()
+            time.sleep(0.1)
+        assert failures == []
+    finally:
+        release.set()
+
+
+def crash_on_request(seq_name, sequence, options):
+    # worker function for run_in_pool(), kills its process for protein 'crash'
+    if seq_name == "crash":
+        os._exit(1)
+    if seq_name == "error":
+        raise ValueError("no repeats for you")
+    time.sleep(0.01)
+    return {"id": seq_name, "denovo": len(sequence), "repeats": [], "error": None}
+
+
+def test_run_in_pool_worker_crash():
+    proteins = [("P{}".format(i), "M" * i) for i in range(40)]
+    proteins[10] = ("crash", "MKL")
+    proteins[20] = ("error", "MKL")
+    results = {result["id"]: result for result in run_in_pool(crash_on_request, proteins, workers=3, max_pending=6)}
+
+    assert set(results) == {seq_name for seq_name, _ in proteins}
+    failed = {seq_name for seq_name, result in results.items() if result["error"]}
+    assert failed == {"crash", "error"}
+    assert "Worker process died" in results["crash"]["error"]
+    assert "ValueError" in results["error"]["error"]
+    assert all(results[seq_name]["denovo"] == len(sequence) for seq_name, sequence in proteins
+               if seq_name not in failed)
@@ -0,0 +1,25 @@
+import numpy as np
+
+from src.str_scanner import STRScanner
+
+
+def test_proteins_without_strs():
+    scanner = STRScanner()
+    for sequence in ["MKLVWDEFGHIKLMNPQRST", "MQQKLPAPK", "MKKLL", ""]:
+        assert scanner.scan([("P1", sequence)]) == {}
+
+
+def test_period_without_seed_runs():
+    scanner = STRScanner()
+    codes, _ = scanner.concatenate(["MAAAAAAAK"])
+    starts, ends, mismatches = scanner.scan_period(codes, 3)
+    assert len(starts) == len(ends) == len(mismatches) == 0
+    assert starts.dtype == ends.dtype == mismatches.dtype == np.int64
+
+
+def test_batch_lacking_one_period():
+    # homo- and di-peptide repeats, no tri-peptide repeat
+    repeats = STRScanner().scan([("P1", "MKLVWDEFG"), ("P2", "MAAAAAAAK"), ("P3", "MKLPEPEPEPEPEW")])
+    assert list(repeats) == ["P2", "P3"]
+    assert repeats["P2"] == [["2", "A,A,A,A,A,A,A", "1", "7", "7", "0", "nan"]]
+    assert repeats["P3"][0][:3] == ["4", "PE,PE,PE,PE,PE", "2"]
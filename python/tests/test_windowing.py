@@ -0,0 +1,68 @@
+import csv
+import os
+import random
+import threading
+import time
+
+import pytest
+
+from src.scheduler import BudgetExceeded, time_budget
+from src.str_scanner import STRScanner
+from src.windowing import SequenceWindows
+
+REFERENCE = os.path.join(os.path.dirname(__file__), "..", "..", "data_for_sub", "str_sp_final.tsv")
+
+
+def scanner_detect(sequence):
+    """detect(start, end) for SequenceWindows with the STR scanner as de novo detector"""
+
+    scanner = STRScanner()
+
+    def detect(start, end):
+        rows = scanner.scan([("P1", sequence[start:end])]).get("P1", [])
+        return [(int(row[0]) - 1 + start, int(row[4]), row[1]) for row in rows]
+
+    return detect
+
+
+def test_windows_match_full_sequence():
+    # long protein of random residues with the STRs of the reference table, also across window edges
+    rng = random.Random(1)
+    with open(REFERENCE, "r") as f:
+        regions = [row["msa_original"].replace(",", "").replace("-", "") for row in csv.DictReader(f, delimiter="\t")]
+    parts = []
+    for region in regions[:300]:
+        parts.append("".join(rng.choice("ACDEFGHIKLMNPQRSTVWY") for _ in range(rng.randint(5, 60))))
+        parts.append(region)
+    sequence = "".join(parts)
+    assert len(sequence) > 10000
+
+    windows = SequenceWindows(size=2000, overlap=500, min_length=5000)
+    detect = scanner_detect(sequence)
+    windowed = windows.detect(len(sequence), detect, span=lambda r: (r[0], r[0] + r[1]), key=lambda r: r)
+    assert sorted(windowed) == sorted(detect(0, len(sequence)))
+
+
+def test_timeout_with_windows():
+    release = threading.Event()
+    started = []
+
+    def hung_detect(start, end):
+        # a detector that hangs until the end of the test
+        started.append((start, end))
+        release.wait(30)
+        return []
+
+    windows = SequenceWindows(size=2000, overlap=500, min_length=5000, threads=2)
+    begin = time.perf_counter()
+    try:
+        with pytest.raises(BudgetExceeded):
+            with time_budget(0.5):
+                windows.detect(20000, hung_detect, span=lambda r: r, key=lambda r: r)
+        assert time.perf_counter() - begin < 2
+        # no windows are started after the timeout
+        assert len(started) == 2
+    finally:
+        release.set()
+    time.sleep(0.1)
+    assert len(started) == 2
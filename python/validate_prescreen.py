@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Report how many known tandem repeats would be missed by the periodicity pre-screen of run_tral.py (--prescreen).
+The reference set is a table with at least the columns ID, msa_original and l_effective, e.g. merged run_tral.py output
+or data_for_sub/str_sp_final.tsv.
+
+Without a fasta file, every TR is checked on its own repeat region (reconstructed from msa_original): a TR whose region
+fails the screen would also be missed if no other part of the protein passes. With a fasta file, the screen is run on
+the complete proteins, which gives the exact number of missed TRs and the number of proteins that would skip TRAL.
+
+Author: Max Verbiest
+Contact: max.verbiest@zhaw.ch
+"""
+
+import argparse
+import csv
+import collections
+
+from src.prescreen import Prescreen
+
+
+def read_reference(reference_file):
+    """Read reference TRs
+
+    Returns
+    repeats (list[dict]):
+                rows of the reference table
+    """
+
+    with open(reference_file, "r") as f:
+        return list(csv.DictReader(f, delimiter="\t"))
+
+
+def validate_regions(screen, repeats):
+    """Run the screen on the repeat region of every reference TR
+
+    Returns
+    missed (collections.Counter):
+                number of TRs for which the region does not pass, per l_effective
+    """
+
+    missed = collections.Counter()
+    for tr in repeats:
+        region = tr["msa_original"].replace(",", "").replace("-", "")
+        if not screen.passes(region):
+            missed[tr["l_effective"]] += 1
+    return missed
+
+
+def validate_proteins(screen, repeats, fasta):
+    """Run the screen on all proteins in a fasta file
+
+    Returns
+    missed (collections.Counter):
+                number of reference TRs in proteins that do not pass, per l_effective
+    screened_out (int):
+                number of proteins that do not pass
+    total (int):
+                number of proteins in fasta file
+    """
+
+    from Bio import SeqIO
+
+    failed = set()
+    total = 0
+    for record in SeqIO.parse(fasta, "fasta"):
+        total += 1
+        if not screen.passes(str(record.seq)):
+            failed.add(record.id.split("|")[1])
+    missed = collections.Counter(tr["l_effective"] for tr in repeats if tr["ID"] in failed)
+    return missed, len(failed), total
+
+
+def print_missed(missed, repeats):
+    per_length = collections.Counter(tr["l_effective"] for tr in repeats)
+    print("Missed {} out of {} reference TRs ({:.2%})".format(
+        sum(missed.values()), len(repeats), sum(missed.values()) / len(repeats) if repeats else 0))
+    for l_effective in sorted(per_length, key=float):
+        print("    l_effective {}:\t{} / {} missed".format(l_effective, missed[l_effective], per_length[l_effective]))
+
+
+def parser():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--reference", "-r", type=str, required=True,
+        help="Table with reference TRs (columns ID, msa_original, l_effective), e.g. str_sp_final.tsv"
+    )
+    parser.add_argument(
+        "--fasta", "-f", type=str, default=None,
+        help="Fasta file with the proteins of the reference set. If given, the screen is run on complete proteins"
+    )
+    parser.add_argument(
+        "--max-period", type=int, default=100, help="Longest repeat unit that is screened for (default: 100)"
+    )
+    parser.add_argument(
+        "--min-identity", type=float, default=0.7,
+        help="Minimal fraction of identical residues between neighbouring units (default: 0.7)"
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    args = parser()
+    screen = Prescreen(max_period=args.max_period, min_identity=args.min_identity)
+    repeats = read_reference(args.reference)
+    print(screen)
+
+    print("\nScreen on repeat regions:")
+    print_missed(validate_regions(screen, repeats), repeats)
+
+    if args.fasta:
+        missed, screened_out, total = validate_proteins(screen, repeats, args.fasta)
+        print("\nScreen on complete proteins:")
+        print("{} out of {} proteins ({:.2%}) would skip TRAL".format(
+            screened_out, total, screened_out / total if total else 0))
+        print_missed(missed, repeats)
+
+
+if __name__ == "__main__":
+    main()